@@ -6,10 +6,14 @@
 
 from .enums import CommandTag, PropertyTag, StatusCode
 from .memorytool import MemoryBlock, Memory, Flash
+from .image import Image, ImageCache
 from .peripheral import parse_peripheral, scan_usb, scan_uart, scan_spi, scan_i2c
 from .mboot import McuBoot, decode_property_value, is_command_available
+from .scheduler import Scheduler, Session
+from .retry import RetryPolicy
 from .decorator import global_error_handler
-from .exception import McuBootGenericError, McuBootCommandError, McuBootDataError, McuBootConnectionError, McuBootTimeOutError
+from .exception import McuBootGenericError, McuBootCommandError, McuBootDataError, McuBootConnectionError, McuBootTimeOutError, \
+    McuBootVerifyError
 
 __author__ = "Martin Olejar"
 __contact__ = "martin.olejar@gmail.com"
@@ -25,6 +29,8 @@ __all__ = [
     'MemoryBlock',
     'Memory',
     'Flash',
+    'Image',
+    'ImageCache',
     # peripheral
     'parse_peripheral',
     'scan_usb',
@@ -33,6 +39,9 @@ __all__ = [
     'scan_i2c',
     # classes
     'McuBoot',
+    'Scheduler',
+    'Session',
+    'RetryPolicy',
     # enums
     'CommandTag',
     'PropertyTag',
@@ -44,5 +53,6 @@ __all__ = [
     'McuBootCommandError',
     'McuBootDataError',
     'McuBootConnectionError',
-    'McuBootTimeOutError'
+    'McuBootTimeOutError',
+    'McuBootVerifyError'
 ]
@@ -1,15 +1,18 @@
 import sys
+import time
 import argparse
 import re as _re
 import logging
 
 from . import mboot
-from .tool import check_method_arg_number, convert_arg_to_int, check_key, check_int, hexdump, read_file
+from .tool import check_method_arg_number, convert_arg_to_int, check_key, check_int, hexdump, size_fmt
 from .enums import PropertyTag
 from .constant import Interface
 from .memorytool import MemoryBlock
+from .image import Image
 from .peripheral import parse_peripheral
 from .exception import McuBootGenericError
+from .retry import RetryPolicy
 from . import global_error_handler
 from . import __version__
 
@@ -75,32 +78,46 @@ def info(mb, memory_id=0, exconf=None):
                 m += "\n  = {}".format(value)
             print(m)
 
-def write(mb, address, filename, memory_id=0, offset=0, no_erase=False, exconf=None):
+def write(mb, address, filename, memory_id=0, offset=0, no_erase=False, exconf=None, delta=False, spot_check=0,
+          verify=False, chunk_size=0, compress=False):
     do_erase = not no_erase
+    in_ram = False
     mb.get_memory_range()
-    data, start_address = read_file(filename, address)
-    length = len(data) - offset
-    data = data[offset:]
-    block = MemoryBlock(start_address, None, length)
+    image = Image.from_file(filename, address, offset)
+    if len(image) == 0:
+        raise ValueError('Data len is zero')
+    block = MemoryBlock(image.minimum_address, image.maximum_address)
     if memory_id:
         if exconf:
             mb.setup_external_memory(memory_id, exconf)
         # Some device do not support EXTERNAL_MEMORY_ATTRIBUTES Property, so external memory will not check memory range
-
-        if do_erase:
-            mb.flash_erase_region(start_address, length, memory_id)
     else:
         if mb.is_in_flash(block):
-            if do_erase:    # erase first if block in the flash area
-                mb.flash_erase_region(block.start, block.length)
-        elif mb.is_in_memory(block):
             pass
+        elif mb.is_in_memory(block):
+            do_erase = False
+            delta = False
+            in_ram = True
         else:
             raise McuBootGenericError('MemoryRangeInvalid, please check the address range.')
-        start = mb.get_property(PropertyTag.RAM_START_ADDRESS)
-    mb.write_memory(start_address, data, memory_id)
+    if compress and not in_ram:
+        raise McuBootGenericError('Compressed write only supports RAM, the flash is programmed by the bootloader.')
+    if compress:    # decompressed by a routine uploaded to RAM
+        mb.write_compressed(None, image)
+    elif delta:   # only the changed sectors are erased and written
+        mb.write_delta(None, image, memory_id, spot_check)
+    else:
+        # Only the sectors touched by the segments are erased, the gaps are not sent
+        mb.write_image(image, memory_id, do_erase, chunk_size=chunk_size)
+    if verify:
+        start = time.perf_counter()
+        if verify == 'crc' and not memory_id:
+            length = mb.verify_crc(None, image)
+        else:
+            length = mb.verify_memory(None, image, memory_id)
+        print(' Verify Successfully, {}/s.'.format(size_fmt(length / max(time.perf_counter() - start, 1e-6))))
 
-def read(mb, address, length, filename=None, memory_id=0, compress=False, exconf=None):
+def read(mb, address, length, filename=None, memory_id=0, compress=False, exconf=None, resume=False):
     mb.get_memory_range()
     block = MemoryBlock(address, None, length)
     if memory_id:
@@ -110,8 +127,12 @@ def read(mb, address, length, filename=None, memory_id=0, compress=False, exconf
     else:
         if not (mb.is_in_flash(block) or mb.is_in_memory(block)):
             raise McuBootGenericError('MemoryRangeInvalid, please check the address range.')
-    data = mb.read_memory(address, length, filename, memory_id)
-    print('\n', hexdump(data, address, compress))
+    if filename:    # Read chunk by chunk into the file, the data is not dumped
+        mb.read_memory_to_file(address, length, filename, memory_id, resume=resume)
+        print(' Saved into {}.'.format(filename))
+    else:
+        data = mb.read_memory(address, length, None, memory_id)
+        print('\n', hexdump(data, address, compress))
 
 # def handle_exception(func):
 #     def decorate(func):
@@ -123,10 +144,10 @@ def read(mb, address, length, filename=None, memory_id=0, compress=False, exconf
 def fill(mb, address, byte_count, pattern, unit, no_erase=False):
     do_erase = not no_erase
     mb.get_memory_range()
-    block = MemoryBlock(address, None, byte_count*8)
+    block = MemoryBlock(address, None, byte_count)
     if mb.is_in_flash(block):
-        if do_erase:
-            mb.flash_erase_region(block.start, block.length)
+        if do_erase:    # the sectors of the block
+            mb.flash_erase_blocks([block])
     elif mb.is_in_memory(block):
         pass
     else:
@@ -429,15 +450,30 @@ def main():
     group.add_argument('-p', '--uart', nargs='*', help='Use uart peripheral, '
         'such as "-p PORT SPEED", "-p PORT", "-p SPEED", "-p"', metavar=('port', 'speed'))
     group.add_argument('-s', '--spi', nargs='*', help='Use spi peripheral, '
-        'such as "-s VIDPID SPEED", "-s VIDPID", "-s SPEED", "-s"', metavar=('vid,pid', 'speed'))
+        'such as "-s VIDPID SPEED", "-s VIDPID", "-s SPEED", "-s", SPEED can be "auto" to use the calibrated speed', metavar=('vid,pid', 'speed'))
     group.add_argument('-i', '--i2c', nargs='*', help='Use i2c peripheral, '
-        'such as "-i VIDPID SPEED", "-i VIDPID", "-i SPEED", "-i"', metavar=('vid,pid', 'speed'))
+        'such as "-i VIDPID SPEED", "-i VIDPID", "-i SPEED", "-i", SPEED can be "auto" to use the calibrated speed', metavar=('vid,pid', 'speed'))
     parser.add_argument('--select_device', help='When inserting two devices with the same vid, pid, '
         'manually select the device, so that the device selection prompt will not pop up. '
         'For "usb" devices, its value should be the device id under windows, and a pair of values ​​like "BUS, ADDRESS" under linux. ')
     parser.add_argument('--ftdi_index', type=check_int, help='When inserting multiple SPI, I2C devices with the same vid, pid,'
         'its value should be the value of the device path/locate in the order in which they are arranged by the port.')
 
+    parser.add_argument('--ftdi_interface', type=check_int, default=1, help='FTDI interface (channel) used by SPI, I2C, starting from 1, '
+        'MPSSE is available on interface 1, 2 of FT2232H, FT4232H.')
+
+    parser.add_argument('--spi_cs', type=check_int, default=0, help='Chip select of the SPI target.')
+    parser.add_argument('--i2c_address', type=check_int, default=0x10, help='I2C address of the target.')
+
+    parser.add_argument('--irq_pin', nargs=3, type=check_int, help='Enable the IRQ notifier pin of the target, only for SPI, I2C, '
+        'the host waits on the FTDI GPIO instead of polling the bus.', metavar=('port', 'pin', 'ftdi_pin'))
+
+    parser.add_argument('--profile', action='store_true', help='Load the properties of the device saved by the last session, '
+        'only the device identity is read from the target, the properties read in this session are saved at exit.')
+    parser.add_argument('--no_cache', action='store_true', help='Read every property from the target, '
+        'by default the static properties (memory range, max packet size, available commands...) are read only once per session.')
+    parser.add_argument('--retries', type=check_int, default=3, help='Count of attempts of a command or data transfer '
+        'failed by a transient error (timeout, CRC, bus overrun...), 1 to disable the retry.')
     parser.add_argument('-t', '--timeout', type=int, help='Maximum wait time(Unit: s) for the change of the transceiver status in a single atomic operation, '
         'it is only valid for the "flash-erase-*" command and only changes the timeout of the ack after sending the packet, '
         'which is invalid for the timeout in read phase.')
@@ -460,12 +496,20 @@ def main():
 
     parser_write = subparsers.add_parser('write', help='Write data into MCU memory', formatter_class=MBootSubHelpFormatter, add_help=False)
     parser_write.add_argument('address', type=check_int, nargs='?', help='Start address, '
-        'the arg can be omitted if file end with ".srec", ".s19", ".hex", ".ihex" that contains the address')
+        'the arg can be omitted if file end with ".srec", ".s19", ".hex", ".ihex", ".elf", ".axf", ".out" that contains the address')
     parser_write.add_argument('filename', help='File to be written')
     parser_write.add_argument('memory_id', nargs='?', type=check_int, default=0, choices=(0, 0x1, 0x8, 0x9, 0x0a, 0x010, 0x100, 0x101, 0x110, 0x111, 0x120, 0x121), 
         help='External memory id', metavar='memory_id')
     parser_write.add_argument('-o', '--offset', type=check_int, default=0, help='File offset address')
     parser_write.add_argument('--no_erase', action='store_true', help='Do not automatically erase before writing.')
+    parser_write.add_argument('--delta', action='store_true', help='Only erase and write the flash sectors changed since the last delta write.')
+    parser_write.add_argument('--spot_check', type=check_int, default=0, help='Count of unchanged sectors read back to check in delta write')
+    parser_write.add_argument('--verify', nargs='?', const='read', choices=('read', 'crc'), help='Compare after writing, '
+        '"read" reads the data back, "crc" compares the CRC of every sector computed by a routine uploaded to RAM.')
+    parser_write.add_argument('--compress', action='store_true', help='Send the data to RAM compressed, it is '
+        'decompressed by a routine uploaded to RAM.')
+    parser_write.add_argument('--chunk_size', type=check_int, default=0, help='Write by chunks of the size and resume '
+        'from the last written chunk when the same file is written again after a failure, 0 to write all at once')
     parser_write.add_argument('-e', '--exconf', nargs='*', type=check_int, help='Set external memory address and settings, '
         'such as "fill_config_address config_word1 [config_word2 [...]]", only the first time you need to set')
     parser_write.add_argument('-h', '--help', action='help', default=argparse.SUPPRESS, help='Show this help message and exit.')
@@ -477,6 +521,7 @@ def main():
     parser_read.add_argument('memory_id', nargs='?', type=check_int, action=FixArgValue, check_arg='filename', default=0, 
         choices=(0, 0x1, 0x8, 0x9, 0x0a, 0x010, 0x100, 0x101, 0x110, 0x111, 0x120, 0x121), help='External memory id', metavar='memory_id')
     parser_read.add_argument('-c', '--compress', action='store_true', help='Compress dump output.')
+    parser_read.add_argument('--resume', action='store_true', help='Continue the binary file written by an interrupted read.')
     parser_read.add_argument('-e', '--exconf', nargs='*', type=check_int, help='Set external memory address and settings, '
         'such as "fill_config_address config_word1 [config_word2 [...]]", only the first time you need to set')
     parser_read.add_argument('-h', '--help', action='help', default=argparse.SUPPRESS, help='Show this help message and exit.')
@@ -504,6 +549,12 @@ def main():
     parser_unlock.add_argument('-k', '--key', type=check_key, help='Use backdoor key as ASCI = S:123...8 or HEX = X:010203...08')
     parser_unlock.add_argument('-h', '--help', action='help', default=argparse.SUPPRESS, help='Show this help message and exit.')
 
+    parser_calibrate = subparsers.add_parser('calibrate', help='Find and record the fastest reliable SPI, I2C speed', formatter_class=MBootSubHelpFormatter, add_help=False)
+    parser_calibrate.add_argument('address', nargs='?', type=check_int, help='Address read during calibration, (default: start address of the flash)')
+    parser_calibrate.add_argument('length', nargs='?', type=check_int, default=0x100, help='Read data length')
+    parser_calibrate.add_argument('-r', '--rounds', type=check_int, default=3, help='Count of round trips at each speed step')
+    parser_calibrate.add_argument('-h', '--help', action='help', default=argparse.SUPPRESS, help='Show this help message and exit.')
+
     parser_reset = subparsers.add_parser('reset', help='Reset MCU', formatter_class=MBootSubHelpFormatter, add_help=False)
     parser_reset.add_argument('-h', '--help', action='help', default=argparse.SUPPRESS, help='Show this help message and exit.')
 
@@ -517,6 +568,8 @@ def main():
 
     mb = mboot.McuBoot()
     mb.cli_mode = True  # this is cli mode
+    mb.cache_properties = not cmd.no_cache
+    mb.retry = RetryPolicy(cmd.retries)
 
     # Added the feature to display the original interface help
     if cmd.origin and ('-h' in cmd.origin or '--help' in cmd.origin):
@@ -543,26 +596,39 @@ def main():
     elif cmd.spi is not None:
         if cmd.ftdi_index:
             vid_pid, speed = parse_peripheral(Interface.SPI.name, cmd.spi, False)
-            mb.open_spi(vid_pid, cmd.ftdi_index, speed, 0)
+            mb.open_spi(vid_pid, cmd.ftdi_index, speed, 0, cmd.ftdi_interface, cmd.spi_cs)
         else:
             config, speed = parse_peripheral(Interface.SPI.name, cmd.spi)
             vid_pid = config[0:2]
             index = config[-1]
-            mb.open_spi(vid_pid, index, freq=speed, mode=0)
+            mb.open_spi(vid_pid, index, freq=speed, mode=0, interface=cmd.ftdi_interface, cs=cmd.spi_cs)
     elif cmd.i2c is not None:
         if cmd.ftdi_index:
             vid_pid, speed = parse_peripheral(Interface.I2C.name, cmd.i2c, False)
-            mb.open_i2c(vid_pid, cmd.ftdi_index, speed)
+            mb.open_i2c(vid_pid, cmd.ftdi_index, speed, cmd.ftdi_interface, cmd.i2c_address)
         else:
             config, speed = parse_peripheral(Interface.I2C.name, cmd.i2c)
             vid_pid = config[0:2]
             index = config[-1]
-            mb.open_i2c(vid_pid, index, freq=speed)
+            mb.open_i2c(vid_pid, index, freq=speed, interface=cmd.ftdi_interface, slave_address=cmd.i2c_address)
     else:
         raise McuBootGenericError('You need to choose a peripheral for communication.')
 
+    if cmd.irq_pin:
+        mb.enable_irq_notifier(*cmd.irq_pin)
+
+    if cmd.profile:
+        mb.load_profile()
+
     # mb.get_memory_range()
 
+    if cmd.calibrate:
+        args = cmd.calibrate
+        if getattr(args, '_unrecognized_args', None):
+            raise McuBootGenericError('invalid arguments:{}'.format(args._unrecognized_args))
+        speed = mb.calibrate_speed(args.address, args.length, args.rounds)
+        print(' Calibrated speed: {} Hz'.format(speed))
+
     if cmd.info:
         args = cmd.info
         if getattr(args, '_unrecognized_args', None):
@@ -573,14 +639,15 @@ def main():
         args = cmd.write
         if getattr(args, '_unrecognized_args', None):
             raise McuBootGenericError('invalid arguments:{}'.format(args._unrecognized_args))
-        write(mb, args.address, args.filename, args.memory_id, args.offset, args.no_erase, args.exconf)
+        write(mb, args.address, args.filename, args.memory_id, args.offset, args.no_erase, args.exconf,
+              args.delta, args.spot_check, args.verify, args.chunk_size, args.compress)
         print(" Write Successfully.")
 
     if cmd.read:
         args = cmd.read
         if getattr(args, '_unrecognized_args', None):
             raise McuBootGenericError('invalid arguments:{}'.format(args._unrecognized_args))
-        read(mb, args.address, args.length, args.filename, args.memory_id, args.compress, args.exconf)
+        read(mb, args.address, args.length, args.filename, args.memory_id, args.compress, args.exconf, args.resume)
 
     if cmd.fill:
         args = cmd.fill
@@ -627,11 +694,13 @@ def main():
                 else:
                     args = convert_arg_to_int(cmd_args)
                 data = func(*args)
-                if attr == 'read_memory':
+                if attr == 'read_memory' and not isinstance(data, int):
                     print('\n', hexdump(data, args[0], False))
             else:
                 raise McuBootGenericError('invalid arguments:{}'.format(cmd_args))
         else:
             raise McuBootGenericError('invalid command:{}'.format(cmd.origin[0]))
 
+    if cmd.profile:
+        mb.save_profile()
     mb.close()
@@ -52,4 +52,8 @@ class McuBootConnectionError(McuBootGenericError):
 
 
 class McuBootTimeOutError(McuBootGenericError):
-    _fmt = 'KBoot timeout error'
\ No newline at end of file
+    _fmt = 'KBoot timeout error'
+
+
+class McuBootVerifyError(McuBootGenericError):
+    _fmt = 'Verify failed at 0x%(address)08X -> read 0x%(read)02X, expected 0x%(expected)02X'
@@ -1,4 +1,5 @@
 from sys import platform
+import time
 import threading
 
 import usb.core
@@ -12,14 +13,160 @@ class SpiController(SpiController):
     def __init__(self, silent_clock=False, cs_count=4, turbo=True):
         super(SpiController, self).__init__(silent_clock, cs_count, turbo)
         self._ftdi = Ftdi()
+        # Count of the interfaces sharing the controller, see ControllerPool
+        self.users = 0
 
 class I2cController(I2cController):
+    """The I2C transactions are serialized by a lock, so that several targets on the bus can be used
+    from different threads, like SpiController does for the SPI exchanges."""
     def __init__(self):
         super(I2cController, self).__init__()
         self._ftdi = Ftdi()
+        self._gpio_port = None
+        self._lock = threading.RLock()
+        # Count of the interfaces sharing the controller, see ControllerPool
+        self.users = 0
+
+    def read(self, *args, **kwargs):
+        with self._lock:
+            return super(I2cController, self).read(*args, **kwargs)
+
+    def write(self, *args, **kwargs):
+        with self._lock:
+            return super(I2cController, self).write(*args, **kwargs)
+
+    def exchange(self, *args, **kwargs):
+        with self._lock:
+            return super(I2cController, self).exchange(*args, **kwargs)
+
+    def poll(self, *args, **kwargs):
+        with self._lock:
+            return super(I2cController, self).poll(*args, **kwargs)
+
+    def poll_cond(self, *args, **kwargs):
+        with self._lock:
+            return super(I2cController, self).poll_cond(*args, **kwargs)
+
+    def get_gpio(self):
+        """Retrieve the GPIO port, I2C uses pins b0-b2, so the lowest available pin is b3."""
+        if not self._gpio_port:
+            self._gpio_port = I2cGpioPort(self)
+        return self._gpio_port
+
+    def read_gpio(self):
+        """Read the low byte of the MPSSE port
+        :return: the GPIO pins as a bitfield
+        """
+        with self._lock:
+            self._ftdi.write_data(bytes((Ftdi.GET_BITS_LOW, Ftdi.SEND_IMMEDIATE)))
+            data = self._ftdi.read_data_bytes(1, 4)
+        if not data:
+            raise IOError('Unable to read GPIO')
+        return data[0]
+
+class ControllerPool(object):
+    """Share the MPSSE controllers between the interfaces addressing several targets on the same bus,
+    by SPI chip select or I2C address. An FTDI interface can only be claimed once, so the second target
+    on the bus gets the controller configured for the first one.
+    """
+    Lock = threading.Lock()
+    # url -> controller
+    Controllers = {}
+
+    @classmethod
+    def acquire(cls, url, factory):
+        """Get the controller configured for the url
+        :param str url: pyftdi URL of the FTDI interface
+        :param factory: Callable that creates and configures the controller when the url is not used yet
+        :return: the controller
+        """
+        with cls.Lock:
+            controller = cls.Controllers.get(url)
+            if controller is None:
+                controller = factory()
+                cls.Controllers[url] = controller
+            controller.users += 1
+            return controller
+
+    @classmethod
+    def release(cls, controller):
+        """Release the controller, it is terminated when the last user releases it"""
+        with cls.Lock:
+            controller.users -= 1
+            if controller.users > 0:
+                return
+            for url, value in list(cls.Controllers.items()):
+                if value is controller:
+                    del cls.Controllers[url]
+        controller.terminate()
+
+class I2cGpioPort(object):
+    """Minimal input-only GPIO port of the I2C controller, the interface is compatible with SpiGpioPort"""
+    def __init__(self, controller):
+        self._controller = controller
+        self._mask = 0
+
+    def read(self):
+        return self._controller.read_gpio() & self._mask
+
+    def set_direction(self, pins, direction):
+        if pins & 0x07:
+            raise IOError('Cannot access I2C pins as GPIO')
+        if pins & direction:
+            raise IOError('I2C GPIO port only supports input pins')
+        self._mask = pins
+
+class IrqNotifier(object):
+    """Wait for the bootloader IRQ notifier pin through a FTDI GPIO instead of polling the bus.
+    The target asserts the pin when it has a packet ready to send.
+    :param gpio: GPIO port of the controller, see SpiController.get_gpio() or I2cController.get_gpio()
+    :param int pin: FTDI GPIO pin number connected to the notifier pin of the target
+    :param bool active_low: The target pulls the pin low when the packet is ready
+    :param float interval: Sleep time (Unit: s) between two samples of the pin
+    """
+    def __init__(self, gpio, pin, active_low=True, interval=0.0002):
+        self.gpio = gpio
+        self.mask = 1 << pin
+        self.active_low = active_low
+        self.interval = interval
+        self.gpio.set_direction(self.mask, 0)
+
+    def is_asserted(self):
+        level = self.gpio.read() & self.mask
+        return not level if self.active_low else bool(level)
+
+    def wait(self, timeout=1):
+        """Wait until the pin is asserted
+        :param timeout: timeout (Unit: s)
+        :return: False if timed out
+        """
+        start_time = time.perf_counter()
+        while not self.is_asserted():
+            if time.perf_counter() - start_time >= timeout:
+                return False
+            time.sleep(self.interval)
+        return True
 
 class UsbTools(pyftdi.usbtools.UsbTools):
-    """Helpers to obtain information about connected USB devices."""
+    """Helpers to obtain information about connected USB devices.
+
+       The libusb backend is selected once per process. The bus is enumerated
+       once per scan for all the requested vendor/product pairs, and the
+       devices with their string descriptors are cached. The cache is refreshed
+       when a device is plugged or unplugged (the bus snapshot changes) or when
+       it is older than CACHE_TTL seconds.
+    """
+    # Seconds before the cached string descriptors are read again
+    CACHE_TTL = 30
+    Backend = None
+    # (bus, address, vid, pid) of every device seen by the last enumeration
+    BusSnapshot = None
+    # (bus, address, vid, pid) -> usb.core.Device
+    BusDevices = {}
+    # (bus, address, string index) -> str
+    Strings = {}
+    ScanTime = 0
+
     @staticmethod
     def find_all(vps, nocache=False):
         """Find all devices that match the specified vendor/product pairs.
@@ -32,10 +179,7 @@ class UsbTools(pyftdi.usbtools.UsbTools):
                     device descriptors
            :rtype: list(tuple(int,int,str,int,str))
         """
-        devs = []
-        for v, p in vps:
-            devs.extend(UsbTools._find_devices(v, p, nocache))
-        # print(devs)
+        devs = UsbTools._scan(vps, nocache)
         devices = []
         for dev in devs:
             ifcount = max([cfg.bNumInterfaces for cfg in dev])
@@ -45,90 +189,130 @@ class UsbTools(pyftdi.usbtools.UsbTools):
                          description))
         return devices
 
+    @classmethod
+    def flush_cache(cls):
+        """Flush the FTDI device cache, the next scan enumerates the bus again"""
+        with cls.Lock:
+            cls.UsbDevices = {}
+            cls.BusSnapshot = None
+            cls.BusDevices = {}
+            cls.Strings = {}
+
+    @classmethod
+    def get_backend(cls):
+        """Probe the libusb backend candidates only once"""
+        with cls.Lock:
+            if cls.Backend is None:
+                candidates = ('libusb1', 'libusb10', 'libusb0', 'libusb01',
+                              'openusb')
+                um = __import__('usb.backend', globals(), locals(),
+                                candidates, 0)
+                for c in candidates:
+                    try:
+                        m = getattr(um, c)
+                    except AttributeError:
+                        continue
+                    backend = m.get_backend()
+                    if backend is not None:
+                        cls.Backend = backend
+                        break
+                else:
+                    raise ValueError('No backend available')
+            return cls.Backend
+
+    @classmethod
+    def get_string(cls, device, strname):
+        """Retrieve a string from the USB device, the result is cached until the device is unplugged"""
+        key = (device.bus, device.address, strname)
+        with cls.Lock:
+            if key not in cls.Strings:
+                cls.Strings[key] = super(UsbTools, cls).get_string(device, strname)
+            return cls.Strings[key]
+
+    @classmethod
+    def _enumerate(cls, nocache=False):
+        """Enumerate the bus and refresh the cache if the bus has changed
+           :return: dict of (bus, address, vid, pid) -> usb.core.Device
+        """
+        backend = cls.get_backend()
+        expired = time.monotonic() - cls.ScanTime > cls.CACHE_TTL
+        devices = {}
+        for dev in backend.enumerate_devices():
+            device = usb.core.Device(dev, backend)
+            devices[(device.bus, device.address, device.idVendor, device.idProduct)] = device
+        snapshot = frozenset(devices)
+        if nocache or expired or snapshot != cls.BusSnapshot:
+            if nocache or expired:
+                cls.BusDevices = {}
+                cls.Strings = {}
+            # Keep the known devices, so that their string descriptors are not read again
+            cls.BusDevices = {k: cls.BusDevices.get(k, v) for k, v in devices.items()}
+            alive = set((k[0], k[1]) for k in snapshot)
+            cls.Strings = {k: v for k, v in cls.Strings.items() if (k[0], k[1]) in alive}
+            cls.UsbDevices = {}
+            cls.BusSnapshot = snapshot
+            if nocache or expired:
+                cls.ScanTime = time.monotonic()
+        return cls.BusDevices
+
+    @classmethod
+    def _scan(cls, vps, nocache=False):
+        """Enumerate the bus once and find the devices matching any of the vendor/product pairs
+           :param vps: a sequence of 2-tuple (vid, pid) pairs, pid can be None
+           :return: a list of USB device sorted by (vid, pid, serial, bus, address)
+        """
+        with cls.Lock:
+            bus_devices = cls._enumerate(nocache)
+            vpdict = {}
+            for vendor, product in vps:
+                vpdict.setdefault(vendor, set())
+                if product:
+                    vpdict[vendor].add(product)
+            # ugly kludge for a boring OS:
+            # on Windows, the USB stack may enumerate the very same
+            # devices several times: a real device with N interface
+            # appears also as N device with as single interface.
+            # We only keep the "device" that declares the most
+            # interface count and discard the "virtual" ones.
+            filtered_devs = dict()
+            for (bus, address, vid, pid), dev in bus_devices.items():
+                if vid not in vpdict:
+                    continue
+                products = vpdict[vid]
+                if products and (pid not in products):
+                    continue
+                ifc = max([cfg.bNumInterfaces for cfg in dev])
+                sn = cls.get_string(dev, dev.iSerialNumber) or ''
+                k = (vid, pid, sn, bus, address)
+                if k not in filtered_devs:
+                    filtered_devs[k] = dev
+                else:
+                    fdev = filtered_devs[k]
+                    fifc = max([cfg.bNumInterfaces for cfg in fdev])
+                    if fifc < ifc:
+                        filtered_devs[k] = dev
+            return [filtered_devs[k] for k in sorted(filtered_devs.keys())]
+
     @classmethod
     def _find_devices(cls, vendor, product, nocache=False):
         """Find a USB device and return it.
 
-           This code re-implements the usb.core.find() method using a local
-           cache to avoid calling several times the underlying LibUSB and the
-           system USB calls to enumerate the available USB devices. As these
-           calls are time-hungry (about 1 second/call), the enumerated devices
-           are cached. It consumes a bit more memory but dramatically improves
-           start-up time.
-           Hopefully, this kludge is temporary and replaced with a better
-           implementation from PyUSB at some point.
+           The devices are taken from the process-wide discovery cache, see
+           UsbTools._scan().
 
            :param int vendor: USB vendor id
            :param int product: USB product id
            :param bool nocache: bypass cache to re-enumerate USB devices on
                                 the host
-           :return: a set of USB device matching the vendor/product identifier
+           :return: a list of USB device matching the vendor/product identifier
                     pair
-           :rtype: set(usb.core.Device)
-
+           :rtype: list(usb.core.Device)
         """
-        cls.Lock.acquire()
-        try:
-            backend = None
-            candidates = ('libusb1', 'libusb10', 'libusb0', 'libusb01',
-                          'openusb')
-            um = __import__('usb.backend', globals(), locals(),
-                            candidates, 0)
-            for c in candidates:
-                try:
-                    m = getattr(um, c)
-                except AttributeError:
-                    continue
-                backend = m.get_backend()
-                if backend is not None:
-                    break
-            else:
-                raise ValueError('No backend available')
+        with cls.Lock:
             vp = (vendor, product)
             if nocache or (vp not in cls.UsbDevices):
-                # not freed until Python runtime completion
-                # enumerate_devices returns a generator, so back up the
-                # generated device into a list. To save memory, we only
-                # back up the supported devices
-                devs = set()
-                vpdict = {}
-                vpdict.setdefault(vendor, [])
-                vpdict[vendor].append(product)
-                for dev in backend.enumerate_devices():
-                    device = usb.core.Device(dev, backend)
-                    if device.idVendor in vpdict:
-                        products = vpdict[device.idVendor]
-                        if products and (device.idProduct not in products):
-                            continue
-                        devs.add(device)
-                # if platform == 'win32':
-                    # ugly kludge for a boring OS:
-                    # on Windows, the USB stack may enumerate the very same
-                    # devices several times: a real device with N interface
-                    # appears also as N device with as single interface.
-                    # We only keep the "device" that declares the most
-                    # interface count and discard the "virtual" ones.
-                filtered_devs = dict()
-                for dev in devs:
-                    vid = dev.idVendor
-                    pid = dev.idProduct
-                    ifc = max([cfg.bNumInterfaces for cfg in dev])
-                    sn = UsbTools.get_string(dev, dev.iSerialNumber)
-                    k = (vid, pid, sn, dev.bus, dev.address)
-                    if k not in filtered_devs:
-                        filtered_devs[k] = dev
-                    else:
-                        fdev = filtered_devs[k]
-                        fifc = max([cfg.bNumInterfaces for cfg in fdev])
-                        if fifc < ifc:
-                            filtered_devs[k] = dev
-                devs = [filtered_devs[k] for k in sorted(filtered_devs.keys())]
-                # devs = list(filtered_devs.values())
-                    
-                cls.UsbDevices[vp] = devs
+                cls.UsbDevices[vp] = cls._scan([vp], nocache)
             return cls.UsbDevices[vp]
-        finally:
-            cls.Lock.release()
 
 # Monkey patch
 pyftdi.usbtools.UsbTools = UsbTools
@@ -0,0 +1,221 @@
+import zlib
+import struct
+
+try:
+    import lz4.block    # Optional, compresses faster and better than lz4_compress()
+except ImportError:
+    lz4 = None
+
+# Routines run by the target to speed up the bootloader operations, they are uploaded to RAM by write_memory()
+# and called by call(). The code is Thumb for Cortex-M0 and later and position-independent.
+
+# CRC-32 (the same as zlib.crc32) of the blocks of a memory range, bit by bit without a table.
+# r0 points to the parameters: start address, length and block size, the CRC of every block is stored after them.
+CRC32_CODE = struct.pack('<32HI',
+    0xB5F0,     # 00        push    {r4-r7, lr}
+    0x6801,     # 02        ldr     r1, [r0, #0]        ; address
+    0x6842,     # 04        ldr     r2, [r0, #4]        ; remaining length
+    0x6883,     # 06        ldr     r3, [r0, #8]        ; block size
+    0x300C,     # 08        adds    r0, #12             ; results
+    0x4E0D,     # 0A        ldr     r6, [pc, #52]       ; polynomial
+    0x2A00,     # 0C block: cmp     r2, #0
+    0xD014,     # 0E        beq     done
+    0x2400,     # 10        movs    r4, #0
+    0x43E4,     # 12        mvns    r4, r4              ; crc = 0xFFFFFFFF
+    0x1C1D,     # 14        adds    r5, r3, #0          ; count = min(block size, remaining)
+    0x4295,     # 16        cmp     r5, r2
+    0xD900,     # 18        bls     byte
+    0x1C15,     # 1A        adds    r5, r2, #0
+    0x780F,     # 1C byte:  ldrb    r7, [r1]
+    0x3101,     # 1E        adds    r1, #1
+    0x407C,     # 20        eors    r4, r7
+    0x2708,     # 22        movs    r7, #8
+    0x0864,     # 24 bit:   lsrs    r4, r4, #1
+    0xD300,     # 26        bcc     next
+    0x4074,     # 28        eors    r4, r6
+    0x3F01,     # 2A next:  subs    r7, #1
+    0xD1FA,     # 2C        bne     bit
+    0x3A01,     # 2E        subs    r2, #1
+    0x3D01,     # 30        subs    r5, #1
+    0xD1F3,     # 32        bne     byte
+    0x43E4,     # 34        mvns    r4, r4
+    0xC010,     # 36        stmia   r0!, {r4}
+    0xE7E8,     # 38        b       block
+    0x2000,     # 3A done:  movs    r0, #0              ; kStatus_Success
+    0xBDF0,     # 3C        pop     {r4-r7, pc}
+    0x46C0,     # 3E        nop
+    0xEDB88320  # 40        .word   0xEDB88320
+)
+CRC32_PARAMS = struct.Struct('<3I')
+
+# RAM taken by the helper: the code, the parameters and the results
+HELPER_AREA_SIZE = 0x400
+
+def crc32_blocks(data, block_size):
+    """ CRC-32 of every block of the data, as computed by CRC32_CODE
+    :param data: List of bytes
+    :param block_size: Count of bytes per CRC, the last block may be shorter
+    :return List of CRC
+    """
+    data = memoryview(data)
+    return [zlib.crc32(data[offset:offset + block_size]) & 0xFFFFFFFF for offset in range(0, len(data), block_size)]
+
+# LZ4 block decompressor, the decompressed data is written byte by byte so it works for any RAM.
+# r0 points to the parameters: source address, source length and destination address, the count of
+# decompressed bytes is stored after them.
+LZ4_CODE = struct.pack('<54H',
+    0xB5F0,     # 00        push    {r4-r7, lr}
+    0x6801,     # 02        ldr     r1, [r0, #0]        ; src
+    0x6842,     # 04        ldr     r2, [r0, #4]
+    0x1852,     # 06        adds    r2, r2, r1          ; src end
+    0x6883,     # 08        ldr     r3, [r0, #8]        ; dst
+    0x780C,     # 0A seq:   ldrb    r4, [r1]            ; token
+    0x3101,     # 0C        adds    r1, #1
+    0x0925,     # 0E        lsrs    r5, r4, #4          ; literal length
+    0x2D0F,     # 10        cmp     r5, #15
+    0xD104,     # 12        bne     lit
+    0x780E,     # 14 lext:  ldrb    r6, [r1]
+    0x3101,     # 16        adds    r1, #1
+    0x19AD,     # 18        adds    r5, r5, r6
+    0x2EFF,     # 1A        cmp     r6, #255
+    0xD0FA,     # 1C        beq     lext
+    0x2D00,     # 1E lit:   cmp     r5, #0
+    0xD005,     # 20        beq     offset
+    0x780E,     # 22 lcopy: ldrb    r6, [r1]
+    0x3101,     # 24        adds    r1, #1
+    0x701E,     # 26        strb    r6, [r3]
+    0x3301,     # 28        adds    r3, #1
+    0x3D01,     # 2A        subs    r5, #1
+    0xD1F9,     # 2C        bne     lcopy
+    0x4291,     # 2E offset: cmp    r1, r2              ; the last sequence has no match
+    0xD216,     # 30        bcs     done
+    0x780E,     # 32        ldrb    r6, [r1]
+    0x784F,     # 34        ldrb    r7, [r1, #1]
+    0x023F,     # 36        lsls    r7, r7, #8
+    0x433E,     # 38        orrs    r6, r7
+    0x3102,     # 3A        adds    r1, #2
+    0x1B9F,     # 3C        subs    r7, r3, r6          ; match
+    0x250F,     # 3E        movs    r5, #15
+    0x4025,     # 40        ands    r5, r4              ; match length
+    0x2D0F,     # 42        cmp     r5, #15
+    0xD104,     # 44        bne     match
+    0x780E,     # 46 mext:  ldrb    r6, [r1]
+    0x3101,     # 48        adds    r1, #1
+    0x19AD,     # 4A        adds    r5, r5, r6
+    0x2EFF,     # 4C        cmp     r6, #255
+    0xD0FA,     # 4E        beq     mext
+    0x3504,     # 50 match: adds    r5, #4
+    0x783E,     # 52 mcopy: ldrb    r6, [r7]
+    0x3701,     # 54        adds    r7, #1
+    0x701E,     # 56        strb    r6, [r3]
+    0x3301,     # 58        adds    r3, #1
+    0x3D01,     # 5A        subs    r5, #1
+    0xD1F9,     # 5C        bne     mcopy
+    0xE7D4,     # 5E        b       seq
+    0x6886,     # 60 done:  ldr     r6, [r0, #8]
+    0x1B9B,     # 62        subs    r3, r3, r6
+    0x60C3,     # 64        str     r3, [r0, #12]       ; count of decompressed bytes
+    0x2000,     # 66        movs    r0, #0              ; kStatus_Success
+    0xBDF0,     # 68        pop     {r4-r7, pc}
+    0x46C0      # 6A        nop
+)
+LZ4_PARAMS = struct.Struct('<4I')
+
+def _lz4_length(out, length):
+    while length >= 255:
+        out.append(255)
+        length -= 255
+    out.append(length)
+
+def _lz4_sequence(out, literals, offset=None, length=0):
+    match = length - 4
+    out.append(min(len(literals), 15) << 4 | (min(match, 15) if offset else 0))
+    if len(literals) >= 15:
+        _lz4_length(out, len(literals) - 15)
+    out += literals
+    if offset:
+        out += struct.pack('<H', offset)
+        if match >= 15:
+            _lz4_length(out, match - 15)
+
+def lz4_compress(data):
+    """ Compress the data into a LZ4 block (without the size), by lz4.block if it is installed
+    :param data: List of bytes
+    :return Compressed bytes
+    """
+    data = bytes(data)
+    if lz4 is not None:
+        return lz4.block.compress(data, mode='high_compression', store_size=False)
+    # Greedy search of the last position of every 4 bytes, the end of the block is kept as literals as required
+    # by the format: the last match starts 12 bytes before the end at least and ends 5 bytes before it
+    out = bytearray()
+    positions = {}
+    anchor = pos = 0
+    limit = len(data) - 5
+    while pos < len(data) - 12:
+        ref = positions.get(data[pos:pos + 4])
+        positions[data[pos:pos + 4]] = pos
+        if ref is None or pos - ref > 0xFFFF or data[ref:ref + 4] != data[pos:pos + 4]:
+            pos += 1
+            continue
+        length = 4
+        while pos + length < limit:
+            step = min(64, limit - pos - length)
+            if data[ref + length:ref + length + step] == data[pos + length:pos + length + step]:
+                length += step
+                continue
+            while data[ref + length] == data[pos + length]:
+                length += 1
+            break
+        _lz4_sequence(out, data[anchor:pos], pos - ref, length)
+        pos = anchor = pos + length
+    _lz4_sequence(out, data[anchor:])
+    return bytes(out)
+
+def lz4_decompress(data):
+    """ Decompress the LZ4 block as LZ4_CODE does on the target
+    :param data: Compressed bytes
+    :return Decompressed bytes
+    """
+    out = bytearray()
+    pos = 0
+    while True:
+        token = data[pos]
+        pos += 1
+        length = token >> 4
+        if length == 15:
+            while True:
+                length += data[pos]
+                pos += 1
+                if data[pos - 1] != 255:
+                    break
+        out += data[pos:pos + length]
+        pos += length
+        if pos >= len(data):
+            return bytes(out)
+        offset = data[pos] | data[pos + 1] << 8
+        pos += 2
+        length = token & 15
+        if length == 15:
+            while True:
+                length += data[pos]
+                pos += 1
+                if data[pos - 1] != 255:
+                    break
+        for _ in range(length + 4):     # The match may overlap the bytes it makes
+            out.append(out[-offset])
+
+def plan_compressed(data, buffer_size):
+    """ Split the data into the chunks whose LZ4 block fits into the buffer of the target
+    :param data: List of bytes
+    :param buffer_size: Size of the staging buffer of the compressed data
+    :return List of (offset, length, compressed), compressed is None for the chunk which should be sent as it is
+    """
+    # The worst case of LZ4 is a little above the input, such a chunk always fits
+    chunk_size = buffer_size - buffer_size // 255 - 16
+    plan = []
+    for offset in range(0, len(data), chunk_size):
+        chunk = data[offset:offset + chunk_size]
+        compressed = lz4_compress(chunk)
+        plan.append((offset, len(chunk), compressed if len(compressed) < len(chunk) else None))
+    return plan
@@ -4,48 +4,81 @@ import logging
 
 from .tool import atos
 from .protocol import FPType, UartProtocolMixin
-from .exception import McuBootDataError, McuBootTimeOutError
+from .exception import McuBootGenericError, McuBootDataError, McuBootTimeOutError
 from .enums import StatusCode
-from .ftditool import I2cController
+from .ftditool import I2cController, IrqNotifier, ControllerPool
 
 class I2C(UartProtocolMixin):
+    # Pause between the polls of the start byte when the bus is shared, so that the other targets can use it
+    POLL_INTERVAL = 0.0005
+
     def __init__(self, freq):
         self.freq = int(freq, 0) if isinstance(freq, str) else freq
         self.controller = None
         self.slave = None
+        self.irq = None
+        self.url = None
+        self.slave_address = None
 
-    def open(self, vid=None, pid=None, index=1, slave_address=0x10):
-        """ open the interface """
-        self.controller = I2cController()
+    def open(self, vid=None, pid=None, index=1, slave_address=0x10, interface=1):
+        """ open the interface
+        :param slave_address: I2C address of the target, the targets on the same bus share the controller
+        :param interface: FTDI interface (channel) starting from 1, MPSSE is available on 1, 2 of FT2232H/FT4232H
+        """
 
         # [URL Scheme — PyFtdi documentation](https://eblot.github.io/pyftdi/urlscheme.html#url-scheme)
         # # spi.configure('ftdi:///1')
         # url = 'ftdi://ftdi:{}/1'.format(target)
-        url = 'ftdi://{}:{}:{}/1'.format(vid or '', pid or '', index)
-        self.controller.configure(url, frequency=self.freq)
+        self.url = 'ftdi://{}:{}:{}/{}'.format(vid or '', pid or '', index, interface)
+        self.slave_address = slave_address
+
+        def configure():
+            controller = I2cController()
+            controller.configure(self.url, frequency=self.freq)
+            return controller
+
+        self.controller = ControllerPool.acquire(self.url, configure)
         # print('frequency', self.controller.frequency)
         self.slave = self.controller.get_port(slave_address)
         logging.debug("Opening I2C interface")
 
     def close(self):
         """ close the interface """
-        self.controller.terminate()
+        ControllerPool.release(self.controller)
         logging.debug("Close I2C Interface")
+
+    def set_speed(self, freq):
+        """ change the I2C clock, the FTDI I2C clock can only be set when configuring the controller
+        :param freq: I2C clock frequency in Hz
+        """
+        if self.controller.users > 1:
+            raise McuBootGenericError('Can not change the clock of the I2C bus shared by several targets')
+        self.freq = freq
+        self.controller.terminate()
+        self.controller.configure(self.url, frequency=freq)
+        self.slave = self.controller.get_port(self.slave_address)
+        logging.debug("I2C clock: %d Hz", self.controller.frequency)
+
+    def set_irq_pin(self, pin, active_low=True):
+        """ wait on the FTDI GPIO connected to the target IRQ notifier pin before reading
+        :param pin: FTDI GPIO pin number, None to go back to polling the bus
+        :param active_low: The target pulls the pin low when the packet is ready
+        """
+        if pin is None:
+            self.irq = None
+        else:
+            self.irq = IrqNotifier(self.controller.get_gpio(), pin, active_low)
     
     def read(self, packet_type, rx_ack=False, tx_ack=True, locate=None):
         start_byte = self.find_start_byte()
         if rx_ack:
-            if not self.slave.read(1)[0] == FPType.ACK:
-                raise EnvironmentError
+            self.check_packet_type(self.slave.read(1)[0], FPType.ACK)
             self.find_start_byte()
         head = start_byte + self.slave.read(5).tobytes()
         logging.debug('I2C-IN-%s-HEAD[%d]: %s', packet_type.name, len(head), atos(head))
         _, _packet_type, payload_len, crc = struct.unpack('<2B2H', head) # framing packet
-        if not _packet_type == packet_type:
-            if _packet_type == FPType.CMD:   # Slave interrupt in read data
-                pass    # Read out the rest of the command
-            else:
-                raise EnvironmentError
+        # The target can interrupt the read data by a command packet, read out the rest of the command
+        self.check_packet_type(_packet_type, packet_type, FPType.CMD)
         payload = self.slave.read(payload_len).tobytes()
 
         if locate is None:
@@ -76,8 +109,8 @@ class I2C(UartProtocolMixin):
         data = start_byte + self.slave.read(9).tobytes()
         logging.debug('I2C-OUT-PINGR[%d]: %s', len(data), atos(data))
         _, packet_type, *protocol_version, protocol_name, options, crc = struct.unpack('<6B2H', data)
-        if not packet_type == FPType.PINGR:
-                raise EnvironmentError
+        self.check_packet_type(packet_type, FPType.PINGR)
+        self.check_crc(data[:8], crc)
         return data
 
     def find_start_byte(self, timeout=1):
@@ -89,12 +122,19 @@ class I2C(UartProtocolMixin):
         # timeout logic
         start_time = time.perf_counter()
 
+        # The start byte is ready when the target asserts its IRQ notifier pin
+        if self.irq and not self.irq.wait(timeout):
+            raise McuBootTimeOutError
+
+        shared = self.controller is not None and self.controller.users > 1
         # Return before time runs out
         while time.perf_counter() - start_time < timeout:
             start = self.slave.read(1).tobytes()  # return array.array
             # logging.debug('{!r} {}'.format(start, type(start)))
             if start[0] == 0x5A:
                 return start
+            if shared:
+                time.sleep(self.POLL_INTERVAL)
 
         raise McuBootTimeOutError
 
@@ -115,6 +155,8 @@ class I2C(UartProtocolMixin):
         if not packet_type == FPType.ACK:
             if packet_type == FPType.ABORT:
                 raise McuBootDataError(mode='read', errname=StatusCode[0x2712])
+            elif packet_type == FPType.NACK:    # The target received a broken packet
+                raise McuBootDataError(mode='write', errname='Nack', nack=True)
             else:
                 raise McuBootDataError('recevice ack error, packet_type={!s}(0x{:X})'
                     .format(FPType(packet_type), packet_type))
@@ -0,0 +1,319 @@
+import os
+import re
+import struct
+import logging
+import hashlib
+import tempfile
+
+from .exception import McuBootGenericError
+from .memorytool import MemoryBlock, Flash
+from .tool import map_file, read_segments, read_elf
+from .store import JsonStore, cache_dir
+
+class ImageCache(object):
+    """ Cache of the parsed S-Record and Hex files, so that the same file is parsed once.
+    The segments are kept in a binary blob per file content and loaded by mapping it, the manifest maps
+    the path, mtime and size of the file to its content hash, a changed file is hashed and parsed again.
+    :param max_size: Size cap of the blobs in bytes, the least recently used ones are dropped above it
+    :param directory: Directory of the cache, default is "images" in the cache directory of mboot
+    """
+    def __init__(self, max_size=0x10000000, directory=None):
+        self.max_size = max_size
+        self.directory = directory
+
+    def get(self, filename):
+        """ Return the segments of the file, from the cache if it is not changed
+        :param filename: S-Record (.srec, .s19) or Hex (.hex, .ihex) file
+        :return List of (address, data) segments sorted by address
+        """
+        try:
+            directory = self.directory or os.path.join(cache_dir(), 'images')
+            os.makedirs(directory, exist_ok=True)
+            store = JsonStore('manifest', directory)
+            return self._get(filename, directory, store)
+        except OSError as e:
+            logging.warning('Image cache is not available: %s', e)
+            return read_segments(filename)
+
+    def _get(self, filename, directory, store):
+        path = os.path.abspath(filename)
+        stat = os.stat(path)
+        files = store.data.get('files', {})
+        images = store.data.get('images', {})
+        entry = files.get(path)
+        if entry and entry['mtime'] == stat.st_mtime_ns and entry['size'] == stat.st_size and entry['hash'] in images:
+            segments = self._load(directory, entry['hash'], images[entry['hash']])
+            if segments is not None:
+                return segments
+        with open(path, 'rb') as f:
+            data = f.read()
+        digest = hashlib.sha1(data).hexdigest()
+        segments = self._load(directory, digest, images[digest]) if digest in images else None
+        if segments is None:
+            segments = read_segments(filename, data)
+            self._save(directory, store, digest, segments, path, stat)
+        else:
+            self._save(directory, store, digest, None, path, stat)
+        return segments
+
+    @staticmethod
+    def _load(directory, digest, image):
+        blob_path = os.path.join(directory, digest + '.bin')
+        try:
+            blob = map_file(blob_path)
+        except OSError:
+            return None
+        if len(blob) != image['size']:
+            return None
+        # The mtime of the blob is the last use, the manifest is not written for a hit
+        try:
+            os.utime(blob_path)
+        except OSError:
+            pass
+        segments = []
+        offset = 0
+        for address, length in image['segments']:
+            segments.append((address, blob[offset:offset + length]))
+            offset += length
+        return segments
+
+    def _save(self, directory, store, digest, segments, path, stat):
+        # segments is None if the blob of the digest is already in the cache, only the file is added
+        if segments is not None:
+            size = sum(len(data) for _, data in segments)
+            if size > self.max_size:
+                return
+            # Write to a temporary file first, a broken blob is never seen by the other processes
+            fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                for _, data in segments:
+                    f.write(data)
+            os.replace(tmp, os.path.join(directory, digest + '.bin'))
+
+        def change(data):
+            files = data.setdefault('files', {})
+            images = data.setdefault('images', {})
+            if segments is not None:
+                images[digest] = {'segments': [[address, len(part)] for address, part in segments], 'size': size}
+            elif digest not in images:
+                return False    # Dropped by another process meanwhile
+            files[path] = {'mtime': stat.st_mtime_ns, 'size': stat.st_size, 'hash': digest}
+            # Drop the least recently used images above the size cap
+            def used(key):
+                try:
+                    return os.stat(os.path.join(directory, key + '.bin')).st_mtime
+                except OSError:
+                    return 0
+            total = sum(image['size'] for image in images.values())
+            for old in sorted(images, key=used):
+                if total <= self.max_size:
+                    break
+                if old == digest:
+                    continue
+                total -= images.pop(old)['size']
+                try:
+                    os.remove(os.path.join(directory, old + '.bin'))
+                except OSError:
+                    pass    # Still mapped by another process, it is not used any more
+            for old_path in [old_path for old_path, entry in files.items() if entry['hash'] not in images]:
+                del files[old_path]
+        store.modify(change)
+
+class Image(object):
+    """ Memory image made of segments, unlike tool.read_file() the gaps between the segments are kept out of the data
+    :param segments: List of (address, data), adjacent segments are joined, bytes and memoryview are kept without copy
+    """
+    # The parsed S-Record and Hex files are cached, None to parse them every time
+    cache = ImageCache()
+
+    def __init__(self, segments=()):
+        self.segments = []
+        for address, data in sorted(segments, key=lambda segment: segment[0]):
+            if not data:
+                continue
+            if self.segments:
+                last_address, last_data = self.segments[-1]
+                last_end = last_address + len(last_data)
+                if address < last_end:
+                    raise McuBootGenericError('Segment 0x{:08X} overlaps 0x{:08X}-0x{:08X}'.format(
+                        address, last_address, last_end))
+                if address == last_end:
+                    self.segments[-1] = (last_address, b''.join((last_data, data)))
+                    continue
+            self.segments.append((address, data if isinstance(data, (bytes, memoryview)) else bytes(data)))
+
+    @classmethod
+    def from_binary(cls, data, address):
+        return cls([(address, data)])
+
+    @classmethod
+    def from_file(cls, filename, address=None, offset=0, length=None):
+        """ Load S-Record (.srec, .s19), Hex (.hex, .ihex), ELF (.elf, .axf, .out) or binary file,
+        the binary file is mapped, see tool.map_file(), only the loadable segments of the ELF file are taken
+        at their physical addresses, see tool.read_elf()
+        :param filename: The file to be loaded
+        :param address: Start address, required for binary file, the other files are moved to it if given
+        :param offset: Count of bytes skipped from the start of the file, see skip()
+        :param length: Count of bytes loaded after the offset, default is all
+        """
+        try:
+            if filename.lower().endswith(('.elf', '.axf', '.out')):
+                segments = read_elf(filename)     # Mapped, there is nothing to be cached
+            elif filename.lower().endswith(('.srec', '.s19', '.hex', '.ihex')):
+                segments = read_segments(filename) if cls.cache is None else cls.cache.get(filename)
+            else:
+                if address is None:
+                    raise McuBootGenericError('Write a bin file to device must provide a write address.')
+                return cls.from_binary(map_file(filename, offset, length), address)
+        except McuBootGenericError:
+            raise
+        except Exception as e:
+            raise Exception('Could not read file {}:\n [{}]'.format(filename, str(e)))
+        image = cls(segments)
+        if address is not None and image.segments:
+            image = image.move(address - image.minimum_address)
+        image = image.skip(offset)
+        if length is not None and image.segments:
+            image = image.window(image.minimum_address, image.minimum_address + length)
+        return image
+
+    def __len__(self):
+        """ Count of bytes in the segments, the gaps are not included """
+        return sum(len(data) for _, data in self.segments)
+
+    def __iter__(self):
+        return iter(self.segments)
+
+    def __str__(self):
+        return '\n'.join('segment: 0x{:08X}-0x{:08X} (len: 0x{:08X})'.format(address, address + len(data), len(data))
+            for address, data in self.segments)
+
+    @property
+    def minimum_address(self):
+        return self.segments[0][0] if self.segments else None
+
+    @property
+    def maximum_address(self):
+        if not self.segments:
+            return None
+        address, data = self.segments[-1]
+        return address + len(data)
+
+    def blocks(self):
+        return [MemoryBlock(address, None, len(data)) for address, data in self.segments]
+
+    def move(self, offset):
+        """ Return the image moved by offset """
+        return self.__class__([(address + offset, data) for address, data in self.segments])
+
+    def skip(self, offset):
+        """ Return the image without the first offset bytes, the rest is kept at the start address,
+        it is the file offset of "write -o"
+        """
+        if not offset:
+            return self
+        start = self.minimum_address + offset
+        segments = []
+        for address, data in self.segments:
+            if address + len(data) <= start:
+                continue
+            if address < start:
+                data, address = data[start - address:], start
+            segments.append((address - offset, data))
+        return self.__class__(segments)
+
+    def digest(self):
+        """ SHA-1 of the addresses and data of the segments """
+        sha1 = hashlib.sha1()
+        for address, data in self.segments:
+            sha1.update(struct.pack('<2I', address, len(data)))
+            sha1.update(data)
+        return sha1.hexdigest()
+
+    def window(self, start, end):
+        """ Return the part of the image between start and end """
+        segments = []
+        for address, data in self.segments:
+            if address < end and address + len(data) > start:
+                offset = max(start - address, 0)
+                segments.append((address + offset, data[offset:end - address]))
+        return self.__class__(segments)
+
+    def chunks(self, chunk_size):
+        """ Split the image by the windows aligned to chunk_size, the empty windows are skipped
+        :return List of (window start address, Image)
+        """
+        chunks = []
+        for address, data in self.segments:
+            for window in range(address - address % chunk_size, address + len(data), chunk_size):
+                if not chunks or chunks[-1][0] != window:
+                    chunks.append((window, self.window(window, window + chunk_size)))
+        return chunks
+
+    def split(self, value=0xFF, length=0x100, align=4):
+        """ Return the image without the runs of value at least length bytes long, such as the erased flash
+        :param value: Byte value of the runs
+        :param length: Minimal length of the run
+        :param align: The runs are shrunk to be aligned, the programming unit of the flash
+        """
+        # The runs are found by the regular expression engine instead of a loop over the bytes
+        pattern = re.compile(re.escape(bytes([value])) + b'{%d,}' % length)
+        segments = []
+        for address, data in self.segments:
+            offset = 0
+            for match in pattern.finditer(data):
+                start = Flash.align_up(address + match.start(), align) - address
+                end = Flash.align_down(address + match.end(), align) - address
+                if end - start < length:
+                    continue
+                segments.append((address + offset, data[offset:start]))
+                offset = end
+            segments.append((address + offset, data[offset:]))
+        return self.__class__(segments)
+
+    def runs(self, gap=0, padding=0xFF):
+        """ Join the segments separated by no more than gap bytes, the gaps are filled with padding
+        :return List of (address, data)
+        """
+        runs = []   # [address, end, list of data]
+        for address, data in self.segments:
+            if runs and address - runs[-1][1] <= gap:
+                runs[-1][2].extend((bytes([padding]) * (address - runs[-1][1]), data))
+                runs[-1][1] = address + len(data)
+            else:
+                runs.append([address, address + len(data), [data]])
+        # A single part is returned as it is, a mapped file is not copied
+        return [(address, parts[0] if len(parts) == 1 else b''.join(parts)) for address, _, parts in runs]
+
+    def as_binary(self, padding=0xFF):
+        """ All segments in one blob from the minimum address, the gaps are filled with padding """
+        if not self.segments:
+            return b''
+        return self.runs(self.maximum_address, padding)[0][1]
+
+def plan_fill(address, data, length=0x40, align=4):
+    """ Split the data into the parts to be written and the runs of a repeating 1, 2 or 4 byte pattern,
+    which can be generated by the target with fill_memory()
+    :param address: Start address of the data
+    :param data: List of bytes
+    :param length: Minimal length of the run, the fill command costs about as much as sending this count of bytes
+    :param align: The runs are shrunk to be aligned, at least 4, the programming unit for the flash
+    :return List of (address, data, pattern), pattern is the 32-bit fill word or None for the part to be written
+    """
+    data = memoryview(data)
+    # Every 1, 2 byte pattern is a 4 byte one, the runs are word aligned as required by fill_memory()
+    pattern = re.compile(b'(.{4})\\1{%d,}' % max(length // 4 - 1, 1), re.DOTALL)
+    plan = []
+    offset = 0
+    for match in pattern.finditer(data):
+        start = Flash.align_up(address + match.start(), align) - address
+        end = Flash.align_down(address + match.end(), align) - address
+        if end - start < length:
+            continue
+        if offset < start:
+            plan.append((address + offset, data[offset:start], None))
+        plan.append((address + start, data[start:end], struct.unpack_from('<I', data, start)[0]))
+        offset = end
+    if offset < len(data):
+        plan.append((address + offset, data[offset:], None))
+    return plan
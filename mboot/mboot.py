@@ -4,144 +4,184 @@
 # The BSD-3-Clause license for this file can be found in the LICENSE file included with this distribution
 # or at https://spdx.org/licenses/BSD-3-Clause.html#licenseText
 
+import os
 import sys
 import time
 import logging
 import struct
+import random
+import hashlib
 
 # relative imports
 from .enums import CommandTag, PropertyTag, StatusCode, ExtMemPropTags
 from .constant import Interface, KeyOperation
-from .tool import read_file, write_file, check_key, atos, size_fmt
-from .exception import McuBootGenericError, McuBootCommandError
+from .tool import read_file, write_file, open_writer, check_key, atos, size_fmt
+from .exception import McuBootGenericError, McuBootCommandError, McuBootVerifyError
 from .uart import UART
 from .usb import RawHID
 from .spi import SPI
 from .i2c import I2C
-from .memorytool import MemoryBlock, Memory, Flash
-from .peripheral import parse_port, peripheral_speed
+from .memorytool import MemoryBlock, Memory, Flash, plan_erase
+from .image import Image, plan_fill
+from .peripheral import parse_port, peripheral_speed, peripheral_speed_steps, get_calibrated_speed, save_calibrated_speed
 from .decorator import clock
+from .store import JsonStore
+from .retry import RetryPolicy
+from .helper import CRC32_CODE, CRC32_PARAMS, HELPER_AREA_SIZE, LZ4_CODE, LZ4_PARAMS, crc32_blocks, plan_compressed
 
 ########################################################################################################################
 # Helper functions
 ########################################################################################################################
 
-def decode_property_value(property_tag, raw_value, last_cmd_response=None, memory_id=None):
-    if property_tag in (PropertyTag.CURRENT_VERSION, PropertyTag.TARGET_VERSION):
-        str_value = "{0:d}.{1:d}.{2:d}".format((raw_value >> 16) & 0xFF, (raw_value >> 8) & 0xFF, raw_value & 0xFF)
-
-    elif property_tag == PropertyTag.AVAILABLE_PERIPHERALS:
-        str_value = []
-        for key, value in McuBoot.INTERFACES.items():
-            if value[0] & raw_value:
-                str_value.append(key)
-
-    elif property_tag in (PropertyTag.CRC_CHECK_STATUS, PropertyTag.QSPI_INIT_STATUS,
-                          PropertyTag.RELIABLE_UPDATE_STATUS):
-        if raw_value in StatusCode:
-            str_value = StatusCode[raw_value]
-        else:
-            str_value = 'Unknown Status Code: 0x{:08X}'.format(raw_value)
-
-    elif property_tag == PropertyTag.VERIFY_WRITES:
-        str_value = 'ON' if raw_value else 'OFF'
-
-    elif property_tag == PropertyTag.RESERVED_REGIONS:
-        word_len = int((len(last_cmd_response) - 8) / 4)
-        result = struct.unpack_from('<{:d}I'.format(word_len), last_cmd_response, 8)
-        str_value = []
-        for i in range(0, len(result), 2):
-            block = MemoryBlock(result[i], result[i+1])
-            if block:
-                str_value.append(str(block))
-
-    elif property_tag == PropertyTag.UNIQUE_DEVICE_IDENT:
-        word_len = int((len(last_cmd_response) - 8) / 4)
-        result = struct.unpack_from('<{:d}I'.format(word_len), last_cmd_response, 8)
-        str_list = ['{:08X}'.format(value) for value in result]
-        str_value = ' '.join(str_list)
-        # str_value = '{:04X} {:04X} '.format((raw_value >> 16) & 0xFFFF, raw_value & 0xFFFF)
-
-    elif property_tag == PropertyTag.FLASH_FAC_SUPPORT:
-        str_value = 'SUPPORTED' if raw_value else 'UNSUPPORTED'
-
-    elif property_tag == PropertyTag.FLASH_SECURITY_STATE:
-        security_state = {0x00000000: 'Unlocked', 0x00000001: 'Locked', 0x5AA55AA5: 'Unlocked', 0xC33CC33C: 'Locked'}
-        if raw_value in security_state:
-            str_value = security_state[raw_value]
-        else:
-            str_value = "Unknown (0x{:08X})".format(raw_value)
-
-    elif property_tag == PropertyTag.AVAILABLE_COMMANDS:
-        str_value = []
-        for name, value, desc in CommandTag:
-            if (1 << value) & raw_value:
-                str_value.append(name)
-
-    elif property_tag in (PropertyTag.MAX_PACKET_SIZE, PropertyTag.FLASH_SECTOR_SIZE,
-                          PropertyTag.FLASH_SIZE, PropertyTag.RAM_SIZE, PropertyTag.FLASH_ACCESS_SEGMENT_SIZE):
-        str_value = size_fmt(raw_value)
-
-    elif property_tag in (PropertyTag.RAM_START_ADDRESS, PropertyTag.FLASH_START_ADDRESS,
-                          PropertyTag.SYSTEM_DEVICE_IDENT):
-        str_value = '0x{:08X}'.format(raw_value)
-
-    elif property_tag in (PropertyTag.FLASH_ACCESS_SEGMENT_COUNT, PropertyTag.FLASH_BLOCK_COUNT,
-                          PropertyTag.VALIDATE_REGIONS):
-        str_value = '0x{:X}'.format(raw_value)
-
-    elif property_tag == PropertyTag.FLASH_READ_MARGIN:
-        margin_info = {0: "Normal", 1: "User", 2: "Factory"}
-        if raw_value in margin_info:
-            str_value = "{} (0x{:X})".format(margin_info[raw_value], raw_value)
-        else:
-            str_value = "Unknown (0x{:X})".format(raw_value)
+# MCUBoot Interface | mask | default speed
+INTERFACES = {
+    'UART':      [0x00000001, 115200],
+    'I2C-Slave': [0x00000002, 400],
+    'SPI-Slave': [0x00000004, 400],
+    'CAN':       [0x00000008, 500],
+    'USB-HID':   [0x00000010, 12000000],
+    'USB-CDC':   [0x00000020, 12000000],
+    'USB-DFU':   [0x00000040, 12000000],
+}
+
+# The enum lookups are done once, the decoders only use these tables
+_INTERFACE_MASKS = [(name, value[0]) for name, value in INTERFACES.items()]
+_COMMAND_MASKS = [(name, 1 << value) for name, value, desc in CommandTag]
+_STATUS_NAMES = {value: name for name, value, desc in StatusCode}
+_PROPERTY_NAMES = {value: name for name, value, desc in PropertyTag}
+_SECURITY_STATES = {0x00000000: 'Unlocked', 0x00000001: 'Locked', 0x5AA55AA5: 'Unlocked', 0xC33CC33C: 'Locked'}
+_MARGIN_INFO = {0: "Normal", 1: "User", 2: "Factory"}
+
+def _decode_version(raw_value, response, memory_id):
+    return "{0:d}.{1:d}.{2:d}".format((raw_value >> 16) & 0xFF, (raw_value >> 8) & 0xFF, raw_value & 0xFF)
+
+def _decode_peripherals(raw_value, response, memory_id):
+    return [name for name, mask in _INTERFACE_MASKS if mask & raw_value]
+
+def _decode_status(raw_value, response, memory_id):
+    if raw_value in _STATUS_NAMES:
+        return _STATUS_NAMES[raw_value]
+    return 'Unknown Status Code: 0x{:08X}'.format(raw_value)
+
+def _decode_on_off(raw_value, response, memory_id):
+    return 'ON' if raw_value else 'OFF'
+
+def _response_words(response):
+    word_len = int((len(response) - 8) / 4)
+    return struct.unpack_from('<{:d}I'.format(word_len), response, 8)
+
+def _decode_reserved_regions(raw_value, response, memory_id):
+    result = _response_words(response)
+    str_value = []
+    for i in range(0, len(result), 2):
+        block = MemoryBlock(result[i], result[i+1])
+        if block:
+            str_value.append(str(block))
+    return str_value
 
-    elif property_tag == PropertyTag.EXTERNAL_MEMORY_ATTRIBUTES and memory_id:
+def _decode_unique_ident(raw_value, response, memory_id):
+    return ' '.join(['{:08X}'.format(value) for value in _response_words(response)])
 
-        result = struct.unpack_from('<6I', last_cmd_response, 8)
-        prop_tags, start_address, total_size, page_size, sector_size, block_size = result
-        str_value = []
-        str_value.append('Memory Id: 0x{:X}'.format(memory_id))
-        if prop_tags & ExtMemPropTags.START_ADDRESS:
-            str_value.append('Start Address: 0x{:08X}'.format(start_address))
+def _decode_supported(raw_value, response, memory_id):
+    return 'SUPPORTED' if raw_value else 'UNSUPPORTED'
 
-        if prop_tags & ExtMemPropTags.SIZE_IN_KBYTES:
-            str_value.append('Total Size: {}'.format(size_fmt(total_size * 1024)))
+def _decode_security_state(raw_value, response, memory_id):
+    if raw_value in _SECURITY_STATES:
+        return _SECURITY_STATES[raw_value]
+    return "Unknown (0x{:08X})".format(raw_value)
 
-        if prop_tags & ExtMemPropTags.PAGE_SIZE:
-            str_value.append('Page Size: {}'.format(size_fmt(page_size)))
+def _decode_commands(raw_value, response, memory_id):
+    return [name for name, mask in _COMMAND_MASKS if mask & raw_value]
 
-        if prop_tags & ExtMemPropTags.SECTOR_SIZE:
-            str_value.append('Sector Size: {}'.format(size_fmt(sector_size)))
+def _decode_size(raw_value, response, memory_id):
+    return size_fmt(raw_value)
 
-        if prop_tags & ExtMemPropTags.BLOCK_SIZE:
-            str_value.append('Block Size: {}'.format(size_fmt(block_size)))
+def _decode_address(raw_value, response, memory_id):
+    return '0x{:08X}'.format(raw_value)
 
-    elif property_tag == PropertyTag.IRQ_NOTIFIER_PIN:
-        pin = raw_value & 0xFF
-        port = (raw_value >> 8) & 0xFF
-        enabled = True if raw_value & (1 << 32) else False
-        if enabled:
-            str_value = "Irq pin is enabled, using GPIO port[{}], pin[{}]".format(port, pin)
-        else:
-            str_value = "Irq pin is disabled"
+def _decode_hex(raw_value, response, memory_id):
+    return '0x{:X}'.format(raw_value)
 
-    elif property_tag == PropertyTag.PFR_KEYSTORE_UPDATE_OPT:
-        str_value = "FFR KeyStore Update is "
+def _decode_read_margin(raw_value, response, memory_id):
+    if raw_value in _MARGIN_INFO:
+        return "{} (0x{:X})".format(_MARGIN_INFO[raw_value], raw_value)
+    return "Unknown (0x{:X})".format(raw_value)
 
-        if raw_value == 0:
-            str_value += "Key Provisioning"
-        elif raw_value == 1:
-            str_value += "Write Memory"
-        else:
-            str_value += "UnKnow Option"
+def _decode_external_memory(raw_value, response, memory_id):
+    if not memory_id:
+        return _decode_hex(raw_value, response, memory_id)
+    result = struct.unpack_from('<6I', response, 8)
+    prop_tags, start_address, total_size, page_size, sector_size, block_size = result
+    str_value = []
+    str_value.append('Memory Id: 0x{:X}'.format(memory_id))
+    if prop_tags & ExtMemPropTags.START_ADDRESS:
+        str_value.append('Start Address: 0x{:08X}'.format(start_address))
 
-    else:
-        str_value = '0x{:X}'.format(raw_value)
+    if prop_tags & ExtMemPropTags.SIZE_IN_KBYTES:
+        str_value.append('Total Size: {}'.format(size_fmt(total_size * 1024)))
+
+    if prop_tags & ExtMemPropTags.PAGE_SIZE:
+        str_value.append('Page Size: {}'.format(size_fmt(page_size)))
 
+    if prop_tags & ExtMemPropTags.SECTOR_SIZE:
+        str_value.append('Sector Size: {}'.format(size_fmt(sector_size)))
+
+    if prop_tags & ExtMemPropTags.BLOCK_SIZE:
+        str_value.append('Block Size: {}'.format(size_fmt(block_size)))
     return str_value
 
+def _decode_irq_notifier_pin(raw_value, response, memory_id):
+    pin = raw_value & 0xFF
+    port = (raw_value >> 8) & 0xFF
+    enabled = True if raw_value & (1 << 31) else False
+    if enabled:
+        return "Irq pin is enabled, using GPIO port[{}], pin[{}]".format(port, pin)
+    return "Irq pin is disabled"
+
+def _decode_keystore_update_opt(raw_value, response, memory_id):
+    str_value = "FFR KeyStore Update is "
+    if raw_value == 0:
+        str_value += "Key Provisioning"
+    elif raw_value == 1:
+        str_value += "Write Memory"
+    else:
+        str_value += "UnKnow Option"
+    return str_value
+
+# property tag -> decoder(raw_value, last_cmd_response, memory_id)
+PROPERTY_DECODERS = {
+    PropertyTag.CURRENT_VERSION: _decode_version,
+    PropertyTag.TARGET_VERSION: _decode_version,
+    PropertyTag.AVAILABLE_PERIPHERALS: _decode_peripherals,
+    PropertyTag.CRC_CHECK_STATUS: _decode_status,
+    PropertyTag.QSPI_INIT_STATUS: _decode_status,
+    PropertyTag.RELIABLE_UPDATE_STATUS: _decode_status,
+    PropertyTag.VERIFY_WRITES: _decode_on_off,
+    PropertyTag.RESERVED_REGIONS: _decode_reserved_regions,
+    PropertyTag.UNIQUE_DEVICE_IDENT: _decode_unique_ident,
+    PropertyTag.FLASH_FAC_SUPPORT: _decode_supported,
+    PropertyTag.FLASH_SECURITY_STATE: _decode_security_state,
+    PropertyTag.AVAILABLE_COMMANDS: _decode_commands,
+    PropertyTag.MAX_PACKET_SIZE: _decode_size,
+    PropertyTag.FLASH_SECTOR_SIZE: _decode_size,
+    PropertyTag.FLASH_SIZE: _decode_size,
+    PropertyTag.RAM_SIZE: _decode_size,
+    PropertyTag.FLASH_ACCESS_SEGMENT_SIZE: _decode_size,
+    PropertyTag.RAM_START_ADDRESS: _decode_address,
+    PropertyTag.FLASH_START_ADDRESS: _decode_address,
+    PropertyTag.SYSTEM_DEVICE_IDENT: _decode_address,
+    PropertyTag.FLASH_ACCESS_SEGMENT_COUNT: _decode_hex,
+    PropertyTag.FLASH_BLOCK_COUNT: _decode_hex,
+    PropertyTag.VALIDATE_REGIONS: _decode_hex,
+    PropertyTag.FLASH_READ_MARGIN: _decode_read_margin,
+    PropertyTag.EXTERNAL_MEMORY_ATTRIBUTES: _decode_external_memory,
+    PropertyTag.IRQ_NOTIFIER_PIN: _decode_irq_notifier_pin,
+    PropertyTag.PFR_KEYSTORE_UPDATE_OPT: _decode_keystore_update_opt,
+}
+
+def decode_property_value(property_tag, raw_value, last_cmd_response=None, memory_id=None):
+    return PROPERTY_DECODERS.get(property_tag, _decode_hex)(raw_value, last_cmd_response, memory_id)
+
 
 def is_command_available(command_tag, property_raw_value):
     return True if (1 << command_tag) & property_raw_value else False
@@ -193,23 +233,47 @@ def is_command_available(command_tag, property_raw_value):
 
 class McuBoot(object):
 
-    INTERFACES = {
-        #  MCUBoot Interface | mask | default speed
-        'UART':      [0x00000001, 115200],
-        'I2C-Slave': [0x00000002, 400],
-        'SPI-Slave': [0x00000004, 400],
-        'CAN':       [0x00000008, 500],
-        'USB-HID':   [0x00000010, 12000000],
-        'USB-CDC':   [0x00000020, 12000000],
-        'USB-DFU':   [0x00000040, 12000000],
-    }
+    INTERFACES = INTERFACES
+
+    # Properties that do not change during a session, get_property() reads them from the target only once
+    STATIC_PROPERTIES = frozenset((
+        PropertyTag.CURRENT_VERSION, PropertyTag.AVAILABLE_PERIPHERALS, PropertyTag.FLASH_START_ADDRESS,
+        PropertyTag.FLASH_SIZE, PropertyTag.FLASH_SECTOR_SIZE, PropertyTag.FLASH_BLOCK_COUNT,
+        PropertyTag.AVAILABLE_COMMANDS, PropertyTag.MAX_PACKET_SIZE, PropertyTag.RESERVED_REGIONS,
+        PropertyTag.RAM_START_ADDRESS, PropertyTag.RAM_SIZE, PropertyTag.SYSTEM_DEVICE_IDENT,
+        PropertyTag.UNIQUE_DEVICE_IDENT, PropertyTag.FLASH_FAC_SUPPORT, PropertyTag.FLASH_ACCESS_SEGMENT_SIZE,
+        PropertyTag.FLASH_ACCESS_SEGMENT_COUNT, PropertyTag.TARGET_VERSION, PropertyTag.EXTERNAL_MEMORY_ATTRIBUTES,
+        PropertyTag.FLASH_PAGE_SIZE
+    ))
 
     def __init__(self, level=logging.WARNING):
         self.cli_mode = False
         self._itf_ = None
         self.current_interface = None
         self.reopen_args = None
+        self.adapter = None
         self.timeout = 1
+        # Set False to read every property from the target
+        self.cache_properties = True
+        # Retry of the commands and data phases failed by a transient error, RetryPolicy(attempts=1) to disable
+        self.retry = RetryPolicy()
+        # (property tag, memory id) -> (raw value, response) or McuBootCommandError
+        self._property_cache = {}
+        self.last_property_response = None
+        self._profile_key = None
+        # memory id -> (config address, config words) of the external memories configured in this session
+        self._exmem_config = {}
+        self._manifests = None
+        self._writing_delta = False
+        # Journal of write_image() by chunks and the key of the image being written, see _write_image_chunks()
+        self._journal = None
+        self._journal_key = None
+        # (identity, unique) of the connected device, see _get_device_ident()
+        self._device_ident = None
+        # False if the stores have no manifest and journal of the device, see _forget_flash()
+        self._device_stored = None
+        # (start, end) of the internal flash, () if there is none, see _is_flash()
+        self._flash_range = None
         self.memory = None
         self.flash = None
         # self._pg_func = None
@@ -252,6 +316,7 @@ class McuBoot(object):
         This function is not involved in library function calls, it is used in cli mode
         :return The result of opening the device
         """
+        self._reset_session()
         if vid_pid and path is None:
             if isinstance(vid_pid, str):
                 _vid_pid = parse_port(Interface.USB.name, vid_pid)
@@ -286,6 +351,7 @@ class McuBoot(object):
     def open_uart(self, port, baudrate=peripheral_speed['uart']):
         """ MCUBoot: Connect by UART
         """
+        self._reset_session()
         if self.cli_mode:   # checked in cli mode
             _port = port
         else:
@@ -306,9 +372,12 @@ class McuBoot(object):
         #     logging.info('UART Disconnected !')
         #     return False
     
-    def open_spi(self, vid_pid, index=1, freq=peripheral_speed['spi'], mode=0):
-        """ MCUBoot: Connect by UART
+    def open_spi(self, vid_pid, index=1, freq=peripheral_speed['spi'], mode=0, interface=1, cs=0):
+        """ MCUBoot: Connect by SPI
+        :param interface: FTDI interface (channel) starting from 1, use 1, 2 of FT2232H/FT4232H to drive two targets
+        :param cs: Chip select of the target, several McuBoot can be opened on the same bus with different chip select
         """
+        self._reset_session()
         if vid_pid is None:
             if index:
                 _vid_pid = (None, None)
@@ -319,10 +388,13 @@ class McuBoot(object):
             _vid_pid, _freq = parse_port(Interface.SPI.name, vid_pid)
         else:   # Default input tuple in cli mode, no conversion required
             _vid_pid = vid_pid
+        index = index or 1
+        auto_speed = freq == 'auto'
+        if auto_speed:  # The target is unknown before connecting, start with the slowest speed recorded for the adapter
+            freq = get_calibrated_speed(Interface.SPI.name, _vid_pid, index) or peripheral_speed['spi']
         try:
             self._itf_ = SPI(freq, mode)
-            index = index or 1
-            self._itf_.open(*_vid_pid, index=index)
+            self._itf_.open(*_vid_pid, index=index, interface=interface, cs=cs)
         except Exception:
             logging.info('Open SPI failed, SPI disconnected !')
             if self.cli_mode:   # Fast failure in cli mode
@@ -330,12 +402,18 @@ class McuBoot(object):
             return False
         else:
             self.current_interface = Interface.SPI
-            self.reopen_args = (_vid_pid, freq, mode)
+            self.reopen_args = (_vid_pid, freq, mode, interface, cs)
+            self.adapter = (_vid_pid, index)
+            if auto_speed:
+                self.use_calibrated_speed()
             return True
 
-    def open_i2c(self, vid_pid, index=1, freq=peripheral_speed['i2c']):
-        """ MCUBoot: Connect by UART
+    def open_i2c(self, vid_pid, index=1, freq=peripheral_speed['i2c'], interface=1, slave_address=0x10):
+        """ MCUBoot: Connect by I2C
+        :param interface: FTDI interface (channel) starting from 1, use 1, 2 of FT2232H/FT4232H to drive two targets
+        :param slave_address: I2C address of the target, several McuBoot can be opened on the same bus with different address
         """
+        self._reset_session()
         if vid_pid is None:
             if index:
                 _vid_pid = (None, None)
@@ -345,10 +423,13 @@ class McuBoot(object):
             _vid_pid = parse_port(Interface.I2C.name, vid_pid)
         else:   # Default input tuple in cli mode, no conversion required
             _vid_pid = vid_pid
+        index = index or 1
+        auto_speed = freq == 'auto'
+        if auto_speed:  # The target is unknown before connecting, start with the slowest speed recorded for the adapter
+            freq = get_calibrated_speed(Interface.I2C.name, _vid_pid, index) or peripheral_speed['i2c']
         try:
             self._itf_ = I2C(freq)
-            index = index or 1
-            self._itf_.open(*_vid_pid, index=index)
+            self._itf_.open(*_vid_pid, index=index, slave_address=slave_address, interface=interface)
         except Exception:
             logging.info('Open I2C failed, I2C disconnected !')
             if self.cli_mode:   # Fast failure in cli mode
@@ -356,12 +437,16 @@ class McuBoot(object):
             return False
         else:
             self.current_interface = Interface.I2C
-            self.reopen_args = (_vid_pid, freq)
+            self.reopen_args = (_vid_pid, freq, interface, slave_address)
+            self.adapter = (_vid_pid, index)
+            if auto_speed:
+                self.use_calibrated_speed()
             return True
 
     def close(self):
         """ MCUBoot: Disconnect device
         """
+        self._reset_session()
         if self._itf_:
             self._itf_.close()
             self._itf_ = None
@@ -372,6 +457,128 @@ class McuBoot(object):
         else:
             return False
     
+    def enable_irq_notifier(self, port, pin, ftdi_pin, active_low=True):
+        """ MCUBoot: Enable the IRQ notifier pin of the target, then wait on it instead of polling the bus
+        :param port: GPIO port of the target used as IRQ notifier pin
+        :param pin: GPIO pin of the target used as IRQ notifier pin
+        :param ftdi_pin: FTDI GPIO pin number connected to the IRQ notifier pin
+        :param active_low: The target pulls the pin low when the packet is ready
+        """
+        if self.current_interface not in (Interface.SPI, Interface.I2C):
+            raise McuBootGenericError('IRQ notifier pin is only supported by SPI and I2C')
+        self.set_property(PropertyTag.IRQ_NOTIFIER_PIN, (1 << 31) | ((port & 0xFF) << 8) | (pin & 0xFF))
+        self._itf_.set_irq_pin(ftdi_pin, active_low)
+
+    def calibrate_speed(self, address=None, length=0x100, rounds=3, steps=None, save=True):
+        """ MCUBoot: Find the fastest reliable SPI/I2C clock. The clock is stepped up and some round trips
+        (ping, get property and read memory, all CRC validated) are run at each step, back off to the last good step on error.
+        :param address: Address read in the round trips, default is the start address of the internal flash
+        :param length: Count of bytes read in each round trip, 0 means only ping and get property
+        :param rounds: Count of round trips at each step
+        :param steps: Clock frequencies to try, default is peripheral_speed_steps
+        :param save: Record the result for the adapter and target, it will be used by the speed 'auto'
+        :return The fastest reliable speed
+        """
+        if self.current_interface not in (Interface.SPI, Interface.I2C):
+            raise McuBootGenericError('Speed calibration is only supported by SPI and I2C')
+        peripheral = self.current_interface.name
+        steps = sorted(steps or peripheral_speed_steps[peripheral.lower()])
+
+        # The references are read at the current speed, which is expected to work
+        target = self._get_target_ident()
+        version = self.get_property(PropertyTag.CURRENT_VERSION)
+        reference = None
+        if length:
+            try:
+                if address is None:
+                    address = self.get_property(PropertyTag.FLASH_START_ADDRESS)
+                reference = self.read_memory(address, length)
+            except McuBootGenericError:
+                logging.info('Calibrate: Can not read 0x%X, only ping and get property are used', address or 0)
+
+        best = self._itf_.freq
+        # Every error counts in the round trips, do not hide them by the retry
+        retry, self.retry = self.retry, RetryPolicy(attempts=1)
+        try:
+            for freq in steps:
+                if freq <= best:
+                    continue
+                self._itf_.set_speed(freq)
+                if not self._run_round_trips(rounds, version, address, reference):
+                    logging.info('Calibrate: %d Hz failed, back off to %d Hz', freq, best)
+                    break
+                logging.info('Calibrate: %d Hz passed', freq)
+                best = freq
+        finally:
+            self.retry = retry
+
+        self._itf_.set_speed(best)
+        self._resync()
+        if save and self.adapter:
+            save_calibrated_speed(peripheral, *self.adapter, target, best)
+        return best
+
+    def use_calibrated_speed(self):
+        """ MCUBoot: Switch SPI/I2C to the speed recorded by calibrate_speed() for the connected target
+        :return The speed in use
+        """
+        try:
+            target = self._get_target_ident()
+        except McuBootGenericError:
+            logging.info('Target does not respond, keep %d Hz', self._itf_.freq)
+            return self._itf_.freq
+        speed = get_calibrated_speed(self.current_interface.name, *self.adapter, target)
+        if speed and speed != self._itf_.freq:
+            self._itf_.set_speed(speed)
+        return self._itf_.freq
+
+    def _get_target_ident(self):
+        try:
+            return self.get_property(PropertyTag.SYSTEM_DEVICE_IDENT)
+        except McuBootCommandError:
+            return 0    # Not supported by the target
+
+    def _run_round_trips(self, rounds, version, address, reference):
+        try:
+            for _ in range(rounds):
+                self._itf_.ping()
+                if self.get_property(PropertyTag.CURRENT_VERSION, cached=False) != version:
+                    return False
+                if reference is not None and self.read_memory(address, len(reference)) != reference:
+                    return False
+        except Exception as e:  # A broken packet can fail anywhere in the transport
+            logging.debug('Calibrate: %s', e)
+            return False
+        return True
+
+    def _retry(self, operation, name):
+        # Only for the operations which can be sent again, not for reset, execute, program once...
+        return self.retry.run(operation, self._resync, name)
+
+    def _resync(self, retries=3):
+        # A broken transfer may leave the target waiting for the rest of the packet, ping until it responds
+        for _ in range(retries):
+            time.sleep(0.01)
+            try:
+                self._itf_.ping()
+                return True
+            except Exception:
+                continue
+        return False
+
+    def _is_flash(self, memory_id, start_address, length):
+        # The external memories are nonvolatile, the internal one is flash in FLASH_START_ADDRESS/FLASH_SIZE.
+        # The range is read once per session, even if the properties are not cached
+        if memory_id:
+            return True
+        if self._flash_range is None:
+            try:
+                start = self.get_property(PropertyTag.FLASH_START_ADDRESS)
+                self._flash_range = (start, start + self.get_property(PropertyTag.FLASH_SIZE))
+            except McuBootCommandError:
+                self._flash_range = ()    # Some device have no internal flash
+        return bool(self._flash_range) and start_address < self._flash_range[1] and start_address + length > self._flash_range[0]
+
     def get_memory_range(self):
         try:
             mstart = self.get_property(PropertyTag.RAM_START_ADDRESS)
@@ -401,7 +608,7 @@ class McuBoot(object):
         for property_name, property_tag, _ in PropertyTag:
             try:
                 raw_value = self.get_property(property_tag)
-                str_value = decode_property_value(property_tag, raw_value, self._itf_.last_cmd_response, memory_id)
+                str_value = decode_property_value(property_tag, raw_value, self.last_property_response, memory_id)
             except McuBootCommandError:
                 continue
             mcu_info.update({property_name: str_value})
@@ -413,7 +620,7 @@ class McuBoot(object):
         exmem_info = {}
         try:
             raw_value = self.get_property(PropertyTag.EXTERNAL_MEMORY_ATTRIBUTES, memory_id)
-            str_value = decode_property_value(PropertyTag.EXTERNAL_MEMORY_ATTRIBUTES, raw_value, self._itf_.last_cmd_response, memory_id)
+            str_value = decode_property_value(PropertyTag.EXTERNAL_MEMORY_ATTRIBUTES, raw_value, self.last_property_response, memory_id)
         except McuBootCommandError:
             pass
         # str_list = [' External Memory Attributes:']
@@ -423,12 +630,23 @@ class McuBoot(object):
         return exmem_info
 
     def setup_external_memory(self, memory_id, exconf):
-        start_config_address = fill_config_address = exconf[0]
-        external_config = exconf[1:]
-        for word in external_config:
-            self.fill_memory(fill_config_address, 4, word)
-            fill_config_address += 4
-        self.configure_memory(memory_id, start_config_address)
+        """ Write the configuration block of the external memory and configure it,
+        skipped if the memory is already configured with the same block in this session
+        :param memory_id: External memory id
+        :param exconf: [config_address, config_word1, config_word2, ...]
+        """
+        config_address = exconf[0]
+        config_words = tuple(exconf[1:])
+        if self._exmem_config.get(memory_id) == (config_address, config_words):
+            logging.info('External memory 0x%X is already configured', memory_id)
+            return
+        # The whole block is sent in one transfer
+        if len(set(config_words)) == 1:
+            self.fill_memory(config_address, 4 * len(config_words), config_words[0])
+        elif config_words:
+            self.write_memory(config_address, struct.pack('<{:d}I'.format(len(config_words)), *config_words))
+        self.configure_memory(memory_id, config_address)
+        self._exmem_config[memory_id] = (config_address, config_words)
 
     def flash_erase_all(self, memory_id = 0):
         """ MCUBoot: Erase complete flash memory without recovering flash security section
@@ -436,12 +654,77 @@ class McuBoot(object):
         :param memory_id: External memory id
         """
         logging.info('TX-CMD: FlashEraseAll [ memoryId = 0x%X ]', memory_id)
+        self._forget_flash(memory_id)
         # Prepare FlashEraseAll command
         cmd = struct.pack('4BI', CommandTag.FLASH_ERASE_ALL, 0x00, 0x00, 0x01, memory_id)
         # Process FlashEraseAll command
         timeout = 300 if self.timeout == 1 else self.timeout
         self._itf_.write_cmd(cmd, timeout = timeout)
 
+    def get_sector_size(self, memory_id = 0):
+        """ Get the erase unit of the memory
+        :param memory_id: External memory id, the sector size in the EXTERNAL_MEMORY_ATTRIBUTES is used if present
+        :return Count of bytes
+        """
+        if memory_id:
+            try:
+                self.get_property(PropertyTag.EXTERNAL_MEMORY_ATTRIBUTES, memory_id)
+                prop_tags, _, _, _, sector_size, _ = struct.unpack_from('<6I', self.last_property_response, 8)
+                if prop_tags & ExtMemPropTags.SECTOR_SIZE and sector_size:
+                    return sector_size
+            except (McuBootCommandError, struct.error):
+                pass    # Some device do not support EXTERNAL_MEMORY_ATTRIBUTES Property
+        return self.get_property(PropertyTag.FLASH_SECTOR_SIZE, memory_id)
+
+    def get_program_unit(self, memory_id = 0):
+        """ Get the programming unit of the memory, the page size in EXTERNAL_MEMORY_ATTRIBUTES for external memories,
+        FLASH_PAGE_SIZE for internal flash, 16 bytes (the widest flash phrase) if not known.
+        :param memory_id: External memory id
+        :return Count of bytes
+        """
+        try:
+            if memory_id:
+                self.get_property(PropertyTag.EXTERNAL_MEMORY_ATTRIBUTES, memory_id)
+                prop_tags, _, _, page_size, _, _ = struct.unpack_from('<6I', self.last_property_response, 8)
+                if prop_tags & ExtMemPropTags.PAGE_SIZE and page_size:
+                    return page_size
+            else:
+                page_size = self.get_property(PropertyTag.FLASH_PAGE_SIZE)
+                if page_size:
+                    return page_size
+        except (McuBootCommandError, struct.error):
+            pass
+        return 16
+
+    def get_flash_banks(self):
+        """ Get the blocks (banks) of the internal flash, the flash is split equally by FLASH_BLOCK_COUNT
+        :return List of Flash, empty if not known
+        """
+        try:
+            start = self.get_property(PropertyTag.FLASH_START_ADDRESS)
+            size = self.get_property(PropertyTag.FLASH_SIZE)
+            sector_size = self.get_property(PropertyTag.FLASH_SECTOR_SIZE)
+            try:
+                count = self.get_property(PropertyTag.FLASH_BLOCK_COUNT) or 1
+            except McuBootCommandError:
+                count = 1
+        except McuBootCommandError:
+            return []
+        bank_size = size // count
+        return [Flash(start + i * bank_size, None, bank_size, sector_size) for i in range(count)]
+
+    def flash_erase_blocks(self, blocks, memory_id = 0):
+        """ Erase the sectors of the blocks with the minimal count of flash_erase_region(), see memorytool.plan_erase()
+        :param blocks: List of MemoryBlock or (start, end) to be written
+        :param memory_id: External memory id
+        :return List of erased Flash regions
+        """
+        banks = [] if memory_id else self.get_flash_banks()
+        regions = plan_erase(blocks, self.get_sector_size(memory_id), banks)
+        for region in regions:
+            self.flash_erase_region(region.start, region.length, memory_id)
+        return regions
+
     '''                             
     MT64 UART 57600
     len             size    time
@@ -458,18 +741,19 @@ class McuBoot(object):
         :param memory_id: External memory id
         """
         logging.info('TX-CMD: FlashEraseRegion [ StartAddr=0x%08X | len=0x%X | memoryId = 0x%X ]', start_address, length, memory_id)
+        self._forget_flash(memory_id, start_address, length)
         # Prepare FlashEraseRegion command
         cmd = struct.pack('<4B3I', CommandTag.FLASH_ERASE_REGION, 0x00, 0x00, 0x03, start_address, length, memory_id)
         # Process FlashEraseRegion command
         timeout = 300 if self.timeout == 1 else self.timeout
-        self._itf_.write_cmd(cmd, timeout = timeout)
+        self._retry(lambda: self._itf_.write_cmd(cmd, timeout = timeout), 'FlashEraseRegion')
 
     def read_memory(self, start_address, length, filename = None, memory_id = 0):
         """ MCUBoot: Read data from MCU memory
         CommandTag: 0x03
         :param start_address: Start address
         :param length: Count of bytes
-        :param filename: The file to be read
+        :param filename: The file to be written, see read_memory_to_file() to read a large memory chunk by chunk
         :param memory_id: External memory id
         :return List of bytes
         """
@@ -482,15 +766,203 @@ class McuBoot(object):
         logging.info('TX-CMD: ReadMemory [ StartAddr=0x%08X | len=0x%X | memoryId = 0x%X ]', start_address, length, memory_id)
         # Prepare ReadMemory command
         cmd = struct.pack('<4B3I', CommandTag.READ_MEMORY, 0x00, 0x00, 0x03, start_address, length, memory_id)
-        # Process ReadMemory command
-        self._itf_.write_cmd(cmd)
-        # Process Read Data
-        data = self._itf_.read_data(length)
+        def transfer():
+            # Process ReadMemory command
+            self._itf_.write_cmd(cmd)
+            # Process Read Data
+            return self._itf_.read_data(length)
+        # The retry sends the command again
+        data = self._retry(transfer, 'ReadMemory')
         if filename:
-            write_file(filename, data)
+            write_file(filename, data, start_address)
             logging.info("Successfully saved into: {}".format(filename))
         return data
 
+    def read_memory_to_file(self, start_address, length, filename, memory_id = 0, chunk_size = None, resume = False):
+        """ Read data from MCU memory into the file chunk by chunk, only one chunk is kept in memory
+        :param start_address: Start address
+        :param length: Count of bytes
+        :param filename: The file to be written, S-Record (.srec, .s19), Hex (.hex, .ihex) or binary
+        :param memory_id: External memory id
+        :param chunk_size: Count of bytes read by one ReadMemory command, default is the sector size
+        :param resume: Continue the binary file written by an interrupted read, the chunks in it are not read again
+        :return Count of bytes
+        """
+        if chunk_size is None:
+            try:
+                chunk_size = self.get_sector_size(memory_id)
+            except McuBootCommandError:
+                chunk_size = 0x1000
+        writer = open_writer(filename, start_address, resume, chunk_size, length)
+        try:
+            if writer.offset:
+                logging.info('ReadMemory: resume from 0x%08X', start_address + writer.offset)
+            for offset in range(writer.offset, length, chunk_size):
+                writer.write(self.read_memory(start_address + offset, min(chunk_size, length - offset), memory_id=memory_id))
+                logging.info('ReadMemory: 0x%X of 0x%X bytes', min(offset + chunk_size, length), length)
+        finally:
+            writer.close()
+        logging.info("Successfully saved into: {}".format(filename))
+        return length
+
+    def verify_memory(self, start_address, data, memory_id = 0, chunk_size = 0x10000):
+        """ Read back the memory chunk by chunk and compare it with the data, stop at the first mismatch
+        :param start_address: Start address, not used for the Image, optional for S-Record and Hex file
+        :param data: List of bytes, mboot.image.Image or the file to be compared, the binary file is read chunk by chunk
+        :param memory_id: External memory id
+        :param chunk_size: Count of bytes read by one ReadMemory command
+        :return Count of verified bytes
+        """
+        start = time.perf_counter()
+        length = 0
+        for address, expected in self._verify_chunks(start_address, data, chunk_size):
+            read = self.read_memory(address, len(expected), memory_id=memory_id)
+            if read != expected:
+                i = next((i for i, (a, b) in enumerate(zip(read, expected)) if a != b), min(len(read), len(expected)))
+                if i == min(len(read), len(expected)):     # The same data, but not the same length
+                    raise McuBootVerifyError('Verify failed at 0x{:08X} -> read 0x{:X} bytes, expected 0x{:X}'.format(
+                        address, len(read), len(expected)), address=address + i, read=None, expected=None)
+                raise McuBootVerifyError(address=address + i, read=read[i], expected=expected[i])
+            length += len(expected)
+        elapsed = max(time.perf_counter() - start, 1e-6)
+        logging.info('Verify: %d bytes in %.3f s (%s/s)', length, elapsed, size_fmt(length / elapsed))
+        return length
+
+    def verify_crc(self, start_address, data, block_size = None):
+        """ Verify the memory by the CRC-32 of its blocks computed by the target, only a word per block is read back.
+        The routine helper.CRC32_CODE is written to the free end of RAM and called for every run of blocks,
+        a block with a different CRC is read back to find the first different address, see verify_memory().
+        Only the memory in the address space of the core can be verified, not the external memory behind memory_id.
+        :param start_address: Start address, not used for the Image, optional for S-Record and Hex file
+        :param data: List of bytes, mboot.image.Image or the file to be compared
+        :param block_size: Count of bytes per CRC, default is the sector size
+        :return Count of verified bytes
+        """
+        if block_size is None:
+            try:
+                block_size = self.get_sector_size(0)
+            except McuBootCommandError:
+                block_size = 0x1000
+        start = time.perf_counter()
+        # The helper is kept out of the verified memory, which may be RAM
+        if self._is_bin_file(data):
+            used = [(start_address, start_address + os.path.getsize(data))] if start_address is not None else []
+        else:
+            data = self._verify_image(start_address, data)
+            used = [(address, address + len(segment)) for address, segment in data]
+        code_address = self._get_helper_area(HELPER_AREA_SIZE, used)
+        params_address = code_address + len(CRC32_CODE)
+        max_blocks = (HELPER_AREA_SIZE - len(CRC32_CODE) - CRC32_PARAMS.size) // 4
+        self.write_memory(code_address, CRC32_CODE)
+        length = 0
+        for address, expected in self._verify_chunks(start_address, data, block_size * max_blocks):
+            self.write_memory(params_address, CRC32_PARAMS.pack(address, len(expected), block_size))
+            self._call_helper(code_address, params_address)
+            crcs = crc32_blocks(expected, block_size)
+            read = struct.unpack('<{}I'.format(len(crcs)),
+                                 self.read_memory(params_address + CRC32_PARAMS.size, 4 * len(crcs)))
+            for i in range(len(crcs)):
+                if read[i] != crcs[i]:
+                    offset = i * block_size
+                    logging.info('Verify: CRC of 0x%08X is different, read it back', address + offset)
+                    self.verify_memory(address + offset, expected[offset:offset + block_size])
+                    raise McuBootGenericError('CRC of 0x{:08X} is different, but the data read back is the same'.format(
+                        address + offset))
+            length += len(expected)
+        elapsed = max(time.perf_counter() - start, 1e-6)
+        logging.info('Verify: %d bytes by CRC in %.3f s (%s/s)', length, elapsed, size_fmt(length / elapsed))
+        return length
+
+    def write_compressed(self, start_address, data, buffer_size = 0x2000):
+        """ Write data into RAM compressed, for the slow links. The LZ4 decompressor helper.LZ4_CODE is written to the
+        free end of RAM, then every chunk is sent as a LZ4 block into the staging buffer behind it and decompressed
+        to its address by call(), the chunks which do not compress are written as they are.
+        The bootloader has no flash programming entry for the routine, so the destination must be RAM.
+        :param start_address: Start address, not used for the Image
+        :param data: List of bytes or mboot.image.Image, the helper is uploaded once for all its segments
+        :param buffer_size: Size of the staging buffer of the compressed chunk in RAM
+        :return Count of wrote bytes
+        """
+        image = data if isinstance(data, Image) else Image.from_binary(data, start_address)
+        if len(image) == 0:
+            raise ValueError('Data len is zero')
+        runs = image.runs()
+        code_address = self._get_helper_area(len(LZ4_CODE) + LZ4_PARAMS.size + buffer_size,
+                                             [(address, address + len(run)) for address, run in runs])
+        params_address = code_address + len(LZ4_CODE)
+        self.write_memory(code_address, LZ4_CODE)
+        sent = 0
+        for run_address, run in runs:
+            run = memoryview(run if isinstance(run, (bytes, bytearray, memoryview)) else bytes(run))
+            for offset, length, compressed in plan_compressed(run, buffer_size):
+                address = run_address + offset
+                if compressed is None:
+                    sent += self.write_memory(address, run[offset:offset + length])
+                    continue
+                # The parameters and the block are sent by one command
+                params = LZ4_PARAMS.pack(params_address + LZ4_PARAMS.size, len(compressed), address, 0)
+                self.write_memory(params_address, params + compressed)
+                self._call_helper(code_address, params_address)
+                count = struct.unpack('<I', self.read_memory(params_address + 12, 4))[0]
+                if count != length:
+                    raise McuBootGenericError('Decompressed 0x{:X} bytes at 0x{:08X}, expected 0x{:X}'.format(
+                        count, address, length))
+                sent += len(compressed)
+        logging.info('WriteCompressed: %d bytes sent for %d bytes', sent, len(image))
+        return len(image)
+
+    def _call_helper(self, code_address, params_address):
+        # Unlike call(), the session is kept: the helper only touches its area and the memory it is given
+        logging.info('TX-CMD: Call [ CallAddr=0x%08X | ARG=0x%08X]', code_address | 1, params_address)
+        # The Thumb bit is set, the bootloader calls the address as it is
+        cmd = struct.pack('<4B2I', CommandTag.CALL, 0x00, 0x00, 0x02, code_address | 1, params_address)
+        self._itf_.write_cmd(cmd)
+
+    def _get_helper_area(self, size, used = ()):
+        """ Find size bytes at the end of RAM out of the regions reserved by the bootloader, see helper
+        :param used: List of (start, end) also to be kept out, such as the destination of the data
+        :return Start address
+        """
+        start = self.get_property(PropertyTag.RAM_START_ADDRESS)
+        end = (start + self.get_property(PropertyTag.RAM_SIZE)) & ~3
+        try:
+            self.get_property(PropertyTag.RESERVED_REGIONS)
+            words = _response_words(self.last_property_response)
+            # The end address of the reserved region is inclusive
+            reserved = [(words[i], words[i + 1] + 1) for i in range(0, len(words) - 1, 2) if words[i + 1]]
+        except McuBootCommandError:
+            reserved = []
+        for region_start, region_end in sorted(reserved + list(used), reverse=True):
+            if region_start < end and region_end > end - size:
+                end = region_start & ~3
+        if end - size < start:
+            raise McuBootGenericError('No free RAM for the helper routine')
+        return end - size
+
+    @staticmethod
+    def _is_bin_file(data):
+        return isinstance(data, str) and not data.lower().endswith(('.srec', '.s19', '.hex', '.ihex', '.elf', '.axf', '.out'))
+
+    @staticmethod
+    def _verify_image(start_address, data):
+        if isinstance(data, str):
+            return Image.from_file(data, start_address)
+        return data if isinstance(data, Image) else Image.from_binary(data, start_address)
+
+    @classmethod
+    def _verify_chunks(cls, start_address, data, chunk_size):
+        if cls._is_bin_file(data):
+            if start_address is None:
+                raise McuBootGenericError('Verify a bin file must provide an address.')
+            with open(data, 'rb') as f:
+                for chunk in iter(lambda: f.read(chunk_size), b''):
+                    yield start_address, chunk
+                    start_address += len(chunk)
+            return
+        for address, segment in cls._verify_image(start_address, data):
+            for offset in range(0, len(segment), chunk_size):
+                yield address + offset, segment[offset:offset + chunk_size]
+
     def write_memory(self, start_address, filename, memory_id = 0):
         """ MCUBoot: Write data into MCU memory
         CommandTag: 0x04
@@ -508,14 +980,23 @@ class McuBoot(object):
         if len(data) == 0:
             raise ValueError('Data len is zero')
         logging.info('TX-CMD: WriteMemory [ StartAddr=0x%08X | len=0x%x | memoryId = 0x%X ]', address, len(data), memory_id)
+        in_flash = self._is_flash(memory_id, address, len(data))
+        if in_flash:
+            self._forget_flash(memory_id, address, len(data))
         # Prepare WriteMemory command
         cmd = struct.pack('<4B3I', CommandTag.WRITE_MEMORY, 0x00, 0x00, 0x03, address, len(data), memory_id)
         # get max packet size
         max_packet_size = self.get_property(PropertyTag.MAX_PACKET_SIZE, memory_id)
-        # Process WriteMemory command
-        self._itf_.write_cmd(cmd)
-        # Process Write Data
-        return self._itf_.write_data(data, max_packet_size)
+        def transfer():
+            # Process WriteMemory command
+            self._itf_.write_cmd(cmd)
+            # Process Write Data
+            return self._itf_.write_data(data, max_packet_size)
+        if in_flash:
+            # The programmed flash can not be written again before erase, see write_image() for its retry
+            return transfer()
+        # The retry sends the command and the whole data again
+        return self._retry(transfer, 'WriteMemory')
 
     def fill_memory(self, start_address, length, pattern=0xFFFFFFFF, unit='word'):
         """ MCUBoot: Fill MCU memory with specified pattern
@@ -544,7 +1025,11 @@ class McuBoot(object):
         # Prepare FillMemory command
         cmd = struct.pack('<4B3I', CommandTag.FILL_MEMORY, 0x00, 0x00, 0x03, start_address, length, _pattern)
         # Process FillMemory command
-        self._itf_.write_cmd(cmd)
+        if self._is_flash(0, start_address, length):
+            self._forget_flash(0, start_address, length)
+            self._itf_.write_cmd(cmd)
+        else:
+            self._retry(lambda: self._itf_.write_cmd(cmd), 'FillMemory')
 
     def flash_security_disable(self, backdoor_key):
         """ MCUBoot: Disable flash security by backdoor key
@@ -563,15 +1048,31 @@ class McuBoot(object):
         # Process FlashSecurityDisable command
         self._itf_.write_cmd(cmd)
 
-    def get_property(self, prop_tag, memory_id = 0):
+    def get_property(self, prop_tag, memory_id = 0, cached = True):
         """ MCUBoot: Get value of specified property
         CommandTag: 0x07
         :param prop_tag: The property ID (see Property enumerator)
         :param memory_id: External memory id
+        :param cached: Get the static properties from the session cache, False to read from the target
         :return {dict} with 'RAW' and 'STRING/LIST' value
         """
-        logging.info('TX-CMD: GetProperty->%s [ PropertyTag: %d | memoryId = 0x%X ]', 
-            PropertyTag[prop_tag], PropertyTag[PropertyTag[prop_tag]], memory_id)
+        key = (prop_tag, memory_id)
+        use_cache = cached and self.cache_properties and prop_tag in self.STATIC_PROPERTIES
+        if use_cache and key in self._property_cache:
+            entry = self._property_cache[key]
+            if isinstance(entry, McuBootCommandError):  # Not supported by the target
+                raise McuBootCommandError(errname=entry.errname, errval=entry.errval)
+            raw_value, self.last_property_response = entry
+            # Decode only for the log message
+            if logging.root.isEnabledFor(logging.INFO):
+                logging.info('RX-CMD: %s = %s (cached)', _PROPERTY_NAMES.get(prop_tag), decode_property_value(prop_tag,
+                    raw_value, self.last_property_response, memory_id))
+            return raw_value
+
+        log_info = logging.root.isEnabledFor(logging.INFO)
+        if log_info:
+            logging.info('TX-CMD: GetProperty->%s [ PropertyTag: %d | memoryId = 0x%X ]', 
+                _PROPERTY_NAMES.get(prop_tag), prop_tag, memory_id)
         # Prepare GetProperty command
         # if memory_id is None:
         #     memory_id = 0
@@ -581,12 +1082,162 @@ class McuBoot(object):
         # print(CommandTag.GET_PROPERTY[prop_tag])
         cmd = struct.pack('<4B2I', CommandTag.GET_PROPERTY, 0x00, 0x00, 0x02, prop_tag, memory_id)
         # Process FillMemory command
-        raw_value = self._itf_.write_cmd(cmd)
-
-        logging.info('RX-CMD: %s = %s', PropertyTag[prop_tag], decode_property_value(prop_tag, 
-            raw_value, self._itf_.last_cmd_response, memory_id))
+        try:
+            raw_value = self._retry(lambda: self._itf_.write_cmd(cmd), 'GetProperty')
+        except McuBootCommandError as e:
+            if use_cache:
+                self._property_cache[key] = e
+            raise
+        self.last_property_response = self._itf_.last_cmd_response
+        if use_cache:
+            self._property_cache[key] = (raw_value, self.last_property_response)
+
+        if log_info:
+            logging.info('RX-CMD: %s = %s', _PROPERTY_NAMES.get(prop_tag), decode_property_value(prop_tag, 
+                raw_value, self.last_property_response, memory_id))
         return raw_value
 
+    def _reset_session(self):
+        # The target is reconnected, reset or leaves the bootloader, nothing known about it is valid anymore
+        self.clear_property_cache()
+        self._exmem_config.clear()
+        self._manifests = None
+        self._journal = None
+        self._device_ident = None
+        self._device_stored = None
+        self._flash_range = None
+
+    def clear_property_cache(self, memory_id = None):
+        """ Drop the cached properties
+        :param memory_id: Only drop the properties of the memory, None to drop all
+        """
+        if memory_id is None:
+            self._property_cache.clear()
+        else:
+            for key in [key for key in self._property_cache if key[1] == memory_id]:
+                del self._property_cache[key]
+
+    def load_profile(self):
+        """ Load the properties of the connected device saved by save_profile(), so that only the device identity
+        is read from the target. The profile is keyed by the VID/PID and UNIQUE_DEVICE_IDENT (SYSTEM_DEVICE_IDENT if not supported).
+        :return True if the profile of the device is found
+        """
+        self._profile_key = self._get_profile_key()
+        profile = JsonStore('profiles').get(self._profile_key)
+        if not profile:
+            logging.info('Profile: %s not found', self._profile_key)
+            return False
+        for tag, entry in profile['properties'].items():
+            if 'error' in entry:
+                self._property_cache[(int(tag), 0)] = McuBootCommandError(errname=entry['errname'], errval=entry['error'])
+            else:
+                self._property_cache[(int(tag), 0)] = (entry['raw'], bytes.fromhex(entry['response']))
+        logging.info('Profile: %s loaded', self._profile_key)
+        return True
+
+    def save_profile(self):
+        """ Save the static properties of the connected device cached in this session, see load_profile()
+        The decoded values are saved too, they are the same as get_mcu_info().
+        """
+        key = self._profile_key or self._get_profile_key()
+        store = JsonStore('profiles')
+        profile = store.get(key, {'properties': {}, 'info': {}})
+        for (tag, memory_id), entry in self._property_cache.items():
+            if memory_id:   # The external memories depend on configure_memory
+                continue
+            if isinstance(entry, McuBootCommandError):
+                profile['properties'][str(tag)] = {'error': entry.errval, 'errname': entry.errname}
+            else:
+                raw_value, response = entry
+                profile['properties'][str(tag)] = {'raw': raw_value, 'response': bytes(response).hex()}
+                profile['info'][_PROPERTY_NAMES.get(tag, str(tag))] = decode_property_value(tag, raw_value, response)
+        store.set(key, profile)
+        logging.info('Profile: %s saved', key)
+
+    def _get_profile_key(self):
+        vid, pid = 0, 0
+        if self.current_interface == Interface.USB:
+            vid, pid = self._itf_.vid, self._itf_.pid
+        elif self.adapter:
+            vid, pid = self.adapter[0]
+        ident, _ = self._get_device_ident()
+        return '{}:{:04X}:{:04X}:{}'.format(self.current_interface.name, vid or 0, pid or 0, ident)
+
+    def _get_device_ident(self):
+        # UNIQUE_DEVICE_IDENT if supported, else SYSTEM_DEVICE_IDENT which is the same for all devices of a part.
+        # Read once per session, even if the properties are not cached
+        if self._device_ident is None:
+            try:
+                self.get_property(PropertyTag.UNIQUE_DEVICE_IDENT)
+                self._device_ident = bytes(self.last_property_response[8:]).hex().upper(), True
+            except McuBootCommandError:
+                self._device_ident = '{:08X}'.format(self.get_property(PropertyTag.SYSTEM_DEVICE_IDENT)), False
+        return self._device_ident
+
+    def _get_manifests(self):
+        if self._manifests is None:
+            self._manifests = JsonStore('manifests')
+        return self._manifests
+
+    def _get_journal(self):
+        if self._journal is None:
+            self._journal = JsonStore('journal')
+        return self._journal
+
+    def clear_manifest(self, memory_id = None):
+        """ Drop the manifest of the connected device used by write_delta(), the next write_delta() writes all sectors
+        :param memory_id: Only drop the manifest of the memory, None to drop all
+        """
+        self._forget_flash(memory_id)
+
+    def _forget_flash(self, memory_id = None, start_address = 0, length = None):
+        # The flash is changed out of write_delta(), drop the changed sectors from the manifests of the device.
+        # The journals of the device are dropped too, except the one of the image being written by chunks
+        # The stores are read once per session if they have nothing of the device, not by every erase and write
+        if self._device_stored is False:
+            return
+        store = self._get_manifests()
+        journal = self._get_journal()
+        if not store.exists() and not journal.exists():
+            self._device_stored = False
+            return
+        try:
+            ident, _ = self._get_device_ident()
+        except McuBootCommandError:
+            return
+        stored = []
+
+        def forget_journals(data):
+            keys = [key for key in data if key != self._journal_key and key.split(':')[0] == ident and
+                    (memory_id is None or int(key.split(':')[1], 16) == memory_id)]
+            for key in keys:
+                del data[key]
+            stored.extend(key for key in data if key.split(':')[0] == ident)
+            return bool(keys)
+        journal.modify(forget_journals)
+        if self._writing_delta:
+            return
+
+        def forget_sectors(data):
+            stored.extend(key for key in data if key.rpartition(':')[0] == ident)
+            changed = False
+            for key in list(data):
+                device, _, mem_id = key.rpartition(':')
+                if device != ident or (memory_id is not None and int(mem_id, 16) != memory_id):
+                    continue
+                if length is None:
+                    del data[key]
+                    changed = True
+                    continue
+                sectors = data[key]['sectors']
+                sector_size = data[key]['sector_size']
+                for address in [a for a in sectors if start_address - sector_size < int(a, 16) < start_address + length]:
+                    del sectors[address]
+                    changed = True
+            return changed
+        store.modify(forget_sectors)
+        self._device_stored = bool(stored)
+
     def set_property(self, prop_tag, value, memory_id = 0):
         """ MCUBoot: Set value of specified property
         CommandTag: 0x0C
@@ -594,11 +1245,13 @@ class McuBoot(object):
         :param  value: The value of selected property
         :param memory_id: External memory id
         """
-        logging.info('TX-CMD: SetProperty->%s = %d [ memoryId = 0x%X ]', PropertyTag[prop_tag], value, memory_id)
+        logging.info('TX-CMD: SetProperty->%s = %d [ memoryId = 0x%X ]', _PROPERTY_NAMES.get(prop_tag), value, memory_id)
         # Prepare SetProperty command
         cmd = struct.pack('<4B3I', CommandTag.SET_PROPERTY, 0x00, 0x00, 0x02, prop_tag, value, memory_id)
+        # Setting a property may change the others
+        self.clear_property_cache()
         # Process SetProperty command
-        self._itf_.write_cmd(cmd)
+        self._retry(lambda: self._itf_.write_cmd(cmd), 'SetProperty')
 
     def receive_sb_file(self, filename):
         """ MCUBoot: Receive SB file
@@ -615,6 +1268,9 @@ class McuBoot(object):
         cmd = struct.pack('<4BI', CommandTag.RECEIVE_SB_FILE, 0x01, 0x00, 0x01, len(data))
         # get max packet size
         max_packet_size = self.get_property(PropertyTag.MAX_PACKET_SIZE)
+        # The SB file can write any memory, configure memories and change properties
+        self._forget_flash()
+        self._reset_session()
         # Process WriteMemory command
         self._itf_.write_cmd(cmd)
         # Process Write Data
@@ -631,6 +1287,7 @@ class McuBoot(object):
                      sp_address)
         # Prepare Execute command
         cmd = struct.pack('<4B3I', CommandTag.EXECUTE, 0x00, 0x00, 0x03, jump_address, argument, sp_address)
+        self._reset_session()
         # Process Execute command
         self._itf_.write_cmd(cmd)
 
@@ -643,6 +1300,7 @@ class McuBoot(object):
         logging.info('TX-CMD: Call [ CallAddr=0x%08X | ARG=0x%08X]', call_address, argument)
         # Prepare Call command
         cmd = struct.pack('<4B2I', CommandTag.CALL, 0x00, 0x00, 0x02, call_address, argument)
+        self._reset_session()
         # Process Call command
         self._itf_.write_cmd(cmd)
 
@@ -653,11 +1311,15 @@ class McuBoot(object):
         logging.info('TX-CMD: Reset MCU')
         # Prepare Reset command
         cmd = struct.pack('4B', CommandTag.RESET, 0x00, 0x00, 0x00)
+        self._reset_session()
         # Process Reset command
         try:
             self._itf_.write_cmd(cmd)
         except:
             pass
+        # The IRQ notifier pin is disabled after reset
+        if self.current_interface in (Interface.SPI, Interface.I2C):
+            self._itf_.set_irq_pin(None)
         # else:
         #     if hasattr(self._itf_, 'set_handler'):
         #         self._itf_.set_handler(None)
@@ -690,6 +1352,7 @@ class McuBoot(object):
         CommandTag: 0x0D
         """
         logging.info('TX-CMD: FlashEraseAllUnsecure')
+        self._forget_flash(0)
         # Prepare FlashEraseAllUnsecure command
         cmd = struct.pack('4B', CommandTag.FLASH_ERASE_ALL_UNSECURE, 0x00, 0x00, 0x00)
         # Process FlashEraseAllUnsecure command
@@ -811,7 +1474,7 @@ class McuBoot(object):
         # Process Read Data
         data = self._itf_.read_data(length)
         if filename:
-            write_file(filename, data)
+            write_file(filename, data, start_address)
             logging.info("Successfully saved into: {}".format(filename))
         return data
 
@@ -824,8 +1487,11 @@ class McuBoot(object):
         logging.info('TX-CMD: ConfigureMemory [ memoryId=0x%08X | Address=0x%08X ]', memory_id, address)
         # Prepare ConfigureMemory command
         cmd = struct.pack('<4B2I', CommandTag.CONFIGURE_MEMORY, 0x00, 0x00, 0x02, memory_id, address)
+        # The attributes of the memory are changed by the configuration
+        self.clear_property_cache(memory_id)
+        self._exmem_config.pop(memory_id, None)
         # Process ConfigureMemory command
-        raw_value = self._itf_.write_cmd(cmd)
+        raw_value = self._retry(lambda: self._itf_.write_cmd(cmd), 'ConfigureMemory')
 
     def reliable_update(self, address):
         '''Checks the validity of backup application at <addr>, then copies the contents of 
@@ -995,35 +1661,216 @@ class McuBoot(object):
     def flash_image(self, filename, erase='none', memory_id=0):
         '''Write the formatted image in <file> to the memory specified by memoryID.
         CommandTag: 0x16
-        :param filename: The file to be written, supported file types are S-Record (.srec and .s19), and Hex (.hex)
-        :param erase: Whether to erase before writing, there are two values ​​of 'erase' and 'none', and numbers are not supported.
+        :param filename: The file to be written, supported file types are S-Record (.srec and .s19), Hex (.hex)
+                         and ELF (.elf, .axf and .out, the loadable segments at their physical addresses)
+        :param erase: Whether to erase before writing, 'erase', 'none' or 'delta' to write only the changed sectors
+                      (see write_delta()), numbers are not supported.
         :param memory_id: External memory id
         '''
         if isinstance(erase, int):
             memory_id = erase
-            erase = False
+            erase = 'none'
 
-        data, address = read_file(filename, None)
-        data_len = len(data)
-        if data_len == 0:
+        image = Image.from_file(filename)
+        if len(image) == 0:
             raise ValueError('Data len is zero')
-
-        if erase == 'erase':
-            sector_size = self.get_property(PropertyTag.FLASH_SECTOR_SIZE, memory_id)
-            erase_len = Flash.align_up(data_len, sector_size)
-            self.flash_erase_region(address, erase_len, memory_id)
-        elif erase == 'none':
-            pass
-        else:
+        if erase not in ('erase', 'none', 'delta'):
             raise McuBootGenericError('invalid arguments: {}'.format(erase))
 
-        logging.info('TX-CMD: FlashImage [ filename=%s -> 0x%08X | erase=%s | memoryId = 0x%X ]', filename, address, erase, memory_id)
-        # Prepare WriteMemory command
-        cmd = struct.pack('<4B3I', CommandTag.WRITE_MEMORY, 0x00, 0x00, 0x03, address, data_len, memory_id)
-        # get max packet size
-        max_packet_size = self.get_property(PropertyTag.MAX_PACKET_SIZE, memory_id)
-        # Process WriteMemory command
-        self._itf_.write_cmd(cmd)
-        # Process Write Data
-        return self._itf_.write_data(data, max_packet_size)
+        logging.info('TX-CMD: FlashImage [ filename=%s -> 0x%08X | erase=%s | memoryId = 0x%X ]', filename,
+            image.minimum_address, erase, memory_id)
+        if erase == 'delta':
+            return self.write_delta(None, image, memory_id)
+        return self.write_image(image, memory_id, erase == 'erase')
 
+    def write_image(self, image, memory_id = 0, erase = True, skip_length = 0x100, fill_length = 0x40, chunk_size = 0):
+        """ Write the segments of the image, only the sectors touched by the segments are erased
+        and the gaps between them are not sent.
+        :param image: mboot.image.Image
+        :param memory_id: External memory id
+        :param erase: Erase the sectors before writing, a run failed by a transient error is erased and written again
+        :param skip_length: After erase, the runs of 0xFF at least skip_length bytes long are not sent, 0 to send them
+        :param fill_length: The runs of a repeating pattern at least fill_length bytes long are written by fill_memory(),
+                            0 to send them, only for the memory_id 0 (fill_memory() has no memory id)
+        :param chunk_size: Erase and write the image by the sector aligned chunks, the written chunks are recorded
+                           in a journal, so that the write of the same image to the device resumes from the last good
+                           chunk after a failure, 0 to write all at once. Without UNIQUE_DEVICE_IDENT the done
+                           chunks are read back before they are skipped
+        :return Count of wrote bytes
+        """
+        if chunk_size:
+            return self._write_image_chunks(image, memory_id, erase, skip_length, fill_length, chunk_size)
+        gap = 0
+        align = 4
+        if erase or any(self._is_flash(memory_id, address, len(data)) for address, data in image):
+            # The flash is programmed by units, a part written by another command must not share one
+            align = max(self.get_program_unit(memory_id), 4)
+        if erase:
+            regions = self.flash_erase_blocks(image.blocks(), memory_id)
+            # A gap shorter than a sector lies in the erased sectors of its segments,
+            # sending a short one is cheaper than another WriteMemory command
+            gap = min((region.sector_size for region in regions), default=1) - 1
+            if skip_length:
+                image = image.split(0xFF, skip_length, align)
+                gap = min(gap, skip_length - 1)
+        if fill_length and not memory_id:
+            gap = min(gap, fill_length - 1)
+        runs = image.runs(gap)
+        if not erase:
+            return sum(self._write_run(address, data, memory_id, erase, fill_length, align) for address, data in runs)
+        # The runs sharing a sector are retried together, see _write_erased()
+        sector_size = max((region.sector_size for region in regions), default=1)
+        groups = []
+        for address, data in runs:
+            start = address - address % sector_size
+            end = Flash.align_up(address + len(data), sector_size)
+            if groups and start < groups[-1][1]:
+                groups[-1][1] = max(groups[-1][1], end)
+                groups[-1][2].append((address, data))
+            else:
+                groups.append([start, end, [(address, data)]])
+        return sum(self._write_erased(start, end, group, memory_id, fill_length, align) for start, end, group in groups)
+
+    def _write_run(self, address, data, memory_id, erase, fill_length, align):
+        if memory_id or not fill_length:
+            return self.write_memory(address, data, memory_id)
+        wrote = 0
+        for part_address, part, pattern in plan_fill(address, data, fill_length, align):
+            if pattern is None:
+                wrote += self.write_memory(part_address, part, memory_id)
+                continue
+            if not (erase and pattern == 0xFFFFFFFF):   # The erased flash needs no fill
+                self.fill_memory(part_address, len(part), pattern)
+            wrote += len(part)
+        return wrote
+
+    def _write_erased(self, start, end, runs, memory_id, fill_length, align):
+        # A transient error leaves the sectors half programmed, they are erased again before the runs are sent again
+        attempts = []
+        def write():
+            if attempts:
+                logging.info('WriteImage: erase 0x%08X - 0x%08X again', start, end)
+                self.flash_erase_blocks([(start, end)], memory_id)
+            attempts.append(start)
+            return sum(self._write_run(address, data, memory_id, True, fill_length, align) for address, data in runs)
+        return self._retry(write, 'WriteImage')
+
+    def _write_image_chunks(self, image, memory_id, erase, skip_length, fill_length, chunk_size):
+        if erase:
+            sector_size = self.get_sector_size(memory_id)
+            chunk_size = (chunk_size + sector_size - 1) // sector_size * sector_size
+        ident, unique = self._get_device_ident()
+        key = '{}:{:X}:{}'.format(ident, memory_id, image.digest())
+        journal = self._get_journal()
+        done = set(journal.reload().get(key, []))
+        if done:
+            logging.info('Journal: resume the write, %d chunks are done', len(done))
+        wrote = 0
+        self._journal_key = key
+        try:
+            for address, chunk in image.chunks(chunk_size):
+                if '{:08X}'.format(address) in done:
+                    if unique:
+                        continue
+                    # All devices of the part share the journal, the chunk may be done on another one
+                    try:
+                        self.verify_memory(None, chunk, memory_id)
+                        continue
+                    except McuBootVerifyError as e:
+                        logging.info('Journal: %s, write the chunk again', e)
+                wrote += self.write_image(chunk, memory_id, erase, skip_length, fill_length)
+                done.add('{:08X}'.format(address))
+                journal.set(key, sorted(done))
+                self._device_stored = True
+        finally:
+            self._journal_key = None
+        journal.delete(key)
+        return wrote
+
+    def write_delta(self, start_address, data, memory_id = 0, spot_check = 0):
+        """ Write data into flash, only the sectors changed since the last write_delta() are erased and written.
+        The hashes of the written sectors are kept in a manifest per device identity and memory id, the flash erased
+        or written by the other commands of McuBoot is dropped from it. The changes made by others (the application,
+        another tool) are not seen, use spot_check or clear_manifest() if it is possible.
+        Only the sectors touched by the data are compared, the gaps between the segments of the Image are kept.
+        :param start_address: Start address, not used for the Image
+        :param data: List of bytes or mboot.image.Image
+        :param memory_id: External memory id
+        :param spot_check: Count of unchanged sectors to be read back and compared, they are picked at random
+        :return Count of wrote bytes
+        """
+        # A mapped file is hashed and sent by slices, see tool.map_file()
+        image = data if isinstance(data, Image) else Image.from_binary(memoryview(
+            data if isinstance(data, (bytes, bytearray, memoryview)) else bytes(data)), start_address)
+        if len(image) == 0:
+            raise ValueError('Data len is zero')
+        sector_size = self.get_sector_size(memory_id)
+        ident, unique = self._get_device_ident()
+        if not unique and not spot_check:
+            # All devices of the part share the manifest, check that it is the same device
+            logging.warning('UNIQUE_DEVICE_IDENT is not supported, check one sector of the manifest')
+            spot_check = 1
+        store = self._get_manifests()
+        key = '{}:{:X}'.format(ident, memory_id)
+        manifest = store.reload().get(key)
+        sectors = manifest['sectors'] if manifest and manifest['sector_size'] == sector_size else {}
+
+        def update_sectors(hashes):
+            # Only the sectors of this write are changed, the file may be changed by another session meanwhile
+            def change(data):
+                manifest = data.get(key)
+                if manifest is None or manifest['sector_size'] != sector_size:
+                    manifest = data[key] = {'sector_size': sector_size, 'sectors': {}}
+                for address, value in hashes.items():
+                    if value is None:
+                        manifest['sectors'].pop(address, None)
+                    else:
+                        manifest['sectors'][address] = value
+            store.modify(change)
+            self._device_stored = True
+
+        # The runs do not share a sector, the head of every run is padded to its sector with the erased value
+        runs = []
+        for address, run in image.runs(sector_size - 1):
+            head = address % sector_size
+            runs.append((address - head, memoryview(b'\xFF' * head + bytes(run) if head else run)))
+        # The sectors are erased before writing, so the bytes out of data will be 0xFF
+        def sector(run, offset):
+            part = run[offset:offset + sector_size]
+            return part if len(part) == sector_size else bytes(part) + b'\xFF' * (sector_size - len(part))
+        blocks = [(address + offset, run, offset) for address, run in runs for offset in range(0, len(run), sector_size)]
+        hashes = [hashlib.sha1(sector(run, offset)).hexdigest() for _, run, offset in blocks]
+        changed = [sectors.get('{:08X}'.format(address)) != h for (address, _, _), h in zip(blocks, hashes)]
+        unchanged = [i for i, c in enumerate(changed) if not c]
+        for i in random.sample(unchanged, min(spot_check, len(unchanged))):
+            address, run, offset = blocks[i]
+            if bytes(self.read_memory(address, sector_size, memory_id=memory_id)) != sector(run, offset):
+                logging.warning('Sector 0x%08X is different from the manifest', address)
+                changed[i] = True
+        logging.info('Delta: %d of %d sectors changed', changed.count(True), len(changed))
+
+        wrote = 0
+        self._writing_delta = True
+        try:
+            i = 0
+            while i < len(changed):
+                if not changed[i]:
+                    i += 1
+                    continue
+                address, run, offset = blocks[i]
+                end = i
+                while end < len(changed) and changed[end] and blocks[end][1] is run:
+                    end += 1
+                # Erase and write the run of changed sectors at once
+                length = (end - i) * sector_size
+                update_sectors({'{:08X}'.format(blocks[n][0]): None for n in range(i, end)})
+                def write(address=address, part=run[offset:offset + length], length=length):
+                    # The retry erases the sectors again
+                    self.flash_erase_region(address, length, memory_id)
+                    return self.write_memory(address, part, memory_id)
+                wrote += self._retry(write, 'WriteDelta')
+                update_sectors({'{:08X}'.format(blocks[n][0]): hashes[n] for n in range(i, end)})
+                i = end
+        finally:
+            self._writing_delta = False
+        return wrote
@@ -1,4 +1,4 @@
-import collections
+import collections.abc
 
 class MemoryBlock(object):
     def __init__(self, start, end=None, length=None):
@@ -11,7 +11,7 @@ class MemoryBlock(object):
         
     @classmethod
     def from_sequence(cls, sequence):
-        if isinstance(sequence, collections.Sequence):
+        if isinstance(sequence, collections.abc.Sequence):
             try:    # input may be is an str
                 start, end = sequence
             except ValueError as e:
@@ -36,7 +36,7 @@ class MemoryBlock(object):
         return other.start == self.start and other.end == self.end
 
     def __contains__(self, other):
-        if isinstance(other, collections.Sequence):
+        if isinstance(other, collections.abc.Sequence):
             _other = self.from_sequence(other)
         elif isinstance(other, MemoryBlock):
             _other = other  # prevent rewriting other
@@ -49,7 +49,7 @@ class MemoryBlock(object):
     def __sub__(self, other):
         """
         """
-        if isinstance(other, collections.Sequence):
+        if isinstance(other, collections.abc.Sequence):
             _other = self.from_sequence(other)
         elif isinstance(other, self.__class__):
             _other = other  # prevent rewriting other
@@ -87,6 +87,45 @@ class Flash(MemoryBlock):
     def align_down(number, base):
         return (number & (~(base-1)))
 
+def plan_erase(blocks, sector_size, banks=()):
+    """ Plan the erase of the blocks to be written, the minimal list of regions aligned to the sectors
+    :param blocks: List of MemoryBlock or (start, end) to be written
+    :param sector_size: Size of the sector
+    :param banks: List of Flash, the region does not cross a bank and uses its sector_size
+    :return Sorted list of Flash
+    """
+    regions = []
+    for block in blocks:
+        if not isinstance(block, MemoryBlock):
+            block = MemoryBlock.from_sequence(block)
+        if not block.length:
+            continue
+        pieces = []
+        address = block.start
+        for bank in sorted(banks, key=lambda bank: bank.start):
+            start, end = max(address, bank.start), min(block.end, bank.end)
+            if start < end:
+                if address < start:     # Out of the banks
+                    pieces.append((address, start, None))
+                pieces.append((start, end, bank))
+                address = end
+        if address < block.end:
+            pieces.append((address, block.end, None))
+        for start, end, bank in pieces:
+            size = bank.sector_size if bank else sector_size
+            start, end = Flash.align_down(start, size), Flash.align_up(end, size)
+            if bank:
+                start, end = max(start, bank.start), min(end, bank.end)
+            regions.append((start, end, size, bank))
+
+    plan = []
+    for start, end, size, bank in sorted(regions, key=lambda region: region[0]):
+        if plan and plan[-1][3] is bank and start <= plan[-1][1]:
+            plan[-1][1] = max(plan[-1][1], end)
+        else:
+            plan.append([start, end, size, bank])
+    return [Flash(start, end, sector_size=size) for start, end, size, _ in plan]
+
 if __name__ == "__main__":
     x = MemoryBlock(*[0,100])
 
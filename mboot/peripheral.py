@@ -4,6 +4,7 @@ import serial.tools.list_ports
 from .usb import RawHID
 from .exception import McuBootGenericError, McuBootConnectionError
 from .ftditool import UsbTools
+from .store import JsonStore
 # DEVICES = {
 #     # NAME   | VID   | PID
 #     'MKL27': (0x15A2, 0x0073),
@@ -52,6 +53,36 @@ peripheral_speed = {
     'can'   : 500
 }
 
+# The clock steps tried by McuBoot.calibrate_speed(), from slow to fast
+peripheral_speed_steps = {
+    'i2c'   : (100000, 200000, 400000, 600000, 800000, 1000000),
+    'spi'   : (1000000, 2000000, 4000000, 6000000, 8000000, 10000000, 12000000, 15000000, 20000000, 30000000)
+}
+
+def adapter_key(peripheral, vid_pid, index=1):
+    vid, pid = vid_pid if vid_pid else (None, None)
+    return '{}:{:04X}:{:04X}:{}'.format(peripheral.lower(), vid or 0, pid or 0, index or 1)
+
+def get_calibrated_speed(peripheral, vid_pid, index=1, target=None):
+    """ Get the fastest reliable speed recorded by McuBoot.calibrate_speed()
+    :param peripheral: 'spi' or 'i2c'
+    :param vid_pid: (vid, pid) of the adapter
+    :param index: Index of the adapter with the same vid, pid
+    :param target: SYSTEM_DEVICE_IDENT of the target, None means unknown target, use the slowest record of the adapter
+    :return The speed or None if the adapter has not been calibrated
+    """
+    records = JsonStore('speed').get(adapter_key(peripheral, vid_pid, index), {})
+    if target is None:
+        return min(records.values()) if records else None
+    return records.get('0x{:08X}'.format(target))
+
+def save_calibrated_speed(peripheral, vid_pid, index, target, speed):
+    store = JsonStore('speed')
+    key = adapter_key(peripheral, vid_pid, index)
+    records = store.get(key, {})
+    records['0x{:08X}'.format(target)] = speed
+    store.set(key, records)
+
 def parse_port(peripheral, arg):
     port = arg.lower()
     if port.startswith('com') or port.startswith('/dev/'):
@@ -85,9 +116,13 @@ def parse_peripheral(peripheral, args, auto_scan=True):
     if args_len == 2:
         port, speed = args
         port = parse_port(peripheral, port)
+        if isinstance(speed, str) and speed.lower() == 'auto':
+            speed = 'auto'
     elif args_len == 1:
         if args[0].isdigit():
             speed = int(args[0], 0)
+        elif args[0].lower() == 'auto':  # Use the speed recorded by calibration
+            speed = 'auto'
         else:
             port = parse_port(peripheral, args[0])
     elif args_len > 2:
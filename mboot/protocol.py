@@ -5,7 +5,7 @@ import logging
 
 from .tool import atos, crc16
 from .enums import CommandTag, PropertyTag, StatusCode
-from .exception import McuBootCommandError, McuBootDataError, McuBootConnectionError, McuBootTimeOutError
+from .exception import McuBootGenericError, McuBootCommandError, McuBootDataError, McuBootConnectionError, McuBootTimeOutError
 
 class ProtocolMixin(object):
     '''This mixed-in class provides some methods about the protocol part for external calls.
@@ -34,6 +34,8 @@ class ProtocolMixin(object):
         return status, propertyValue
 
 class UartProtocolMixin(ProtocolMixin):
+    # Count of resends of a data frame not acknowledged (NACK) by the target
+    NACK_RETRIES = 3
 
     @staticmethod
     def _gen_crc(head, payload):
@@ -56,18 +58,56 @@ class UartProtocolMixin(ProtocolMixin):
         _, _packet_type, payload_len, crc = struct.unpack('<2B2H', head)
         return _packet_type, crc
 
+    @staticmethod
+    def check_crc(data, crc):
+        '''Validate the CRC of the received packet
+        :param data: The data covered by the CRC, framing header without CRC + payload, or the ping response without CRC
+        :param crc: The CRC in the received packet
+        '''
+        if crc16(data) != crc:
+            logging.debug('RX: %s', StatusCode.desc(StatusCode.INVALID_CRC))
+            raise McuBootDataError(mode='read', errname=StatusCode.desc(StatusCode.INVALID_CRC), errval=StatusCode.INVALID_CRC)
+
+    @staticmethod
+    def check_packet_type(packet_type, *expected):
+        '''Validate the type of the received framing packet
+        :param packet_type: The packet type in the received packet
+        :param expected: The allowed packet types
+        '''
+        if packet_type not in expected:
+            logging.debug('RX: %s 0x%X', StatusCode.desc(StatusCode.INVALID_PACKET_TYPE), packet_type)
+            raise McuBootDataError(mode='read', errname=StatusCode.desc(StatusCode.INVALID_PACKET_TYPE),
+                errval=StatusCode.INVALID_PACKET_TYPE)
+
+    def check_packet(self, head, payload):
+        '''Validate the CRC of the received framing packet
+        :param head: framing packet header
+        :param payload: payload in the current packet
+        '''
+        _packet_type, crc = self.parse_framing(head)
+        self.check_crc(head[:4] + payload, crc)
+
+    def _read_response(self, **kwargs):
+        try:
+            return self.read(FPType.CMD, **kwargs)
+        except McuBootGenericError:
+            raise
+        except (struct.error, IndexError):  # The response is shorter than the framing
+            logging.debug('RX-CMD: %s no response', self.__class__.__name__)
+            raise McuBootTimeOutError('{} no response'.format(self.__class__.__name__))
+        except Exception as e:
+            logging.info('RX-CMD: %s Disconnected', self.__class__.__name__)
+            raise McuBootConnectionError('{} Disconnected: {}'.format(self.__class__.__name__, e))
+
     def read_cmd(self, **kwargs):
         '''Receive the command packet (only need to receive the packet when an error occurs)
         Implemented but not called, The process is implemented in read_data, write_data
         '''
-        try:
-            head, rxpkg = self.read(FPType.CMD, **kwargs)
-        except:
-            logging.info('RX-CMD: %s Disconnected', self.__class__.__name__)
-            raise McuBootTimeOutError('%s Disconnected', self.__class__.__name__)
+        head, rxpkg = self._read_response(**kwargs)
         
         # log RX raw command data
         logging.debug('RX-CMD [%02d]: %s', len(rxpkg), atos(rxpkg))
+        self.check_packet(head, rxpkg)
 
         # Parse and validate status flag
         status, value = self.parse_response_payload(rxpkg)
@@ -93,14 +133,11 @@ class UartProtocolMixin(ProtocolMixin):
         logging.debug('TX-CMD [%02d]: %s', len(data), atos(data))
 
         self.write(FPType.CMD, data, timeout = timeout)
-        try:
-            head, rxpkg = self.read(FPType.CMD, **kwargs)
-        except:
-            logging.debug('RX-CMD: %s Disconnected', self.__class__.__name__)
-            raise McuBootTimeOutError('%s Disconnected', self.__class__.__name__)
+        head, rxpkg = self._read_response(**kwargs)
 
         # log RX raw command data
         logging.debug('RX-CMD [%02d]: %s', len(rxpkg), atos(rxpkg))
+        self.check_packet(head, rxpkg)
         self.last_cmd_response = rxpkg
 
         # Parse and validate status flag
@@ -122,6 +159,7 @@ class UartProtocolMixin(ProtocolMixin):
         while n < length:
             head, pkg = self.read(FPType.DATA, locate = n)
             _packet_type, crc = self.parse_framing(head)
+            self.check_crc(head[:4] + pkg, crc)
             
             '''Slave interrupt in read data
             Parse the package and throw the appropriate error'''
@@ -140,6 +178,7 @@ class UartProtocolMixin(ProtocolMixin):
             data.extend(pkg)
             n += len(pkg)
         head, pkg = self.read(FPType.CMD)
+        self.check_packet(head, pkg)
         self.last_cmd_response = pkg
 
         # Parse and validate status flag
@@ -156,6 +195,20 @@ class UartProtocolMixin(ProtocolMixin):
         logging.info('RX-DATA: Successfully Received %d Bytes', len(data))
         return data
 
+    def _write_frame(self, data_packet, locate):
+        for retry in range(self.NACK_RETRIES + 1):
+            try:
+                self.write(FPType.DATA, data_packet, locate = locate)
+                return True
+            except McuBootDataError as e:
+                if getattr(e, 'nack', False) and retry < self.NACK_RETRIES:
+                    logging.info('TX-DATA: Frame [0x%X] is not acknowledged, resend it', locate)
+                    continue
+                '''There may be a problem with the write, the slave aborts receiving the data, 
+                and the master aborts the write and receives the error message.'''
+                logging.error(e)
+                return False
+
     def write_data(self, data, max_packet_size=0x20):
         n = len(data)
         start = 0
@@ -163,16 +216,12 @@ class UartProtocolMixin(ProtocolMixin):
         while n > 0:
             end = start + max_packet_size
             data_packet = self.genPacket(FPType.DATA, data[start:end])
-            try:
-                '''There may be a problem with the write, the slave aborts receiving the data, 
-                and the master aborts the write and receives the error message.'''
-                self.write(FPType.DATA, data_packet, locate = start)
-            except McuBootDataError as e:
-                logging.error(e)
+            if not self._write_frame(data_packet, start):
                 break
             start = end
             n -= max_packet_size
         head, pkg = self.read(FPType.CMD)
+        self.check_packet(head, pkg)
         self.last_cmd_response = pkg
 
         status, value = self.parse_response_payload(pkg)
@@ -305,9 +354,11 @@ class UsbProtocolMixin(ProtocolMixin):
         # Read USB-HID CMD IN Report
         try:
             rep_id, rx_payload = self.read(timeout)
-        except:
+        except McuBootGenericError:
+            raise
+        except Exception as e:
             logging.info('RX-CMD: USB Disconnected')
-            raise McuBootTimeOutError('USB Disconnected')
+            raise McuBootTimeOutError('USB Disconnected: {}'.format(e))
 
         # log RX raw command data
         logging.debug('RX-CMD [%02d]: %s', len(rx_payload), atos(rx_payload))
@@ -343,9 +394,11 @@ class UsbProtocolMixin(ProtocolMixin):
             # Read USB-HID DATA IN Report
             try:
                 rep_id, rx_payload = self.read(timeout, locate = n) # note: The length of rx_payload is not necessarily 32 bits
-            except:
+            except McuBootGenericError:
+                raise
+            except Exception as e:
                 logging.info('RX-DATA: USB Disconnected')
-                raise McuBootTimeOutError('USB Disconnected')
+                raise McuBootTimeOutError('USB Disconnected: {}'.format(e))
 
             # if rep_id != HID_REPORT['DATA_IN']:
             #     status, value = self.parse_response_payload(rx_payload)
@@ -370,9 +423,11 @@ class UsbProtocolMixin(ProtocolMixin):
         # Read USB-HID CMD IN Report
         try:
             rep_id, rx_payload = self.read(timeout)
-        except:
+        except McuBootGenericError:
+            raise
+        except Exception as e:
             logging.info('RX-DATA: USB Disconnected')
-            raise McuBootTimeOutError('USB Disconnected')
+            raise McuBootTimeOutError('USB Disconnected: {}'.format(e))
         
         self.last_cmd_response = rx_payload
 
@@ -419,9 +474,11 @@ class UsbProtocolMixin(ProtocolMixin):
             #     return
         try:
             rep_id, rx_payload = self.read()
-        except:
+        except McuBootGenericError:
+            raise
+        except Exception as e:
             logging.info('TX-DATA: USB Disconnected')
-            raise McuBootTimeOutError('USB Disconnected')
+            raise McuBootTimeOutError('USB Disconnected: {}'.format(e))
 
         self.last_cmd_response = rx_payload
 
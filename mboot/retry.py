@@ -0,0 +1,55 @@
+import time
+import logging
+
+from .enums import StatusCode
+from .exception import McuBootGenericError, McuBootDataError, McuBootTimeOutError
+
+class RetryPolicy(object):
+    """ Retry the bootloader operations failed by a transient error, such as a glitch on the bus
+    :param attempts: Count of attempts, 1 to disable the retry
+    :param backoff: Delay in seconds before the first retry, doubled for each next one
+    :param max_backoff: Upper bound of the delay
+    :param transient: Status codes treated as transient in addition to TRANSIENT_STATUS
+    """
+    # Errors of the link, the same operation may pass when it is sent again.
+    # The others (flash driver, security, invalid argument...) fail again, they are fatal.
+    TRANSIENT_STATUS = frozenset((
+        StatusCode.TIMEOUT, StatusCode.INVALID_CRC, StatusCode.INVALID_PACKET_TYPE, StatusCode.PING_ERROR,
+        StatusCode.NO_RESPONSE, StatusCode.I2C_SLAVE_TX_UNDERRUN, StatusCode.I2C_SLAVE_RX_OVERRUN,
+        StatusCode.I2C_ARBITRATION_LOST, StatusCode.SPI_SLAVE_TX_UNDERRUN, StatusCode.SPI_SLAVE_RX_OVERRUN
+    ))
+
+    def __init__(self, attempts=3, backoff=0.01, max_backoff=0.5, transient=()):
+        self.attempts = max(attempts, 1)
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.transient = self.TRANSIENT_STATUS.union(transient)
+
+    def is_transient(self, error):
+        if isinstance(error, McuBootTimeOutError):
+            return True
+        errval = getattr(error, 'errval', None)
+        if errval is None:
+            # Data phase broken by the framing, such as a not acknowledged frame
+            return isinstance(error, McuBootDataError)
+        return errval in self.transient
+
+    def run(self, operation, resync=None, name='Operation'):
+        """ Run the operation, retry it on transient error
+        :param operation: Callable without arguments
+        :param resync: Callable to restore the framing before the retry
+        :param name: Name of the operation for the log
+        :return Return value of the operation
+        """
+        delay = self.backoff
+        for attempt in range(1, self.attempts + 1):
+            try:
+                return operation()
+            except McuBootGenericError as e:
+                if attempt == self.attempts or not self.is_transient(e):
+                    raise
+                logging.warning('%s failed (%s), retry %d/%d', name, e, attempt, self.attempts - 1)
+            time.sleep(delay)
+            delay = min(delay * 2, self.max_backoff)
+            if resync:
+                resync()
@@ -0,0 +1,80 @@
+import logging
+import threading
+
+from .mboot import McuBoot
+from .exception import McuBootConnectionError
+
+class Session(object):
+    """ A McuBoot session run by the Scheduler
+    :param job: Callable that receives the opened McuBoot and does the work, its return value is kept in result
+    :param peripheral: 'usb', 'uart', 'spi' or 'i2c', selects McuBoot.open_<peripheral>()
+    :param args: Arguments of McuBoot.open_<peripheral>()
+    :param kwargs: Keyword arguments of McuBoot.open_<peripheral>()
+    """
+    def __init__(self, job, peripheral, args=(), kwargs=None):
+        self.job = job
+        self.peripheral = peripheral.lower()
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.result = None
+        self.error = None
+
+    def __str__(self):
+        args = [repr(arg) for arg in self.args] + ['{}={!r}'.format(k, v) for k, v in sorted(self.kwargs.items())]
+        return '{}({})'.format(self.peripheral.upper(), ', '.join(args))
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def run(self):
+        mb = McuBoot()
+        try:
+            if not getattr(mb, 'open_' + self.peripheral)(*self.args, **self.kwargs):
+                raise McuBootConnectionError('Open {} failed'.format(self))
+            self.result = self.job(mb)
+        except Exception as e:
+            logging.error('%s: %s', self, e)
+            self.error = e
+        finally:
+            try:
+                mb.close()
+            except Exception as e:
+                logging.debug('%s: %s', self, e)
+
+class Scheduler(object):
+    """ Run independent McuBoot sessions concurrently, one thread per session.
+    Each session must use its own channel, such as an interface of FT2232H/FT4232H (MPSSE is only available on
+    interface 1, 2, the interface 3, 4 of FT4232H can be used as UART), another FTDI adapter or a serial port.
+
+    Example:
+    >>> scheduler = Scheduler()
+    >>> for interface in (1, 2):
+    ...     scheduler.add(lambda mb: mb.write_memory(0, 'app.bin'), 'spi', (0x0403, 0x6010), interface=interface)
+    >>> for session in scheduler.run():
+    ...     print(session, 'OK' if session.ok else session.error)
+    """
+    def __init__(self):
+        self.sessions = []
+
+    def add(self, job, peripheral, *args, **kwargs):
+        """ Add a session
+        :param job: Callable that receives the opened McuBoot
+        :param peripheral: 'usb', 'uart', 'spi' or 'i2c'
+        :param args, kwargs: Arguments of McuBoot.open_<peripheral>()
+        :return The session
+        """
+        session = Session(job, peripheral, args, kwargs)
+        self.sessions.append(session)
+        return session
+
+    def run(self):
+        """ Run all sessions concurrently and wait for them to complete
+        :return List of sessions, check session.ok, session.result and session.error
+        """
+        threads = [threading.Thread(target=session.run, name=str(session)) for session in self.sessions]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return self.sessions
@@ -6,33 +6,62 @@ from .tool import atos
 from .protocol import FPType, UartProtocolMixin
 from .exception import McuBootDataError, McuBootTimeOutError
 from .enums import StatusCode
-from .ftditool import SpiController
+from .ftditool import SpiController, IrqNotifier, ControllerPool
 
 # 5A-A6-5A-A4-0C-00-4B-33-07-00-00-02-01-00-00-00-00-00-00-00
 class SPI(UartProtocolMixin):
+    # Pause between the polls of the start byte when the bus is shared, so that the other targets can use it
+    POLL_INTERVAL = 0.0005
+
     def __init__(self, freq=1000*1000, mode=0):
         self.mode = mode
         self.freq = int(freq, 0) if isinstance(freq, str) else freq
         self.controller = None
         self.slave = None
+        self.irq = None
 
-    def open(self, vid=None, pid=None, index=1):
-        """ open the interface """
-        self.controller = SpiController(cs_count=4)
-        
+    def open(self, vid=None, pid=None, index=1, interface=1, cs=0):
+        """ open the interface
+        :param interface: FTDI interface (channel) starting from 1, MPSSE is available on 1, 2 of FT2232H/FT4232H
+        :param cs: Chip select of the target, the targets on the same bus share the controller
+        """
         # [URL Scheme — PyFtdi documentation](https://eblot.github.io/pyftdi/urlscheme.html#url-scheme)
         # # spi.configure('ftdi:///1')
         # url = 'ftdi://ftdi:{}/1'.format(target)
-        url = 'ftdi://{}:{}:{}/1'.format(vid or '', pid or '', index)
-        self.controller.configure(url)
-        self.slave = self.controller.get_port(cs=0, freq=self.freq, mode=self.mode)
+        url = 'ftdi://{}:{}:{}/{}'.format(vid or '', pid or '', index, interface)
+
+        def configure():
+            controller = SpiController(cs_count=4)
+            controller.configure(url)
+            return controller
+
+        self.controller = ControllerPool.acquire(url, configure)
+        self.slave = self.controller.get_port(cs=cs, freq=self.freq, mode=self.mode)
         logging.debug("Opening SPI interface")
 
     def close(self):
         """ close the interface """
-        self.controller.terminate()
+        ControllerPool.release(self.controller)
         logging.debug("Close SPI Interface")
 
+    def set_speed(self, freq):
+        """ change the SPI clock without reopening the interface
+        :param freq: SPI clock frequency in Hz
+        """
+        self.freq = freq
+        self.slave.set_frequency(freq)
+        logging.debug("SPI clock: %d Hz", self.slave.frequency)
+
+    def set_irq_pin(self, pin, active_low=True):
+        """ wait on the FTDI GPIO connected to the target IRQ notifier pin before reading
+        :param pin: FTDI GPIO pin number, None to go back to polling the bus
+        :param active_low: The target pulls the pin low when the packet is ready
+        """
+        if pin is None:
+            self.irq = None
+        else:
+            self.irq = IrqNotifier(self.controller.get_gpio(), pin, active_low)
+
     def read(self, packet_type, rx_ack=False, tx_ack=True, locate=None):
         # data = self.slave.read(length).tobytes()
         # logging.debug('SPI-IN-%s-ORIGIN[%d]: %s', packet_type.name, len(data), atos(data))
@@ -55,17 +84,13 @@ class SPI(UartProtocolMixin):
         #     payload = data[start_index+6:end_index]
         start_byte = self.find_start_byte()
         if rx_ack:
-            if not self.slave.read(1)[0] == FPType.ACK:
-                raise EnvironmentError
+            self.check_packet_type(self.slave.read(1)[0], FPType.ACK)
             self.find_start_byte()
         head = start_byte + self.slave.read(5).tobytes()
         _, _packet_type, payload_len, crc = struct.unpack('<2B2H', head) # framing packet
         logging.debug('SPI-IN-%s-HEAD[%d]: %s', packet_type.name, len(head), atos(head))
-        if not _packet_type == packet_type:
-            if _packet_type == FPType.CMD:   # Slave interrupt in read data
-                pass    # Read out the rest of the command
-            else:
-                raise EnvironmentError
+        # The target can interrupt the read data by a command packet, read out the rest of the command
+        self.check_packet_type(_packet_type, packet_type, FPType.CMD)
         payload = self.slave.read(payload_len).tobytes()
 
         if locate is None:
@@ -109,8 +134,8 @@ class SPI(UartProtocolMixin):
         data = start_byte + self.slave.read(9).tobytes()
         logging.debug('SPI-OUT-PINGR[%d]: %s', len(data), atos(data))
         _, packet_type, *protocol_version, protocol_name, options, crc = struct.unpack('<6B2H', data)
-        if not packet_type == FPType.PINGR:
-                raise EnvironmentError
+        self.check_packet_type(packet_type, FPType.PINGR)
+        self.check_crc(data[:8], crc)
         return data
 
     def find_start_byte(self, timeout=1):
@@ -122,12 +147,19 @@ class SPI(UartProtocolMixin):
         # timeout logic
         start_time = time.perf_counter()
 
+        # The start byte is ready when the target asserts its IRQ notifier pin
+        if self.irq and not self.irq.wait(timeout):
+            raise McuBootTimeOutError
+
+        shared = self.controller is not None and self.controller.users > 1
         # Return before time runs out
         while time.perf_counter() - start_time < timeout:
             start = self.slave.read(1)   # self.slave.read() return array.array
             # logging.debug('{!r} {}'.format(start, type(start)))
             if start[0] == 0x5A:
                 return start.tobytes()
+            if shared:
+                time.sleep(self.POLL_INTERVAL)
 
         raise McuBootTimeOutError
         
@@ -152,6 +184,8 @@ class SPI(UartProtocolMixin):
         if not packet_type == FPType.ACK:
             if packet_type == FPType.ABORT:
                 raise McuBootDataError(mode='read', errname=StatusCode[0x2712])
+            elif packet_type == FPType.NACK:    # The target received a broken packet
+                raise McuBootDataError(mode='write', errname='Nack', nack=True)
             else:
                 raise McuBootDataError('recevice ack error, packet_type={!s}(0x{:X})'
                     .format(FPType(packet_type), packet_type))
@@ -0,0 +1,112 @@
+import os
+import json
+import logging
+import tempfile
+import contextlib
+
+try:
+    import fcntl
+except ImportError:     # Windows
+    fcntl = None
+    import msvcrt
+
+def cache_dir():
+    """ Return the directory that keeps the persistent data of mboot, such as calibration results
+    It is "~/.mboot" by default and can be changed by the environment variable MBOOT_CACHE_DIR
+    """
+    path = os.environ.get('MBOOT_CACHE_DIR') or os.path.join(os.path.expanduser('~'), '.mboot')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+@contextlib.contextmanager
+def file_lock(path):
+    """ Hold an exclusive lock of the file, shared by the processes and the threads opening it
+    :param path: The lock file, created if it does not exist
+    """
+    fd = os.open(path, os.O_RDWR | os.O_CREAT)
+    try:
+        if fcntl:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        else:
+            msvcrt.locking(fd, msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            else:
+                os.lseek(fd, 0, os.SEEK_SET)
+                msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+    finally:
+        os.close(fd)
+
+class JsonStore(object):
+    """ Small key-value store saved as a json file in the cache directory. The store is shared by the processes,
+    every change reads the file again under a lock and writes back only the changed keys.
+    :param name: Name of the store, used as the file name
+    :param directory: Directory of the file, default is cache_dir()
+    """
+    def __init__(self, name, directory=None):
+        self.path = os.path.join(directory or cache_dir(), name + '.json')
+        self._data = None
+
+    @property
+    def data(self):
+        """ The content read at the first use or the last change, see reload() """
+        if self._data is None:
+            self._data = self._load()
+        return self._data
+
+    def exists(self):
+        """ Whether the file exists, without reading it, the empty store has no file """
+        return os.path.exists(self.path)
+
+    def reload(self):
+        self._data = self._load()
+        return self._data
+
+    def _load(self):
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}     # Not created yet or broken, start again
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def set(self, key, value):
+        def change(data):
+            data[key] = value
+        self.modify(change)
+
+    def delete(self, key):
+        self.modify(lambda data: data.pop(key, None) is not None)
+
+    def modify(self, func):
+        """ Change the store: the file is read again under the lock, changed by func and written back
+        :param func: Callable with the dict of the store, it changes the dict and returns False if nothing is changed
+        """
+        try:
+            with file_lock(self.path + '.lock'):
+                data = self._load()
+                if func(data) is not False:
+                    if data:
+                        self._write(data)
+                    elif os.path.exists(self.path):
+                        os.remove(self.path)
+                self._data = data
+        except OSError as e:
+            logging.warning('Can not save %s: %s', self.path, e)
+
+    def _write(self, data):
+        # Write to a temporary file first, so that an interrupted write will not break the store
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(data, f, indent=2, sort_keys=True)
+            os.replace(tmp, self.path)
+        except OSError:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
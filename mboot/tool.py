@@ -1,8 +1,12 @@
+import os
+import mmap
+import struct
+import binascii
+import operator
+import itertools
 import inspect
 from string import printable
 
-import bincopy
-
 from .exception import McuBootGenericError
 
 def size_fmt(value, use_kibibyte=True):
@@ -219,45 +223,389 @@ def hexdump(data, start_address=0, compress=True, length=16, sep='.'):
     msg.append((' ' + '-' * (13 + 4 * length)))
     return '\n'.join(msg)
 
+def map_file(filename, offset=0, length=None):
+    """ Map the binary file into memory, the pages are loaded by the system when they are sent
+    :param filename: The file to be mapped
+    :param offset: Offset of the first byte in the file
+    :param length: Count of bytes, default is to the end of the file
+    :return Read-only memoryview, the slices of it are not copied
+    """
+    with open(filename, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if offset > size:
+            raise McuBootGenericError('Offset 0x{:X} is out of the file {} (size: 0x{:X})'.format(offset, filename, size))
+        if size == 0:
+            return memoryview(b'')
+        # The mapping is kept alive by the memoryview after the file is closed
+        data = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+    end = size if length is None else min(offset + length, size)
+    return data[offset:end]
+
+class _Records(object):
+    """ Collect the data of the records, the data of the contiguous records is joined as it is added """
+    def __init__(self, name):
+        self.name = name
+        self.records = []
+        self.end = None
+
+    def add(self, address, data):
+        if not data:
+            return
+        if address != self.end:
+            self.records.append((address, bytearray()))
+        self.records[-1][1].extend(data)
+        self.end = address + len(data)
+
+    def segments(self):
+        """ Sort and join the records, the overlapping records are refused
+        :return List of (address, data) segments sorted by address
+        """
+        segments = []
+        for address, data in sorted(self.records, key=lambda record: record[0]):
+            if segments and address < segments[-1][0] + len(segments[-1][1]):
+                raise McuBootGenericError('{} record 0x{:08X} overlaps the data before it'.format(self.name, address))
+            if segments and address == segments[-1][0] + len(segments[-1][1]):
+                segments[-1][1].extend(data)
+            else:
+                segments.append((address, data))
+        return [(address, bytes(data)) for address, data in segments]
+
+def _decode_records(lines, start, skip, name):
+    """ Check the start character of the records and decode the hex digits of all records at once """
+    if bytes(map(operator.itemgetter(0), lines)) != start * len(lines):
+        raise McuBootGenericError('Invalid {} file: the record does not start with "{}"'.format(name, start.decode()))
+    try:
+        return binascii.unhexlify(b''.join(map(operator.itemgetter(slice(skip, None)), lines)))
+    except (binascii.Error, ValueError) as e:
+        raise McuBootGenericError('Invalid {} file: {}'.format(name, e))
+
+# The bytes of count records of the same size are handled by columns, raw[offset::size] is the byte at offset of
+# every record, so a run of data records costs a few slice operations instead of a loop over the records.
+def _column(raw, pos, count, size, offset, width):
+    """ Bytes offset..offset+width of count records of size bytes from pos, joined """
+    end = pos + count * size
+    if width == 1:
+        return raw[pos + offset:end:size]
+    out = bytearray(count * width)
+    for i in range(width):
+        out[i::width] = raw[pos + offset + i:end:size]
+    return out
+
+def _checksums(raw, pos, count, size):
+    """ Low byte of the sum of every record, the records are summed in the 16-bit lanes of one integer,
+    the size must not exceed 257 so that a lane never carries into the next one
+    """
+    end = pos + count * size
+    total = 0
+    lanes = bytearray(count * 2)
+    for i in range(size):
+        lanes[0::2] = raw[pos + i:end:size]
+        total += int.from_bytes(lanes, 'little')
+    return total.to_bytes(count * 2, 'little')[0::2]
+
+def _addresses(start, count, step, width):
+    """ Big endian addresses of count contiguous records, width bytes each """
+    packed = struct.pack('>%dI' % count, *range(start, start + count * step, step))
+    return _column(packed, 0, count, 4, 4 - width, width)
+
+def parse_ihex(data):
+    """ Parse the Intel Hex file content, the runs of data records of the same length are decoded in bulk
+    :param data: Content of the file in bytes
+    :return List of (address, data) segments sorted by address
+    """
+    lines = data.split()
+    raw = _decode_records(lines, b':', 1, 'Hex')
+    records = _Records('Hex')
+    base = pos = number = 0
+    for line_len, group in itertools.groupby(map(len, lines)):
+        count = len(list(group))
+        size = (line_len - 1) // 2
+        length = size - 5
+        end = pos + count * size
+        if (count > 1 and line_len % 2 and 0 < length and size <= 257
+                and raw[pos:end:size] == bytes([length]) * count
+                and raw[pos + 3:end:size] == bytes(count)
+                and _checksums(raw, pos, count, size) == bytes(count)):
+            first = raw[pos + 1] << 8 | raw[pos + 2]
+            if (first + count * length <= 0x10000
+                    and _column(raw, pos, count, size, 1, 2) == _addresses(first, count, length, 2)):
+                records.add(base + first, _column(raw, pos, count, size, 4, length))
+                pos, number = end, number + count
+                continue
+        for _ in range(count):
+            number += 1
+            if line_len % 2 == 0 or size < 5 or raw[pos] != length:
+                raise McuBootGenericError('Invalid Hex record length at line {}'.format(number))
+            if sum(raw[pos:pos + size]) & 0xFF:
+                raise McuBootGenericError('Invalid Hex record checksum at line {}'.format(number))
+            record_type = raw[pos + 3]
+            if record_type == 0:
+                records.add(base + (raw[pos + 1] << 8 | raw[pos + 2]), raw[pos + 4:pos + 4 + length])
+            elif record_type == 1:
+                return records.segments()
+            elif record_type == 2:      # Extended segment address
+                base = (raw[pos + 4] << 8 | raw[pos + 5]) << 4
+            elif record_type == 4:      # Extended linear address
+                base = (raw[pos + 4] << 8 | raw[pos + 5]) << 16
+            pos += size
+    return records.segments()
+
+def parse_srec(data):
+    """ Parse the Motorola S-Record file content, the runs of data records of the same length are decoded in bulk
+    :param data: Content of the file in bytes
+    :return List of (address, data) segments sorted by address
+    """
+    lines = data.split()
+    if min(map(len, lines), default=2) < 2:
+        raise McuBootGenericError('Invalid S-Record file: the record type is missing')
+    raw = _decode_records(lines, b'S', 2, 'S-Record')
+    records = _Records('S-Record')
+    pos = number = 0
+    for (line_len, record_type), group in itertools.groupby(zip(map(len, lines), map(operator.itemgetter(1), lines))):
+        count = len(list(group))
+        size = (line_len - 2) // 2
+        address_size = {0x31: 2, 0x32: 3, 0x33: 4}.get(record_type)     # S1, S2, S3
+        end = pos + count * size
+        if (address_size and count > 1 and line_len % 2 == 0 and size <= 257
+                and raw[pos:end:size] == bytes([size - 1]) * count
+                and _checksums(raw, pos, count, size) == b'\xFF' * count):
+            first = int.from_bytes(raw[pos + 1:pos + 1 + address_size], 'big')
+            length = size - 2 - address_size
+            if (0 < length and first + count * length <= 1 << address_size * 8
+                    and _column(raw, pos, count, size, 1, address_size) == _addresses(first, count, length, address_size)):
+                records.add(first, _column(raw, pos, count, size, 1 + address_size, length))
+                pos, number = end, number + count
+                continue
+        for _ in range(count):
+            number += 1
+            if line_len % 2 or size < 1 or raw[pos] != size - 1:
+                raise McuBootGenericError('Invalid S-Record length at line {}'.format(number))
+            if sum(raw[pos:pos + size]) & 0xFF != 0xFF:
+                raise McuBootGenericError('Invalid S-Record checksum at line {}'.format(number))
+            if address_size:
+                records.add(int.from_bytes(raw[pos + 1:pos + 1 + address_size], 'big'),
+                            raw[pos + 1 + address_size:pos + size - 1])
+            pos += size
+    return records.segments()
+
+def read_elf(filename):
+    """ Read the loadable segments (PT_LOAD) of the ELF file at their physical addresses (LMA), the file is mapped
+    and the segment data is a view of it, the sections which are not loaded and the gaps are not read
+    :param filename: The file to be read
+    :return List of (address, data) segments sorted by address
+    """
+    data = map_file(filename)
+    if len(data) < 0x34 or data[:4] != b'\x7fELF' or data[4] not in (1, 2) or data[5] not in (1, 2):
+        raise McuBootGenericError('Invalid ELF file {}'.format(filename))
+    order = '<' if data[5] == 1 else '>'
+    # e_phoff, e_phentsize, e_phnum from e_entry and p_type, p_offset, p_paddr, p_filesz of the program header
+    if data[4] == 1:    # ELFCLASS32
+        header, program = order + '4xI10xHH', order + '2I4x2I'
+    else:               # ELFCLASS64
+        header, program = order + '8xQ14xHH', order + 'I4xQ8x2Q'
+    segments = []
+    try:
+        phoff, phentsize, phnum = struct.unpack_from(header, data, 0x18)
+        for i in range(phnum):
+            p_type, p_offset, p_paddr, p_filesz = struct.unpack_from(program, data, phoff + i * phentsize)
+            if p_type != 1 or not p_filesz:     # PT_LOAD, the uninitialized data (.bss) has no bytes in the file
+                continue
+            if p_offset + p_filesz > len(data):
+                raise McuBootGenericError('ELF segment 0x{:08X} is out of the file {}'.format(p_paddr, filename))
+            segments.append((p_paddr, data[p_offset:p_offset + p_filesz]))
+    except struct.error:
+        raise McuBootGenericError('Invalid ELF program header in {}'.format(filename))
+    return sorted(segments, key=lambda segment: segment[0])
+
+def read_segments(filename, data=None):
+    """ Read the S-Record (.srec, .s19), Hex (.hex, .ihex) or ELF (.elf, .axf, .out) file,
+    the records are decoded in bulk, the ELF file is mapped, see read_elf()
+    :param filename: The file to be read, the format is selected by the extension
+    :param data: Content of the S-Record or Hex file if it is already read
+    :return List of (address, data) segments sorted by address
+    """
+    if filename.lower().endswith(('.elf', '.axf', '.out')):
+        return read_elf(filename)
+    if data is None:
+        with open(filename, 'rb') as f:
+            data = f.read()
+    if filename.lower().endswith(('.srec', '.s19')):
+        return parse_srec(data)
+    return parse_ihex(data)
+
 def read_file(filename, address=None):
-    in_data = bincopy.BinFile()
     try:
-        if filename.lower().endswith(('.srec', '.s19')):
-            in_data.add_srec_file(filename)
-            if address is None:
-                address = in_data.minimum_address
-        elif filename.lower().endswith(('.hex', '.ihex')):
-            in_data.add_ihex_file(filename)
+        if filename.lower().endswith(('.srec', '.s19', '.hex', '.ihex', '.elf', '.axf', '.out')):
+            segments = read_segments(filename)
+            if not segments:
+                raise McuBootGenericError('No data in the file')
             if address is None:
-                address = in_data.minimum_address
+                address = segments[0][0]
+            # The gaps are padded with 0xFF as the erased flash
+            data = bytearray()
+            for segment_address, segment in segments:
+                data += b'\xFF' * (segment_address - segments[0][0] - len(data))
+                data += segment
         else:
-            in_data.add_binary_file(filename)
             if address is None:
                 raise McuBootGenericError('Write a bin file to device must provide a write address.')
-        data = in_data.as_binary()
+            return map_file(filename), address
     except Exception as e:
         raise Exception('Could not write to file {}:\n [{}]'.format(filename, str(e)))
     return data, address
 
-def write_file(filename, data):
+def write_file(filename, data, address=0):
+    """ Write the data into S-Record (.srec, .s19), Hex (.hex, .ihex) or binary file
+    :param filename: The file to be written
+    :param data: List of bytes
+    :param address: Address of the first byte, not used for binary file
+    """
     try:
-        if filename.lower().endswith(('.srec', '.s19')):
-            srec = bincopy.BinFile()
-            srec.add_binary(data, address)
-            srec.header = 'mboot'
-            with open(filename, "w") as f:
-                f.write(srec.as_srec())
-        elif filename.lower().endswith(('.hex', '.ihex')):
-            ihex = bincopy.BinFile()
-            ihex.add_binary(data, address)
-            with open(filename, "w") as f:
-                f.write(ihex.as_ihex())
-        else:
-            with open(filename, "wb") as f:
-                f.write(data)
+        writer = open_writer(filename, address)
+        try:
+            writer.write(data)
+        finally:
+            writer.close()
     except Exception as e:
         raise Exception('Could not write to file {}:\n [{}]'.format(filename, str(e)))
 
+class BinWriter(object):
+    """ Write the data read chunk by chunk into a binary file
+    :param filename: The file to be written
+    :param resume: Keep the data in the file and continue after it, see offset
+    :param align: The kept data is cut to the multiple of align
+    :param length: Count of bytes of the whole file, a longer file is cut to it on resume
+    """
+    def __init__(self, filename, resume=False, align=1, length=None):
+        self.offset = 0
+        if resume and os.path.exists(filename):
+            size = os.path.getsize(filename)
+            self.offset = (size if length is None else min(size, length)) // align * align
+            self.file = open(filename, 'r+b')
+            self.file.truncate(self.offset)
+            self.file.seek(self.offset)
+        else:
+            self.file = open(filename, 'wb')
+
+    def write(self, data):
+        self.file.write(data)
+
+    def close(self):
+        self.file.close()
+
+class RecordWriter(object):
+    """ Write the data read chunk by chunk as the text records, the records of every chunk are written when it
+    arrives and only the bytes of a partial record are kept until the next one
+    :param filename: The file to be written
+    :param address: Address of the first byte
+    """
+    record_size = 32
+    offset = 0      # Resume is not supported, the file is written from the start
+
+    def __init__(self, filename, address):
+        self.file = open(filename, 'w')
+        self.address = address
+        self.pending = bytearray()
+        self.count = 0
+        self.file.write(self.head_records())
+
+    def max_length(self, address):
+        """ Count of bytes the record at address can take """
+        return self.record_size
+
+    def write(self, data):
+        self.pending += data
+        self._flush(False)
+
+    def _flush(self, final):
+        data = memoryview(self.pending)
+        pos = 0
+        lines = []
+        while len(data) - pos >= self.record_size or (final and pos < len(data)):
+            length = min(self.record_size, len(data) - pos, self.max_length(self.address))
+            lines.append(self.data_record(self.address, data[pos:pos + length]))
+            self.count += 1
+            self.address += length
+            pos += length
+        data.release()
+        del self.pending[:pos]
+        self.file.write(''.join(lines))
+
+    def close(self):
+        try:
+            self._flush(True)
+            self.file.write(self.tail_records())
+        finally:
+            self.file.close()
+
+class IhexWriter(RecordWriter):
+    """ Intel Hex writer, the upper 16 bits of the address are set by the extended linear address records """
+    def __init__(self, filename, address):
+        self.upper = None
+        super().__init__(filename, address)
+
+    @staticmethod
+    def record(record_type, address, data):
+        checksum = -(len(data) + (address >> 8) + (address & 0xFF) + record_type + sum(data)) & 0xFF
+        return ':{:02X}{:04X}{:02X}{}{:02X}\n'.format(len(data), address, record_type, data.hex().upper(), checksum)
+
+    def max_length(self, address):
+        # A record does not cross the 64 KiB boundary
+        return 0x10000 - (address & 0xFFFF)
+
+    def head_records(self):
+        return ''
+
+    def data_record(self, address, data):
+        line = ''
+        if address >> 16 != self.upper:
+            self.upper = address >> 16
+            line = self.record(4, 0, self.upper.to_bytes(2, 'big'))
+        return line + self.record(0, address & 0xFFFF, data)
+
+    def tail_records(self):
+        return self.record(1, 0, b'')
+
+class SrecWriter(RecordWriter):
+    """ Motorola S-Record writer, the data records are S3 (32-bit address) """
+    header = b'mboot'
+
+    def __init__(self, filename, address):
+        self.start_address = address
+        super().__init__(filename, address)
+
+    @staticmethod
+    def record(record_type, address, address_size, data):
+        payload = address.to_bytes(address_size, 'big') + bytes(data)
+        checksum = ~(len(payload) + 1 + sum(payload)) & 0xFF
+        return 'S{}{:02X}{}{:02X}\n'.format(record_type, len(payload) + 1, payload.hex().upper(), checksum)
+
+    def head_records(self):
+        return self.record(0, 0, 2, self.header)
+
+    def data_record(self, address, data):
+        return self.record(3, address, 4, data)
+
+    def tail_records(self):
+        # Count of the data records (S5 or S6) and the start address (S7)
+        count = self.record(5, self.count, 2, b'') if self.count <= 0xFFFF else self.record(6, self.count, 3, b'')
+        return count + self.record(7, self.start_address, 4, b'')
+
+def open_writer(filename, address, resume=False, align=1, length=None):
+    """ Open the writer of the data read chunk by chunk, the format is selected by the file extension
+    :param filename: The file to be written, S-Record (.srec, .s19), Hex (.hex, .ihex) or binary
+    :param address: Address of the first byte
+    :param resume: Continue the binary file, the writer.offset bytes are already in it
+    :param align: The kept data of resume is cut to the multiple of align
+    :param length: Count of bytes to be written, the binary file of resume is cut to it
+    :return Writer with write(data), close() and offset
+    """
+    if filename.lower().endswith(('.srec', '.s19')):
+        return SrecWriter(filename, address)
+    if filename.lower().endswith(('.hex', '.ihex')):
+        return IhexWriter(filename, address)
+    return BinWriter(filename, resume, align, length)
+
 if __name__ == '__main__':
     data = bytes.fromhex('5A A4 0C 00 07 00 00 02 01 00 00 00 00 00 00 00')
     # import array
@@ -87,17 +87,13 @@ class UART(UartProtocolMixin):
             raise McuBootConnectionError("UART Disconnected.")
         start_byte = self.find_start_byte()
         if rx_ack:
-            if not self.ser.read(1)[0] == FPType.ACK:
-                raise EnvironmentError
+            self.check_packet_type(self.ser.read(1)[0], FPType.ACK)
             self.find_start_byte()
         head = start_byte + self.ser.read(5)
         logging.debug('UART-IN-%s-HEAD[%d]: %s', packet_type.name, len(head), atos(head))
         _, _packet_type, payload_len, crc = struct.unpack('<2B2H', head) # framing packet
-        if not _packet_type == packet_type:
-            if _packet_type == FPType.CMD:   # ser interrupt in read data
-                pass    # Read out the rest of the command
-            else:
-                raise EnvironmentError
+        # The target can interrupt the read data by a command packet, read out the rest of the command
+        self.check_packet_type(_packet_type, packet_type, FPType.CMD)
         payload = self.ser.read(payload_len)
 
         if locate is None:
@@ -142,8 +138,8 @@ class UART(UartProtocolMixin):
         data = start_byte + self.ser.read(9)
         logging.debug('UART-OUT-PINGR[%d]: %s', len(data), atos(data))
         _, packet_type, *protocol_version, protocol_name, options, crc = struct.unpack('<6B2H', data)
-        if not packet_type == FPType.PINGR:
-                raise EnvironmentError
+        self.check_packet_type(packet_type, FPType.PINGR)
+        self.check_crc(data[:8], crc)
         return data
 
     def find_start_byte(self, timeout=1):
@@ -185,6 +181,8 @@ class UART(UartProtocolMixin):
         if not packet_type == FPType.ACK:
             if packet_type == FPType.ABORT:
                 raise McuBootDataError(mode='read', errname=StatusCode[0x2712])
+            elif packet_type == FPType.NACK:    # The target received a broken packet
+                raise McuBootDataError(mode='write', errname='Nack', nack=True)
             else:
                 raise McuBootDataError('recevice ack error, packet_type={!s}(0x{:X})'
                     .format(FPType(packet_type), packet_type))
@@ -0,0 +1,8 @@
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    ''' Keep the persistent data of mboot (profiles, manifests, journal, image cache) out of the home directory '''
+    monkeypatch.setenv('MBOOT_CACHE_DIR', str(tmp_path))
+    return tmp_path
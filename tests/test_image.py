@@ -0,0 +1,129 @@
+import struct
+
+import bincopy
+import pytest
+
+from mboot import Image, McuBootGenericError
+from mboot.tool import parse_ihex, parse_srec
+from mboot.image import ImageCache, plan_fill
+
+
+def test_image_from_hex(tmp_path):
+    hex_file = tmp_path / 'app.hex'
+    in_data = bincopy.BinFile()
+    in_data.add_binary(b'\x01' * 0x10, 0x0)
+    in_data.add_binary(b'\x02' * 0x10, 0x80000)
+    hex_file.write_text(in_data.as_ihex())
+
+    image = Image.from_file(str(hex_file))
+    assert image.segments == [(0x0, b'\x01' * 0x10), (0x80000, b'\x02' * 0x10)]
+    assert len(image) == 0x20 and image.maximum_address == 0x80010
+    assert image.runs(0x1000) == image.segments
+    assert len(image.as_binary()) == 0x80010
+
+    moved = Image.from_file(str(hex_file), 0x1000)
+    assert moved.minimum_address == 0x1000 and moved.segments[1][0] == 0x81000
+    assert image.skip(0x8).segments == [(0x0, b'\x01' * 0x8), (0x7FFF8, b'\x02' * 0x10)]
+
+
+def test_image_cache(tmp_path, monkeypatch):
+    hex_file = tmp_path / 'app.hex'
+    in_data = bincopy.BinFile()
+    in_data.add_binary(b'\x01' * 0x100, 0x1000)
+    in_data.add_binary(b'\x02' * 0x100, 0x3000)
+    hex_file.write_text(in_data.as_ihex())
+    expected = [(0x1000, b'\x01' * 0x100), (0x3000, b'\x02' * 0x100)]
+
+    cache = ImageCache(0x300, str(tmp_path / 'cache'))
+    assert cache.get(str(hex_file)) == expected
+    manifest = tmp_path / 'cache' / 'manifest.json'
+    written = manifest.stat().st_mtime_ns
+    parsed = []
+    monkeypatch.setattr('mboot.image.read_segments', lambda *args: parsed.append(args) or parse_ihex(args[1]))
+    segments = cache.get(str(hex_file))
+    assert segments == expected and isinstance(segments[0][1], memoryview) and not parsed
+    # A hit only touches the blob, the manifest is not written
+    assert manifest.stat().st_mtime_ns == written
+
+    # The same content under another name is not parsed again
+    copy_file = tmp_path / 'copy.hex'
+    copy_file.write_bytes(hex_file.read_bytes())
+    assert cache.get(str(copy_file)) == expected and not parsed
+
+    # Above the size cap the least recently used image is dropped
+    in_data.add_binary(b'\x03' * 0x100, 0x5000)
+    hex_file.write_text(in_data.as_ihex())
+    cache.get(str(hex_file))
+    assert len(parsed) == 1
+    assert sorted(p.suffix for p in (tmp_path / 'cache').iterdir()) == ['.bin', '.json', '.lock']
+
+
+def test_image_from_bin_is_mapped(tmp_path):
+    bin_file = tmp_path / 'app.bin'
+    bin_file.write_bytes(bytes(range(0x100)))
+    image = Image.from_file(str(bin_file), 0x1000, 0x10, 0x20)
+    address, data = image.segments[0]
+    assert address == 0x1000 and isinstance(data, memoryview)
+    assert data == bytes(range(0x10, 0x30))
+    # The slices sent to the target are views of the mapping
+    assert isinstance(image.runs()[0][1], memoryview)
+    assert len(Image.from_file(str(bin_file), 0x1000, 0x100)) == 0
+
+
+def test_parse_records():
+    in_data = bincopy.BinFile()
+    in_data.add_binary(bytes(range(0x100)) * 0x20, 0x0FFF0)     # Crosses the extended address of the Hex file
+    in_data.add_binary(b'\x02' * 0x13, 0x20000000)
+    expected = [(segment.minimum_address, bytes(segment.data)) for segment in in_data.segments]
+    assert parse_ihex(in_data.as_ihex().encode()) == expected
+    assert parse_srec(in_data.as_srec().encode()) == expected
+    small = bincopy.BinFile()
+    small.add_binary(b'\x03' * 0x30, 0x100)
+    assert parse_srec(small.as_srec(address_length_bits=16).encode()) == [(0x100, b'\x03' * 0x30)]
+
+    lines = in_data.as_ihex().encode().splitlines()
+    lines[2] = lines[2][:-2] + b'00'
+    with pytest.raises(McuBootGenericError):
+        parse_ihex(b'\n'.join(lines))
+
+
+def test_image_from_elf(tmp_path):
+    text, data = b'\x01' * 0x40, b'\x02' * 0x10
+    # ELF32 header, program headers of .text, .data (copied from its LMA 0x1000 to RAM) and .bss
+    elf = b'\x7fELF\x01\x01\x01' + bytes(9)
+    elf += struct.pack('<2H5I6H', 2, 40, 1, 0, 0x34, 0, 0, 0x34, 0x20, 3, 0x28, 0, 0)
+    elf += struct.pack('<8I', 1, 0x100, 0x0, 0x0, len(text), len(text), 5, 4)
+    elf += struct.pack('<8I', 1, 0x140, 0x20000000, 0x1000, len(data), len(data), 6, 4)
+    elf += struct.pack('<8I', 1, 0x150, 0x20000010, 0x1010, 0, 0x100, 6, 4)
+    elf_file = tmp_path / 'app.elf'
+    elf_file.write_bytes(elf + bytes(0x100 - len(elf)) + text + data)
+
+    image = Image.from_file(str(elf_file))
+    assert image.segments == [(0x0, text), (0x1000, data)]
+
+    broken_file = tmp_path / 'broken.axf'
+    broken_file.write_bytes(elf[:0x40])
+    with pytest.raises(McuBootGenericError):
+        Image.from_file(str(broken_file))
+
+
+def test_image_runs():
+    image = Image([(0x10, b'\x02'), (0x0, b'\x01' * 4), (0x4, b'\x03')])
+    assert image.segments == [(0x0, b'\x01' * 4 + b'\x03'), (0x10, b'\x02')]
+    assert image.runs(0xB) == [(0x0, b'\x01' * 4 + b'\x03' + b'\xFF' * 0xB + b'\x02')]
+    assert image.runs(0xA) == image.segments
+
+
+def test_image_split():
+    data = b'\x01' * 3 + b'\xFF' * 0x20 + b'\x02' + b'\xFF' * 0x8
+    image = Image([(0x100, data)])
+    assert image.split(0xFF, 0x10, 4).segments == [(0x100, b'\x01' * 3 + b'\xFF'), (0x120, b'\xFF' * 3 + b'\x02' + b'\xFF' * 8)]
+    assert image.split(0xFF, 0x40, 4).segments == image.segments
+
+
+def test_plan_fill():
+    data = b'\x01' * 3 + b'\x00' * 0x50 + b'\x12\x34' * 0x30 + b'\x02' * 3
+    plan = [(address, bytes(part), pattern) for address, part, pattern in plan_fill(0x1001, data)]
+    assert plan == [(0x1001, b'\x01' * 3, None), (0x1004, b'\x00' * 0x50, 0), (0x1054, b'\x12\x34' * 0x30, 0x34123412),
+                    (0x10B4, b'\x02' * 3, None)]
+    assert plan_fill(0x1000, data, 0x100)[0][2] is None
@@ -0,0 +1,516 @@
+import struct
+import threading
+
+import pytest
+from mboot import McuBoot, Image, RetryPolicy, Scheduler, decode_property_value, CommandTag, PropertyTag, StatusCode, McuBootDataError, McuBootConnectionError, \
+    McuBootCommandError, McuBootGenericError, McuBootVerifyError
+from mboot.constant import Interface
+from mboot.peripheral import get_calibrated_speed
+from mboot.store import JsonStore
+from mboot.helper import CRC32_CODE, CRC32_PARAMS, LZ4_CODE, LZ4_PARAMS, crc32_blocks, lz4_decompress
+
+
+class FakeInterface(object):
+    ''' Target which breaks the packets above max_freq '''
+    def __init__(self, freq, max_freq):
+        self.freq = freq
+        self.max_freq = max_freq
+        self.properties = {PropertyTag.CURRENT_VERSION: 0x4B020100, PropertyTag.SYSTEM_DEVICE_IDENT: 0x12345678,
+                           PropertyTag.FLASH_START_ADDRESS: 0, PropertyTag.MAX_PACKET_SIZE: 0x20}
+        self.last_cmd_response = None
+        self.commands = []
+
+    def set_speed(self, freq):
+        self.freq = freq
+
+    def ping(self):
+        self._check()
+
+    def _check(self):
+        if self.freq > self.max_freq:
+            raise McuBootDataError(mode='read', errname='InvalidCRC')
+
+    def write_cmd(self, cmd, **kwargs):
+        self._check()
+        tag = cmd[0]
+        self.commands.append(tag)
+        if tag == CommandTag.GET_PROPERTY:
+            prop_tag = struct.unpack_from('<I', cmd, 4)[0]
+            if prop_tag not in self.properties:
+                raise McuBootCommandError(errname=StatusCode[StatusCode.UNKNOWN_PROPERTY], errval=StatusCode.UNKNOWN_PROPERTY)
+            value = self.properties[prop_tag]
+            self.last_cmd_response = struct.pack('<4B2I', 0xA7, 0, 0, 2, 0, value)
+            return value
+        return 0
+
+    def read_data(self, length):
+        self._check()
+        return bytearray(range(length))
+
+    def write_data(self, data, max_packet_size=0x20):
+        self._check()
+        self.written = bytes(data)
+        return len(data)
+
+
+def test_calibrate_speed():
+    mb = McuBoot()
+    mb._itf_ = FakeInterface(1000000, 10000000)
+    mb.current_interface = Interface.SPI
+    mb.adapter = ((0x0403, 0x6014), 1)
+
+    assert mb.calibrate_speed(length=0x10, rounds=2) == 10000000
+    assert mb._itf_.freq == 10000000
+    assert get_calibrated_speed('spi', (0x0403, 0x6014), 1, 0x12345678) == 10000000
+    assert get_calibrated_speed('spi', (0x0403, 0x6014), 1) == 10000000
+    assert get_calibrated_speed('spi', (0x0403, 0x6010), 1) is None
+
+    mb._itf_.freq = 1000000
+    assert mb.use_calibrated_speed() == 10000000
+
+
+def test_scheduler_runs_sessions_concurrently(monkeypatch):
+    opened = []
+
+    def open_spi(self, vid_pid, index=1, freq=1000000, mode=0, interface=1):
+        self._itf_ = FakeInterface(freq, freq)
+        self._itf_.close = lambda: None
+        opened.append(interface)
+        return interface != 3
+
+    monkeypatch.setattr(McuBoot, 'open_spi', open_spi)
+    # Every session waits for the other ones, it only passes if they run in parallel
+    barrier = threading.Barrier(2, timeout=5)
+    scheduler = Scheduler()
+    for interface in (1, 2):
+        scheduler.add(lambda mb: barrier.wait() is not None and mb.get_property(PropertyTag.CURRENT_VERSION),
+                      'spi', (0x0403, 0x6011), interface=interface)
+    scheduler.add(lambda mb: None, 'spi', (0x0403, 0x6011), interface=3)
+
+    sessions = scheduler.run()
+    assert sorted(opened) == [1, 2, 3]
+    assert [s.result for s in sessions[:2]] == [0x4B020100] * 2
+    assert sessions[0].ok and sessions[1].ok
+    assert isinstance(sessions[2].error, McuBootConnectionError)
+
+
+def test_property_cache():
+    mb = McuBoot()
+    mb._itf_ = FakeInterface(1000000, 1000000)
+    mb.current_interface = Interface.SPI
+
+    for _ in range(3):
+        assert mb.get_property(PropertyTag.FLASH_START_ADDRESS) == 0
+    assert mb._itf_.commands.count(CommandTag.GET_PROPERTY) == 1
+    assert mb.last_property_response == mb._itf_.last_cmd_response
+
+    mb.get_property(PropertyTag.FLASH_START_ADDRESS, cached=False)
+    assert mb._itf_.commands.count(CommandTag.GET_PROPERTY) == 2
+
+    mb.set_property(PropertyTag.VERIFY_WRITES, 1)
+    mb.get_property(PropertyTag.FLASH_START_ADDRESS)
+    assert mb._itf_.commands.count(CommandTag.GET_PROPERTY) == 3
+
+    mb.cache_properties = False
+    mb.get_property(PropertyTag.FLASH_START_ADDRESS)
+    assert mb._itf_.commands.count(CommandTag.GET_PROPERTY) == 4
+
+
+def test_profile():
+    mb = McuBoot()
+    mb._itf_ = FakeInterface(1000000, 1000000)
+    mb.current_interface = Interface.SPI
+    mb.adapter = ((0x0403, 0x6014), 1)
+    assert not mb.load_profile()
+    mb.get_property(PropertyTag.FLASH_START_ADDRESS)
+    mb.get_property(PropertyTag.CURRENT_VERSION)
+    mb.save_profile()
+
+    mb = McuBoot()
+    mb._itf_ = FakeInterface(1000000, 1000000)
+    mb.current_interface = Interface.SPI
+    mb.adapter = ((0x0403, 0x6014), 1)
+    assert mb.load_profile()
+    # Only the identity is read, UNIQUE_DEVICE_IDENT is not supported by the fake target
+    assert mb._itf_.commands.count(CommandTag.GET_PROPERTY) == 2
+    assert mb.get_property(PropertyTag.CURRENT_VERSION) == 0x4B020100
+    with pytest.raises(McuBootCommandError):
+        mb.get_property(PropertyTag.UNIQUE_DEVICE_IDENT)
+    assert mb._itf_.commands.count(CommandTag.GET_PROPERTY) == 2
+
+
+def test_decode_property_value():
+    assert decode_property_value(PropertyTag.CURRENT_VERSION, 0x4B020100) == '2.1.0'
+    assert decode_property_value(PropertyTag.AVAILABLE_PERIPHERALS, 0x15) == ['UART', 'SPI-Slave', 'USB-HID']
+    assert decode_property_value(PropertyTag.AVAILABLE_COMMANDS, 0x6) == ['FlashEraseAll', 'FlashEraseRegion']
+    assert decode_property_value(PropertyTag.CRC_CHECK_STATUS, 10400) == 'AppCrcCheckPassed'
+    assert decode_property_value(PropertyTag.FLASH_SECURITY_STATE, 0xC33CC33C) == 'Locked'
+    assert decode_property_value(PropertyTag.LIST_PROPERTIES, 0x10) == '0x10'
+
+
+def test_setup_external_memory():
+    mb = McuBoot()
+    mb._itf_ = FakeInterface(1000000, 1000000)
+    commands = mb._itf_.commands
+
+    mb.setup_external_memory(9, [0x20000000, 0xC0000008, 0x0])
+    mb.setup_external_memory(9, [0x20000000, 0xC0000008, 0x0])
+    assert commands.count(CommandTag.WRITE_MEMORY) == 1 and commands.count(CommandTag.CONFIGURE_MEMORY) == 1
+    assert mb._itf_.written == struct.pack('<2I', 0xC0000008, 0x0)
+
+    mb.setup_external_memory(1, [0x20000000, 0xC0000008, 0xC0000008])
+    assert commands.count(CommandTag.FILL_MEMORY) == 1 and commands.count(CommandTag.CONFIGURE_MEMORY) == 2
+
+    mb.reset()
+    mb.setup_external_memory(9, [0x20000000, 0xC0000008, 0x0])
+    assert commands.count(CommandTag.CONFIGURE_MEMORY) == 3
+
+
+def test_write_delta():
+    mb = McuBoot()
+    mb._itf_ = FakeInterface(1000000, 1000000)
+    mb._itf_.properties.update({PropertyTag.FLASH_SECTOR_SIZE: 0x100, PropertyTag.UNIQUE_DEVICE_IDENT: 0xCAFE})
+    commands = mb._itf_.commands
+    # The fake target reads back bytes(range(n)), so the unchanged sectors pass the spot check
+    data = bytes(range(0x100)) * 4
+
+    assert mb.write_delta(0, data) == 0x400
+    assert commands.count(CommandTag.FLASH_ERASE_REGION) == 1 and mb._itf_.written == data
+
+    del commands[:]
+    assert mb.write_delta(0, data, spot_check=4) == 0
+    assert CommandTag.FLASH_ERASE_REGION not in commands and commands.count(CommandTag.READ_MEMORY) == 4
+
+    data = data[:0x200] + b'\x00' * 0x100 + data[0x300:]
+    assert mb.write_delta(0, data) == 0x100
+    assert mb._itf_.written == b'\x00' * 0x100
+
+    mb.flash_erase_region(0, 0x100)
+    assert mb.write_delta(0, data) == 0x100
+    assert mb._itf_.written == data[:0x100]
+
+    # Only the sectors touched by the segments are erased, the head of a segment is padded to its sector
+    erased = []
+    flash_erase_region = mb.flash_erase_region
+    mb.flash_erase_region = lambda address, length, memory_id=0: erased.append((address, length))
+    image = Image([(0x10, b'\x01' * 0x10), (0x1000, b'\x02' * 0x100)])
+    assert mb.write_delta(None, image) == 0x120
+    assert erased == [(0x0, 0x100), (0x1000, 0x100)]
+    assert mb._itf_.written == b'\x02' * 0x100
+    assert mb.write_delta(None, image) == 0
+    mb.flash_erase_region = flash_erase_region
+
+    # The write to RAM does not look up the manifests of the device
+    mb._get_device_ident = None
+    mb.write_memory(0x20000000, data)
+
+
+def test_json_store_merges_keys(tmp_path):
+    # Two sessions of the same store, the change of one is not undone by the stale copy of the other
+    a, b = JsonStore('manifests', str(tmp_path)), JsonStore('manifests', str(tmp_path))
+    a.set('DEVA:0', 1)
+    assert b.get('DEVA:0') == 1
+    a.delete('DEVA:0')
+    b.set('DEVB:0', 2)
+    assert JsonStore('manifests', str(tmp_path)).data == {'DEVB:0': 2}
+
+
+def test_forget_flash_reads_stores_once(tmp_path):
+    mb = McuBoot()
+    mb._itf_ = FakeInterface(1000000, 1000000)
+    # No store, the identity is not read
+    mb._get_device_ident = None
+    mb.flash_erase_region(0, 0x100)
+    assert not list(tmp_path.iterdir())
+
+    # Only the manifest of another device, the store is read by the first erase of the session
+    JsonStore('manifests').set('CAFE:0', {'sector_size': 0x100, 'sectors': {}})
+    mb = McuBoot()
+    mb._itf_ = FakeInterface(1000000, 1000000)
+    mb.flash_erase_region(0, 0x100)
+    mb._get_manifests().modify = None
+    mb.flash_erase_region(0, 0x100)
+    assert JsonStore('manifests').data == {'CAFE:0': {'sector_size': 0x100, 'sectors': {}}}
+
+
+def test_write_image():
+    mb = McuBoot()
+    mb._itf_ = FakeInterface(1000000, 1000000)
+    mb._itf_.properties.update({PropertyTag.FLASH_SECTOR_SIZE: 0x1000, PropertyTag.FLASH_SIZE: 0x100000})
+    erased = []
+    mb.flash_erase_region = lambda address, length, memory_id=0: erased.append((address, length))
+
+    image = Image([(0x0, b'\x01' * 0x10), (0x30, b'\x02' * 0x10), (0x80000, b'\x03' * 0x10)])
+    mb.write_image(image)
+    assert erased == [(0x0, 0x1000), (0x80000, 0x1000)]
+    # The gap within a sector is sent, the gap of the sectors is not
+    assert mb._itf_.commands.count(CommandTag.WRITE_MEMORY) == 2
+    assert mb._itf_.written == b'\x03' * 0x10
+
+    # The erased value is not sent after erase
+    del mb._itf_.commands[:]
+    mb.write_image(Image([(0x0, b'\x01' * 0x10 + b'\xFF' * 0x200 + b'\x02' * 0x10)]))
+    assert mb._itf_.commands.count(CommandTag.WRITE_MEMORY) == 2
+    assert mb._itf_.written == b'\x02' * 0x10
+
+    # The constant runs are filled by the target
+    del mb._itf_.commands[:]
+    mb.write_image(Image([(0x20000000, b'\x01' * 0x10 + b'\x00' * 0x100 + b'\x02' * 0x10)]), erase=False)
+    assert mb._itf_.commands.count(CommandTag.WRITE_MEMORY) == 2 and mb._itf_.commands.count(CommandTag.FILL_MEMORY) == 1
+
+    # The fill of the flash is aligned to the program unit without erase too
+    mb._itf_.properties[PropertyTag.FLASH_PAGE_SIZE] = 0x10
+    mb.clear_property_cache()
+    filled = []
+    mb.fill_memory = lambda address, length, pattern: filled.append((address, length))
+    mb.write_image(Image([(0x0, b'\x01' * 0x4 + b'\x00' * 0x100 + b'\x02' * 0x4)]), erase=False)
+    assert filled == [(0x10, 0xF0)]
+
+    # The flash range is read once per session without the property cache
+    mb.cache_properties = False
+    del mb._itf_.commands[:]
+    mb.write_image(Image([(0x20000000, bytes(range(0x20))), (0x20001000, bytes(range(0x20)))]), erase=False)
+    assert mb._itf_.commands.count(CommandTag.GET_PROPERTY) == 2
+
+
+def test_verify_memory(tmp_path):
+    mb = McuBoot()
+    mb._itf_ = FakeInterface(1000000, 1000000)
+    # The fake target reads back bytes(range(n)) for every chunk
+    data = bytearray(range(0x20)) * 3
+    assert mb.verify_memory(0x100, data, chunk_size=0x20) == 0x60
+    assert mb._itf_.commands.count(CommandTag.READ_MEMORY) == 3
+
+    bin_file = tmp_path / 'app.bin'
+    bin_file.write_bytes(data)
+    assert mb.verify_memory(0x100, str(bin_file), chunk_size=0x20) == 0x60
+
+    data[0x45] = 0
+    with pytest.raises(McuBootVerifyError) as e:
+        mb.verify_memory(0x100, data, chunk_size=0x20)
+    assert e.value.address == 0x145 and e.value.read == 0x05
+    assert mb._itf_.commands.count(CommandTag.READ_MEMORY) == 9
+
+    # The short read back is a mismatch at its end
+    mb._itf_.read_data = lambda length: bytearray(range(length - 1))
+    with pytest.raises(McuBootVerifyError) as e:
+        mb.verify_memory(0x100, bytes(range(0x20)))
+    assert e.value.address == 0x11F and e.value.read is None
+
+
+def test_read_memory_to_file(tmp_path):
+    mb = McuBoot()
+    mb._itf_ = FakeInterface(1000000, 1000000)
+    bin_file = tmp_path / 'dump.bin'
+    assert mb.read_memory(0x100, 0x50, str(bin_file)) == bytes(range(0x50))
+    assert bin_file.read_bytes() == bytes(range(0x50))
+    assert mb._itf_.commands.count(CommandTag.READ_MEMORY) == 1
+
+    del mb._itf_.commands[:]
+    bin_file.write_bytes(bytes(0x30))
+    assert mb.read_memory_to_file(0x100, 0x50, str(bin_file), chunk_size=0x20, resume=True) == 0x50
+    assert bin_file.read_bytes() == bytes(0x20) + bytes(range(0x20)) + bytes(range(0x10))
+    assert mb._itf_.commands.count(CommandTag.READ_MEMORY) == 2
+
+    # The longer file is cut to the length
+    del mb._itf_.commands[:]
+    bin_file.write_bytes(bytes(0x80))
+    assert mb.read_memory_to_file(0x100, 0x50, str(bin_file), chunk_size=0x20, resume=True) == 0x50
+    assert bin_file.read_bytes() == bytes(0x40) + bytes(range(0x10))
+    assert mb._itf_.commands.count(CommandTag.READ_MEMORY) == 1
+
+    hex_file = tmp_path / 'dump.hex'
+    mb.read_memory_to_file(0x100, 0x40, str(hex_file), chunk_size=0x20)
+    assert Image.from_file(str(hex_file)).segments == [(0x100, bytes(range(0x20)) * 2)]
+
+    # The records are written as the chunks arrive, the 64 KiB boundary of the Hex file is kept
+    for name in ('dump.srec', 'dump.ihex'):
+        mb.read_memory_to_file(0xFFF0, 0x30, str(tmp_path / name), chunk_size=0x18)
+        assert Image.from_file(str(tmp_path / name)).segments == [(0xFFF0, bytes(range(0x18)) * 2)]
+
+
+def test_write_image_resumes_from_journal():
+    mb = McuBoot()
+    mb._itf_ = FakeInterface(1000000, 1000000)
+    mb._itf_.properties[PropertyTag.FLASH_SECTOR_SIZE] = 0x100
+    written = []
+    write_data = mb._itf_.write_data
+
+    def broken_write_data(data, max_packet_size=0x20):
+        if len(written) == 2:
+            raise McuBootDataError(mode='write', errname='InvalidCRC')
+        written.append(bytes(data))
+        return write_data(data, max_packet_size)
+
+    mb._itf_.write_data = broken_write_data
+    image = Image([(0x0, bytes(range(0x100)) * 4)])
+    with pytest.raises(McuBootDataError):
+        mb.write_image(image, chunk_size=0x100)
+    assert written == [bytes(range(0x100))] * 2
+
+    mb._itf_.write_data = write_data
+    del mb._itf_.commands[:]
+    assert mb.write_image(image, chunk_size=0x100) == 0x200
+    assert mb._itf_.commands.count(CommandTag.FLASH_ERASE_REGION) == 2
+    # Without UNIQUE_DEVICE_IDENT the done chunks are read back before they are skipped
+    assert mb._itf_.commands.count(CommandTag.READ_MEMORY) == 2
+    # The journal is dropped after the image is written
+    assert mb.write_image(image, chunk_size=0x100) == 0x400
+
+    # The done chunk which differs on this device is written again
+    mb._itf_.write_data = broken_write_data
+    del written[:]
+    image = Image([(0x0, bytes(range(0xFF, -1, -1)) * 4)])
+    with pytest.raises(McuBootDataError):
+        mb.write_image(image, chunk_size=0x100)
+    mb._itf_.write_data = write_data
+    assert mb.write_image(image, chunk_size=0x100) == 0x400
+
+    # The flash erased by another command drops the journal
+    mb._itf_.write_data = broken_write_data
+    del written[:]
+    with pytest.raises(McuBootDataError):
+        mb.write_image(image, chunk_size=0x100)
+    mb._itf_.write_data = write_data
+    mb.flash_erase_all()
+    del mb._itf_.commands[:]
+    assert mb.write_image(image, chunk_size=0x100) == 0x400
+    assert mb._itf_.commands.count(CommandTag.READ_MEMORY) == 0
+
+
+def test_retry_policy():
+    policy = RetryPolicy()
+    assert policy.is_transient(McuBootDataError(mode='read', errval=StatusCode.INVALID_CRC))
+    assert not policy.is_transient(McuBootCommandError(errval=StatusCode.FLASH_ACCESS_ERROR))
+
+    mb = McuBoot()
+    mb._itf_ = FakeInterface(1000000, 1000000)
+    write_cmd = mb._itf_.write_cmd
+    failures = [McuBootDataError(mode='read', errval=StatusCode.INVALID_CRC)]
+
+    def glitchy_write_cmd(cmd, **kwargs):
+        if failures:
+            raise failures.pop()
+        return write_cmd(cmd, **kwargs)
+
+    mb._itf_.write_cmd = glitchy_write_cmd
+    assert mb.get_property(PropertyTag.CURRENT_VERSION) == 0x4B020100
+
+    mb._itf_.properties.update({PropertyTag.FLASH_SIZE: 0x10000, PropertyTag.FLASH_SECTOR_SIZE: 0x400})
+    mb.fill_memory(0x20000000, 0x10, 0)
+    failures.append(McuBootCommandError(errval=StatusCode.FLASH_ACCESS_ERROR))
+    with pytest.raises(McuBootCommandError):
+        mb.fill_memory(0x20000000, 0x10, 0)
+    assert mb._itf_.commands.count(CommandTag.FILL_MEMORY) == 1
+
+    # The flash is not written again without erase, write_image() erases the sectors of the failed run again
+    write_data = mb._itf_.write_data
+    glitches = [McuBootDataError(mode='write', errname='InvalidCRC')]
+
+    def glitchy_write_data(data, max_packet_size=0x20):
+        if glitches:
+            raise glitches.pop()
+        return write_data(data, max_packet_size)
+
+    mb._itf_.write_data = glitchy_write_data
+    with pytest.raises(McuBootDataError):
+        mb.write_memory(0x100, bytes(range(0x20)))
+    glitches.append(McuBootDataError(mode='write', errname='InvalidCRC'))
+    del mb._itf_.commands[:]
+    assert mb.write_image(Image([(0x100, bytes(range(0x100)) * 2)])) == 0x200
+    assert mb._itf_.commands.count(CommandTag.FLASH_ERASE_REGION) == 2
+    assert mb._itf_.commands.count(CommandTag.WRITE_MEMORY) == 2
+
+
+class FakeHelperTarget(FakeInterface):
+    ''' Target with flash at 0 and RAM at 0x20000000, the helper routines are emulated by the call '''
+    def __init__(self):
+        super().__init__(1000000, 1000000)
+        self.properties.update({PropertyTag.RAM_START_ADDRESS: 0x20000000, PropertyTag.RAM_SIZE: 0x8000,
+                                PropertyTag.FLASH_SECTOR_SIZE: 0x400})
+        self.flash = bytearray(0x10000)
+        self.ram = bytearray(0x8000)
+        self.address = 0
+        self.compressed = 0
+
+    def _memory(self, address):
+        return (self.ram, address - 0x20000000) if address >= 0x20000000 else (self.flash, address)
+
+    def write_cmd(self, cmd, **kwargs):
+        tag = cmd[0]
+        if tag in (CommandTag.WRITE_MEMORY, CommandTag.READ_MEMORY):
+            self.address = struct.unpack_from('<I', cmd, 4)[0]
+        elif tag == CommandTag.CALL:
+            call_address, argument = struct.unpack_from('<2I', cmd, 4)
+            code, code_offset = self._memory(call_address & ~1)
+            assert call_address & 1
+            memory, offset = self._memory(argument)
+            if code[code_offset:code_offset + len(CRC32_CODE)] == CRC32_CODE:
+                address, length, block_size = CRC32_PARAMS.unpack_from(memory, offset)
+                data, start = self._memory(address)
+                crcs = crc32_blocks(data[start:start + length], block_size)
+                struct.pack_into('<{}I'.format(len(crcs)), memory, offset + CRC32_PARAMS.size, *crcs)
+            else:
+                assert code[code_offset:code_offset + len(LZ4_CODE)] == LZ4_CODE
+                src, length, dst, _ = LZ4_PARAMS.unpack_from(memory, offset)
+                data, start = self._memory(src)
+                out = lz4_decompress(data[start:start + length])
+                self.compressed += length
+                memory, dst_offset = self._memory(dst)
+                memory[dst_offset:dst_offset + len(out)] = out
+                struct.pack_into('<I', *self._memory(argument + 12), len(out))
+        return super().write_cmd(cmd, **kwargs)
+
+    def read_data(self, length):
+        memory, offset = self._memory(self.address)
+        return memory[offset:offset + length]
+
+    def write_data(self, data, max_packet_size=0x20):
+        memory, offset = self._memory(self.address)
+        memory[offset:offset + len(data)] = data
+        return len(data)
+
+
+def test_verify_crc():
+    mb = McuBoot()
+    mb._itf_ = FakeHelperTarget()
+    data = bytes(range(0x100)) * 0x20
+    mb._itf_.flash[0x1000:0x3000] = data
+    assert mb.verify_crc(0x1000, data) == 0x2000
+    # One word per sector is read back instead of the data
+    assert mb._itf_.commands.count(CommandTag.READ_MEMORY) == 1
+    assert mb._itf_.commands.count(CommandTag.CALL) == 1
+
+    mb._itf_.flash[0x2345] = 0
+    with pytest.raises(McuBootVerifyError) as e:
+        mb.verify_crc(0x1000, data)
+    assert e.value.address == 0x2345 and e.value.expected == 0x45
+
+    # The helper is not placed over the verified RAM
+    mb._itf_.ram[0x7000:0x8000] = data[:0x1000]
+    assert mb.verify_crc(0x20007000, data[:0x1000]) == 0x1000
+    assert mb._itf_.ram[0x7000:0x8000] == data[:0x1000]
+
+
+def test_write_compressed():
+    mb = McuBoot()
+    mb._itf_ = FakeHelperTarget()
+    data = (b'\x00\x48\x70\x47' * 0x100 + bytes(range(0x100))) * 0x10
+    assert mb.write_compressed(0x20000000, data, buffer_size=0x1000) == len(data)
+    assert mb._itf_.ram[:len(data)] == data
+    assert 0 < mb._itf_.compressed < len(data) // 4
+    assert mb._itf_.commands.count(CommandTag.CALL) == 5
+
+    # The data which does not compress is written as it is
+    mb._itf_.compressed = 0
+    mb.write_compressed(0x20001000, bytes(range(0x100)))
+    assert mb._itf_.ram[0x1000:0x1100] == bytes(range(0x100)) and mb._itf_.compressed == 0
+
+    # The helper is uploaded once and kept out of all segments of the image
+    del mb._itf_.commands[:]
+    image = Image([(0x20000000, bytes(0x1000)), (0x20006000, bytes(0x1000))])
+    assert mb.write_compressed(None, image, buffer_size=0x1000) == 0x2000
+    assert mb._itf_.ram[:0x1000] == bytes(0x1000) and mb._itf_.ram[0x6000:0x7000] == bytes(0x1000)
+    assert mb._itf_.commands.count(CommandTag.CALL) == 4
+    # The properties are kept across the calls of the helper
+    assert mb._itf_.commands.count(CommandTag.GET_PROPERTY) == 0
@@ -0,0 +1,14 @@
+from mboot.memorytool import MemoryBlock, Flash, plan_erase
+
+
+def test_plan_erase():
+    blocks = [(0x800, 0x1800), MemoryBlock(0x10, 0x20), (0x1800, 0x1900)]
+    assert [(r.start, r.end) for r in plan_erase(blocks, 0x1000)] == [(0x0, 0x2000)]
+    assert [(r.start, r.end) for r in plan_erase(blocks, 0x400)] == [(0x0, 0x400), (0x800, 0x1C00)]
+
+
+def test_plan_erase_banks():
+    banks = [Flash(0x0, None, 0x80000, 0x1000), Flash(0x80000, None, 0x80000, 0x2000)]
+    regions = plan_erase([(0x7F800, 0x80800), (0x200000, 0x200010)], 0x400, banks)
+    assert [(r.start, r.end, r.sector_size) for r in regions] == [
+        (0x7F000, 0x80000, 0x1000), (0x80000, 0x82000, 0x2000), (0x200000, 0x200400, 0x400)]
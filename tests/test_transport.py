@@ -0,0 +1,101 @@
+import array
+import struct
+
+import pytest
+from mboot import McuBootTimeOutError, McuBootDataError, StatusCode
+from mboot.protocol import FPType
+from mboot.spi import SPI
+from mboot.tool import crc16
+from mboot.ftditool import IrqNotifier, ControllerPool
+
+
+class FakeGpio(object):
+    def __init__(self, levels):
+        self.levels = list(levels)
+        self.reads = 0
+
+    def set_direction(self, pins, direction):
+        pass
+
+    def read(self):
+        self.reads += 1
+        return self.levels.pop(0) if self.levels else 0xFF
+
+
+class FakeSlave(object):
+    def __init__(self, data):
+        self.data = bytearray(data)
+
+    def read(self, length):
+        out, self.data = self.data[:length], self.data[length:]
+        return array.array('B', out)
+
+
+def test_irq_notifier_wait():
+    gpio = FakeGpio([0xFF, 0xFF, 0x7F])
+    irq = IrqNotifier(gpio, 7, interval=0)
+    assert irq.wait(1)
+    assert gpio.reads == 3
+    assert not IrqNotifier(FakeGpio([]), 7, interval=0).wait(0.01)
+
+
+def test_spi_waits_on_irq_pin():
+    spi = SPI()
+    spi.slave = FakeSlave(b'\x5A')
+    spi.irq = IrqNotifier(FakeGpio([0xFF, 0x00]), 7, interval=0)
+    assert spi.find_start_byte() == b'\x5A'
+    assert not spi.slave.data
+
+    spi.irq = IrqNotifier(FakeGpio([]), 7, interval=0)
+    with pytest.raises(McuBootTimeOutError):
+        spi.find_start_byte(timeout=0.01)
+
+
+def test_ping_crc():
+    response = b'\x5A\xA7\x00\x02\x01\x50\x00\x00'
+    response += struct.pack('<H', crc16(response))
+    spi = SPI()
+    spi.slave = FakeSlave(response)
+    spi.slave.write = lambda data: None
+    assert spi.ping() == response
+
+    spi.slave = FakeSlave(response[:-1] + b'\x00')
+    spi.slave.write = lambda data: None
+    with pytest.raises(McuBootDataError):
+        spi.ping()
+
+
+class FakeController(object):
+    def __init__(self):
+        self.users = 0
+        self.terminated = False
+
+    def terminate(self):
+        self.terminated = True
+
+
+def test_controller_pool_shares_the_bus():
+    url = 'ftdi://0x403:0x6014:1/1'
+    first = ControllerPool.acquire(url, FakeController)
+    second = ControllerPool.acquire(url, lambda: pytest.fail('the bus is configured twice'))
+    assert first is second and first.users == 2
+    ControllerPool.release(first)
+    assert not first.terminated
+    ControllerPool.release(first)
+    assert first.terminated and url not in ControllerPool.Controllers
+
+
+def test_spi_resends_nacked_frame():
+    response = SPI.genPacket(FPType.CMD, struct.pack('<4B2I', 0xA0, 0, 0, 2, 0, 0x04))
+    spi = SPI()
+    spi.slave = FakeSlave(b'\x5A\xA2' + b'\x5A\xA1' + response)
+    sent = []
+    spi.slave.write = lambda data: sent.append(bytes(data))
+    spi.write_data(b'\x01\x02', 0x20)
+    frame = SPI.genPacket(FPType.DATA, b'\x01\x02')
+    assert sent[:2] == [frame, frame]
+
+    spi.slave = FakeSlave(b'\x5A\xA5\x00\x00\x00\x00')
+    with pytest.raises(McuBootDataError) as e:
+        spi.read(FPType.CMD)
+    assert e.value.errval == StatusCode.INVALID_PACKET_TYPE